@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Process-parallel block labeling with checkpoints and a deterministic merge
+
+Blocks of the reservoir raster are dispatched to a pool of worker processes.
+Each worker opens the rasters once and reads its own windows, labels the
+block with stream_label.label_block, counts (label, zone) pairs for every
+zone layer with zonal_areas.zone_counts, and writes the block's pixel
+counts, edges and pairs to a checkpoint in ckpt_dir. Checkpoints are
+written to a temporary file and renamed into place, and blocks that already
+have one are skipped, so an interrupted run resumes where it stopped.
+Checkpoints are only reused with the same parameters and the same size and
+modification time of every input raster.
+
+Blocks are then merged in row-major order with a StreamLabeler, whatever
+order they finished in, so results are the same for any number of workers
+and identical to a sequential run.
+
+Example:
+    >>> sizes, tables = analyze_raster('res.tif', {'state': 'states.tif'},
+    ...                                './blocks/', workers=8)
+
+"""
+
+
+import os
+import json
+import multiprocessing
+import gdal
+import numpy as np
+import stream_label
+import zonal_areas
+
+PARAMS_NAME = 'params.json'
+# File in the checkpoint directory recording the run's parameters
+
+_blocks = {}
+# Per worker process state for process_block, set by init_blocks
+
+
+def block_path(ckpt_dir, row_off, col_off):
+    return os.path.join(ckpt_dir, 'block_{}_{}.npz'.format(row_off, col_off))
+
+
+def raster_version(path):
+    """Absolute path, size and modification time identifying a raster"""
+    version = {'path': os.path.abspath(path)}
+    # GDAL virtual paths such as /vsigs/ have no local file to stat
+    if os.path.isfile(path):
+        st = os.stat(path)
+        version.update({'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+
+    return version
+
+
+def check_params(ckpt_dir, params):
+    """Record params in ckpt_dir, or check they match earlier checkpoints."""
+    if not os.path.isdir(ckpt_dir):
+        os.makedirs(ckpt_dir)
+    params_path = os.path.join(ckpt_dir, PARAMS_NAME)
+    if os.path.isfile(params_path):
+        with open(params_path) as fp:
+            if json.load(fp) != params:
+                raise ValueError('Checkpoints in {} are from a run with other '
+                                 'parameters'.format(ckpt_dir))
+        return
+    with open('{}.tmp'.format(params_path), 'w') as fp:
+        json.dump(params, fp, sort_keys=True, indent=4)
+    os.replace('{}.tmp'.format(params_path), params_path)
+
+    return
+
+
+def init_blocks(tif, zone_tifs, value, connectivity, ckpt_dir):
+    """Pool initializer opening the rasters once per worker."""
+    _blocks['fh'] = gdal.Open(tif)
+    _blocks['zone_fhs'] = {name: gdal.Open(zone_tif)
+                           for name, zone_tif in zone_tifs.items()}
+    _blocks['value'] = value
+    _blocks['connectivity'] = connectivity
+    _blocks['ckpt_dir'] = ckpt_dir
+
+
+def process_block(block):
+    """Label block and write its checkpoint."""
+    row_off, col_off, rows, cols = block
+    ar = _blocks['fh'].GetRasterBand(1).ReadAsArray(col_off, row_off,
+                                                    cols, rows)
+    labels, counts = stream_label.label_block(ar == _blocks['value'],
+                                              _blocks['connectivity'])
+    top, bottom, left, right = stream_label.block_edges(labels)
+    arrays = {'counts': counts, 'top': top, 'bottom': bottom, 'left': left,
+              'right': right}
+    for name, zone_fh in _blocks['zone_fhs'].items():
+        zone_ar = zone_fh.GetRasterBand(1).ReadAsArray(col_off, row_off,
+                                                       cols, rows)
+        pair_labels, pair_zones, pair_counts = zonal_areas.zone_counts(
+            labels, zone_ar)
+        arrays['{}_labels'.format(name)] = pair_labels
+        arrays['{}_zones'.format(name)] = pair_zones
+        arrays['{}_counts'.format(name)] = pair_counts
+
+    path = block_path(_blocks['ckpt_dir'], row_off, col_off)
+    with open('{}.tmp'.format(path), 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace('{}.tmp'.format(path), path)
+
+    return block
+
+
+def merge_blocks(blocks, ckpt_dir, width, zone_names, connectivity):
+    """Stitch block checkpoints in row-major order.
+
+    Returns:
+        Component sizes, and dictionary of zone_table DataFrames by zone
+        layer name.
+
+    """
+    labeler = stream_label.StreamLabeler(width, connectivity)
+    pairs = {name: ([], [], []) for name in zone_names}
+    for row_off, col_off, rows, cols in blocks:
+        with np.load(block_path(ckpt_dir, row_off, col_off)) as ckpt:
+            edges = (ckpt['top'], ckpt['bottom'], ckpt['left'],
+                     ckpt['right'])
+            offset = labeler.add_labeled(ckpt['counts'], edges, row_off,
+                                         col_off)
+            for name in zone_names:
+                label_list, zone_list, count_list = pairs[name]
+                label_list += [ckpt['{}_labels'.format(name)] + offset]
+                zone_list += [ckpt['{}_zones'.format(name)]]
+                count_list += [ckpt['{}_counts'.format(name)]]
+
+    roots = labeler.resolve()
+    tables = {name: zonal_areas.zone_table(*pairs[name], roots=roots)
+              for name in zone_names}
+
+    return labeler.sizes(), tables
+
+
+def analyze_raster(tif, zone_tifs, ckpt_dir, block_rows=stream_label.STRIP_ROWS,
+                   block_cols=None, workers=None,
+                   value=stream_label.RES_VALUE, connectivity=2):
+    """Reservoir sizes and areas by zone, labeling blocks in parallel
+
+    Args:
+        tif (str): Reservoir raster path.
+        zone_tifs (dict): Zone raster path of each zone layer name, on the
+            same grid as tif. May be empty.
+        ckpt_dir (str): Directory for block checkpoints.
+        block_rows, block_cols (int): Block size. block_cols None reads
+            full width row strips.
+        workers (int): Worker processes. None uses all cores, 1 runs in
+            this process.
+        value (int): Value of reservoir pixels.
+        connectivity (int): 1 for 4-connectivity, 2 for 8-connectivity.
+
+    Returns:
+        Array of reservoir sizes in pixels, and dictionary of zone_table
+        DataFrames by zone layer name.
+
+    """
+    fh = gdal.Open(tif)
+    height, width = fh.RasterYSize, fh.RasterXSize
+    if block_cols is None:
+        block_cols = width
+    for zone_tif in zone_tifs.values():
+        zone_fh = gdal.Open(zone_tif)
+        if (zone_fh.RasterYSize, zone_fh.RasterXSize) != (height, width):
+            raise ValueError('{} does not match the size of {}'.format(
+                zone_tif, tif))
+    # Raster versions reject checkpoints of a regenerated input
+    check_params(ckpt_dir, {'tif': raster_version(tif),
+                            'zone_tifs': {name: raster_version(zone_tif)
+                                          for name, zone_tif
+                                          in zone_tifs.items()},
+                            'block_rows': block_rows, 'block_cols': block_cols,
+                            'value': value, 'connectivity': connectivity})
+
+    blocks = list(stream_label.iter_blocks(height, width, block_rows,
+                                           block_cols))
+    pending = [block for block in blocks
+               if not os.path.isfile(block_path(ckpt_dir, *block[:2]))]
+    print('Blocks: {} total, {} already done'.format(
+        len(blocks), len(blocks) - len(pending)))
+
+    init_args = (tif, zone_tifs, value, connectivity, ckpt_dir)
+    if workers == 1:
+        init_blocks(*init_args)
+        results = map(process_block, pending)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=init_blocks,
+                                    initargs=init_args)
+        results = pool.imap_unordered(process_block, pending)
+
+    for done, _ in enumerate(results):
+        print('Blocks done: {}/{}'.format(done + 1, len(pending)))
+
+    if workers != 1:
+        pool.close()
+        pool.join()
+
+    return merge_blocks(blocks, ckpt_dir, width, sorted(zone_tifs),
+                        connectivity)
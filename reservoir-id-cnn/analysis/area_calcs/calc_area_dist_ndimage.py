@@ -1,56 +1,35 @@
 #!/usr/bin/env python3
-""" Quick script to get counts and distribution of reservoir areas'"""
+""" Quick script to get counts and distribution of reservoir areas'
 
-import gdal
-import numpy as np
+Reservoirs are labeled block by block in parallel with block_pool, and
+pieces of reservoirs crossing block edges are merged, so sizes are exact for
+the whole raster. Writes one reservoir size in pixels per line. Block
+results are checkpointed in <out_txt>_blocks/, so a rerun only processes
+blocks that are not done yet.
+"""
+
+import os
 import sys
-from scipy import ndimage
+import multiprocessing
+import stream_label
+import block_pool
 
 tif = sys.argv[1]
 out_txt = sys.argv[2]
 box_size = 10000
-
-fh = gdal.Open(tif)
-
-
-def get_count(ar):
-    mask = ar == 255
-    # Get count
-    label_im, nb_labels = ndimage.label(mask,
-                                    structure = [[1,1,1],[1,1,1],[1,1,1]])
-    print('Count done')
-
-    # Region props
-    sizes = ndimage.sum(mask, label_im, range(nb_labels + 1))
-    print('Reg Props done')
-    return sizes
+# Blocks of box_size x box_size, or full width strips of
+# stream_label.STRIP_ROWS rows if 0
+workers = multiprocessing.cpu_count()
 
 if box_size > 0:
-    total_rows, total_cols = fh.RasterYSize, fh.RasterXSize
-    current_row = 0
-    current_col = 0
-    row_starts = np.arange(0, total_rows, box_size)
-    col_starts = np.arange(0, total_cols, box_size)
-
-    # Create Nx2 array with row/col start indices
-    start_ind = np.array(np.meshgrid(row_starts, col_starts)).T.reshape(-1, 2)
-
-    for i in range(start_ind.shape[0]):
-        # For the indices near edge we need to use a smaller box size
-        box_size_rows = min(total_rows - start_ind[i,0], box_size)
-        box_size_cols = min(total_cols - start_ind[i,1], box_size)
-        ar = fh.GetRasterBand(1).ReadAsArray(
-            int(start_ind[i, 1]), int(start_ind[i,0]),
-            int(box_size_cols),int(box_size_rows))
-        sizes = get_count(ar)
-        with open(out_txt, 'a') as f:
-            for item in sizes:
-                f.write("%s\n" % int(item))
-
+    block_rows, block_cols = box_size, box_size
 else:
-    ar = fh.GetRasterBand(1).ReadAsArray()
-    print('Array read')
-    sizes = get_count(ar)
-    with open(out_txt, 'w') as f:
-        for item in sizes:
-            f.write("%s\n" % int(item))
+    block_rows, block_cols = stream_label.STRIP_ROWS, None
+sizes, _ = block_pool.analyze_raster(tif, {}, '{}_blocks/'.format(out_txt),
+                                     block_rows, block_cols, workers)
+print('Count done: {} reservoirs'.format(sizes.shape[0]))
+
+with open('{}.tmp'.format(out_txt), 'w') as f:
+    for item in sizes:
+        f.write("%s\n" % int(item))
+os.replace('{}.tmp'.format(out_txt), out_txt)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Streaming connected component labeling of rasters too large for memory
+
+The raster is read in blocks, either boxes or full width row strips, in
+row-major order. Each block is labeled on its own with ndimage.label, and
+its components get global ids. Only the block's edges are then kept: its
+first row and first column are stitched to the last row of the block row
+above and the last column of the block to its left with union-find, using
+the same connectivity as the labeling. Memory use is one block plus one
+raster row of labels, and a parent and pixel count per component.
+
+After the last block, each component's id is resolved to the id of the
+first piece of it that was labeled, and pixel counts of pieces are summed,
+giving exact sizes for components crossing any number of block edges.
+Blocks can also be labeled elsewhere, e.g. in worker processes, with
+label_block, and only their counts and edges stitched with add_labeled (see
+block_pool.py).
+
+Example:
+    >>> labeler = StreamLabeler(width)
+    >>> for row_off, col_off, rows, cols in iter_blocks(height, width,
+    ...                                                  1000, width):
+    ...     labeler.add_block(mask[row_off:row_off + rows,
+    ...                            col_off:col_off + cols], row_off, col_off)
+    >>> sizes = labeler.sizes()
+
+"""
+
+
+import numpy as np
+from scipy import ndimage
+
+STRIP_ROWS = 1000
+# Rows per strip when labeling full width row strips
+
+RES_VALUE = 255
+# Raster value of reservoir pixels
+
+
+def iter_blocks(height, width, block_rows, block_cols):
+    """Yield (row_off, col_off, rows, cols) of blocks, in row-major order"""
+    for row_off in range(0, height, block_rows):
+        for col_off in range(0, width, block_cols):
+            yield (row_off, col_off, min(block_rows, height - row_off),
+                   min(block_cols, width - col_off))
+
+
+def structure(connectivity):
+    """ndimage.label structure for 4 (1) or 8 (2) connectivity"""
+    return ndimage.generate_binary_structure(2, connectivity)
+
+
+def label_block(mask, connectivity=2):
+    """Label one block
+
+    Returns:
+        Local labels, 1 to n, 0 for background, and pixel counts of each
+        label, including 0.
+
+    """
+    labels, num_labels = ndimage.label(mask, structure=structure(connectivity))
+    counts = np.bincount(labels.ravel(), minlength=num_labels + 1)
+    counts[0] = 0
+
+    return labels, counts
+
+
+def block_edges(labels):
+    """First row, last row, first column and last column of labels"""
+    return (labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(),
+            labels[:, -1].copy())
+
+
+def edge_pairs(edge, neighbors, neighbor_off, connectivity):
+    """Pairs of nonzero labels touching across an edge
+
+    Args:
+        edge (array): Labels along the first row or column of a block.
+        neighbors (array): Labels along the adjacent row or column of the
+            neighboring block(s).
+        neighbor_off (int): Position in neighbors of edge[0].
+        connectivity (int): 1 for side neighbors only, 2 to add diagonals.
+
+    Returns:
+        Nx2 array of unique (edge label, neighbor label) pairs.
+
+    """
+    shifts = [0] if connectivity == 1 else [-1, 0, 1]
+    pairs = []
+    pos = np.arange(edge.shape[0])
+    for shift in shifts:
+        npos = pos + neighbor_off + shift
+        valid = (npos >= 0) & (npos < neighbors.shape[0])
+        a = edge[pos[valid]]
+        b = neighbors[npos[valid]]
+        touching = (a > 0) & (b > 0)
+        pairs += [np.stack((a[touching], b[touching]), axis=1)]
+    pairs = np.concatenate(pairs)
+    if pairs.shape[0] == 0:
+        return pairs
+
+    return np.unique(pairs, axis=0)
+
+
+class StreamLabeler(object):
+    """Connected components of a raster added block by block
+
+    Blocks must be added in row-major order and tile the raster, with the
+    same rows for every block of a block row.
+
+    Attributes:
+        width (int): Raster columns.
+        connectivity (int): 1 for 4-connectivity, 2 for 8-connectivity.
+        num_labels (int): Global ids given so far. Id 0 is background.
+
+    """
+    def __init__(self, width, connectivity=2):
+        self.width = width
+        self.connectivity = connectivity
+        self.num_labels = 0
+        self.parent = np.arange(1024, dtype=np.int64)
+        self.counts = np.zeros(1024, dtype=np.int64)
+        # Last row of the previous and current block rows, global ids
+        self.bottom_prev = None
+        self.bottom_cur = np.zeros(width, dtype=np.int64)
+        self.right_prev = None
+        self.row_off = None
+        self.next_col = 0
+
+    def grow(self, size):
+        """Make room for ids up to size - 1."""
+        if size <= self.parent.shape[0]:
+            return
+        capacity = max(size, 2 * self.parent.shape[0])
+        parent = np.arange(capacity, dtype=np.int64)
+        parent[:self.parent.shape[0]] = self.parent
+        counts = np.zeros(capacity, dtype=np.int64)
+        counts[:self.counts.shape[0]] = self.counts
+        self.parent, self.counts = parent, counts
+
+        return
+
+    def find(self, x):
+        """Root id of x, halving paths along the way"""
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+
+        return x
+
+    def union(self, a, b):
+        """Join the components of a and b under the smaller root id."""
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a < root_b:
+            self.parent[root_b] = root_a
+        elif root_b < root_a:
+            self.parent[root_a] = root_b
+
+        return
+
+    def add_block(self, mask, row_off, col_off):
+        """Label a block of the mask and stitch it to previous blocks.
+
+        Returns:
+            Global ids of the block's components, as a labels array. Ids are
+            not resolved, see resolve.
+
+        """
+        labels, counts = label_block(mask, self.connectivity)
+        offset = self.add_labeled(counts, block_edges(labels), row_off,
+                                  col_off)
+
+        return np.where(labels > 0, labels + offset, 0)
+
+    def add_labeled(self, counts, edges, row_off, col_off):
+        """Stitch an already labeled block to previous blocks.
+
+        Args:
+            counts (array): Pixel counts of the block's local labels.
+            edges (tuple): Local labels of the block's first row, last row,
+                first column and last column, as block_edges.
+            row_off, col_off (int): Position of the block in the raster.
+
+        Returns:
+            Offset added to the block's local labels to get global ids.
+
+        """
+        top, bottom, left, right = edges
+        if col_off == 0:
+            # New block row
+            if self.row_off is not None:
+                if self.next_col != self.width:
+                    raise ValueError('Block row at {} is incomplete'.format(
+                        self.row_off))
+                self.bottom_prev = self.bottom_cur.copy()
+            self.row_off = row_off
+            self.right_prev = None
+        elif row_off != self.row_off or col_off != self.next_col:
+            raise ValueError('Block at ({}, {}) is out of order'.format(
+                row_off, col_off))
+        self.next_col = col_off + top.shape[0]
+
+        offset = self.num_labels
+        num_local = counts.shape[0] - 1
+        self.grow(offset + num_local + 1)
+        self.counts[offset + 1:offset + num_local + 1] = counts[1:]
+        self.num_labels += num_local
+
+        def to_global(edge):
+            return np.where(edge > 0, edge.astype(np.int64) + offset, 0)
+        top, bottom, left, right = [to_global(e) for e in edges]
+
+        pairs = []
+        if row_off > 0:
+            pairs += [edge_pairs(top, self.bottom_prev, col_off,
+                                 self.connectivity)]
+        if self.right_prev is not None:
+            pairs += [edge_pairs(left, self.right_prev, 0, self.connectivity)]
+        for block_pairs in pairs:
+            for a, b in block_pairs:
+                self.union(a, b)
+
+        self.bottom_cur[col_off:col_off + bottom.shape[0]] = bottom
+        self.right_prev = right
+
+        return offset
+
+    def resolve(self):
+        """Root id of every global id, 0 to num_labels"""
+        roots = self.parent[:self.num_labels + 1].copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+    def sizes(self):
+        """Pixel count of every component, in order of first labeling"""
+        roots = self.resolve()
+        sizes = np.bincount(roots, weights=self.counts[:self.num_labels + 1],
+                            minlength=self.num_labels + 1).astype(np.int64)
+        is_root = roots == np.arange(self.num_labels + 1)
+        is_root[0] = False
+
+        return sizes[is_root]
+
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Reservoir areas by zone for several zone layers in a single pass
+
+Reservoirs are labeled once per block with stream_label, and block_pool.py
+runs the pass. For every zone layer (e.g. states, ecoregions, watersheds),
+the block's pixels are counted per (reservoir, zone) pair with one bincount
+over joint indices, so all zones of all layers are attributed in the same
+pass, in O(pixels) per block. After the last block, reservoir ids are
+resolved across block edges and pairs are summed.
+
+Zone rasters must be on the same grid as the reservoir raster.
+
+Example:
+    >>> labels, zones, counts = zone_counts(block_labels, block_states)
+
+"""
+
+
+import numpy as np
+import pandas as pd
+
+
+def zone_counts(labels, zone_ar):
+    """Pixel counts of every (label, zone) pair in a block
+
+    Args:
+        labels (array): Block labels, 0 for background.
+        zone_ar (array): Zone values of the block.
+
+    Returns:
+        Arrays of labels, zone values and pixel counts of nonzero pairs.
+
+    """
+    is_res = labels > 0
+    res_labels = labels[is_res]
+    if res_labels.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    zone_values, zone_idx = np.unique(zone_ar[is_res], return_inverse=True)
+    label_min = res_labels.min()
+    joint = ((res_labels - label_min).astype(np.int64) * zone_values.size
+             + zone_idx.ravel())
+    counts = np.bincount(joint)
+    pairs = np.nonzero(counts)[0]
+
+    return (pairs // zone_values.size + label_min,
+            zone_values[pairs % zone_values.size].astype(np.int64),
+            counts[pairs])
+
+
+def zone_table(label_list, zone_list, count_list, roots):
+    """Tidy table of reservoir area by zone, from per block pair counts
+
+    Returns:
+        DataFrame with columns reg, res_id and area in pixels, one row per
+        zone and reservoir, res_id being the resolved reservoir id.
+
+    """
+    df = pd.DataFrame({'reg': np.concatenate(zone_list),
+                       'res_id': roots[np.concatenate(label_list)],
+                       'area': np.concatenate(count_list)})
+    df = df.groupby(['reg', 'res_id'], as_index=False)['area'].sum()
+
+    return df.sort_values(['reg', 'res_id']).reset_index(drop=True)
+
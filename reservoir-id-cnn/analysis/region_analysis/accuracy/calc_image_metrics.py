@@ -1,10 +1,14 @@
 """
 Calculate accuracy metrics for each ecoregion, state, and biome
 """
+import os
 import sys
 import numpy as np
 from skimage import transform
 import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../../../train'))
+import pixel_metrics
 
 pred_npy_path = '../../train/logs/v23_fulltrain_good_68f1/predict/pred_test_masks.npy'
 masks_npy_path = '../../train/data/prepped/imgs_mask_test.npy'
@@ -26,26 +30,20 @@ pred = np.delete(pred, -11,axis=0)
 
 test_names_df = pd.read_csv(test_names_path, header=None)
 
-metrics_df = pd.DataFrame()
-for i in range(pred.shape[0]):
-    this_pred = pred[i]
-    this_mask = test[i]
-    temp_dict = {}
-    temp_dict['filename'] = test_names_df.iloc[i, 0]
-
-    temp_dict['true_pos'] = np.sum((this_pred==255)*(this_mask==255))
-    temp_dict['false_pos'] = np.sum((this_pred==255)*(this_mask==0))
-    temp_dict['true_neg'] = np.sum((this_pred==0)*(this_mask==0))
-    temp_dict['false_neg'] = np.sum((this_pred==0)*(this_mask==255))
-
-    temp_dict['precision'] = temp_dict['true_pos']/(temp_dict['true_pos'] + temp_dict['false_pos'])
-    temp_dict['recall'] = temp_dict['true_pos']/(temp_dict['true_pos'] + temp_dict['false_neg'])
-    temp_dict['f1'] = 2*(temp_dict['precision']*temp_dict['recall'])/(temp_dict['precision']+temp_dict['recall'])
-    temp_dict['intersection'] = np.sum((this_pred/255)*(this_mask/255))
-    temp_dict['j_sum'] = np.sum(this_pred + this_mask)/255
-    temp_dict['ji'] = (temp_dict['intersection']) / (temp_dict['j_sum'] - temp_dict['intersection'])
-
-    metrics_df = metrics_df.append(temp_dict, ignore_index=True)
+counts = pixel_metrics.confusion_counts(pred == 255, test == 255)
+m = pixel_metrics.metrics_from_counts(counts)
+metrics_df = pd.DataFrame({
+    'filename': test_names_df.iloc[:pred.shape[0], 0].values,
+    'true_pos': m['true_pos'],
+    'false_pos': m['false_pos'],
+    'true_neg': m['true_neg'],
+    'false_neg': m['false_neg'],
+    'precision': m['precision'],
+    'recall': m['recall'],
+    'f1': m['f1'],
+    'intersection': m['true_pos'],
+    'j_sum': 2*m['true_pos'] + m['false_pos'] + m['false_neg'],
+    'ji': m['iou']})
 
 
 # Join region, biome, etc.
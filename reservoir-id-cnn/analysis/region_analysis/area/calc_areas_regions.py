@@ -1,57 +1,37 @@
 #!/usr/bin/env python3
-""" Quick script to get counts and distribution of reservoir areas'"""
+""" Quick script to get reservoir areas by region for several region rasters
 
-import gdal
-import numpy as np
+Reservoirs are labeled once per block and attributed to every region of all
+region rasters in the same pass (see area_calcs/zonal_areas.py). Blocks
+are processed in parallel and checkpointed in <out_dir>/blocks/, so a rerun
+only processes blocks that are not done yet (see area_calcs/block_pool.py).
+Writes <out_dir>/<name>_sizes.csv for each name=region_tif argument, with
+columns reg, res_id and area in pixels.
+
+Example:
+    python3 calc_areas_regions.py res.tif ./data/ state=states.tif \
+        eco=ecoregions.tif watersheds=watersheds_4digit.tif
+"""
+
+import os
 import sys
-from scipy import ndimage
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../../area_calcs'))
+import block_pool
 
 tif = sys.argv[1]
-region_tif = sys.argv[2]
-out_txt = sys.argv[3]
+out_dir = sys.argv[2]
+region_tifs = dict(arg.split('=', 1) for arg in sys.argv[3:])
 box_size = 10000
-
-fh = gdal.Open(tif)
-region_fh = gdal.Open(region_tif) 
-
-
-def get_count(ar):
-    mask = ar == 255
-    # Get count
-    label_im, nb_labels = ndimage.label(mask,
-                                    structure = [[1,1,1],[1,1,1],[1,1,1]])
-    print('Count done')
-
-    # Region props
-    sizes = ndimage.sum(mask, label_im, range(nb_labels + 1))
-    print('Reg Props done')
-    return sizes
-
-total_rows, total_cols = fh.RasterYSize, fh.RasterXSize
-current_row = 0
-current_col = 0
-row_starts = np.arange(0, total_rows, box_size)
-col_starts = np.arange(0, total_cols, box_size)
-
-# Create Nx2 array with row/col start indices
-start_ind = np.array(np.meshgrid(row_starts, col_starts)).T.reshape(-1, 2)
-
-with open(out_txt, 'w') as f:
-    f.write('reg,area\n')
-for i in range(start_ind.shape[0]):
-    # For the indices near edge we need to use a smaller box size
-    box_size_rows = min(total_rows - start_ind[i,0], box_size)
-    box_size_cols = min(total_cols - start_ind[i,1], box_size)
-    ar = fh.GetRasterBand(1).ReadAsArray(
-        int(start_ind[i, 1]), int(start_ind[i,0]),
-        int(box_size_cols),int(box_size_rows))
-    reg_ar = region_fh.GetRasterBand(1).ReadAsArray(
-        int(start_ind[i, 1]), int(start_ind[i,0]),
-        int(box_size_cols),int(box_size_rows))
-    for reg_num in np.unique(reg_ar):
-        ar_cur_reg = ar.copy() 
-        ar_cur_reg[reg_ar!=reg_num] = 0
-        sizes = get_count(ar_cur_reg)
-        with open(out_txt, 'a') as f:
-            for item in sizes:
-                f.write("{},{}\n".format(int(reg_num), int(item)))
+workers = multiprocessing.cpu_count()
+
+_, tables = block_pool.analyze_raster(tif, region_tifs,
+                                      os.path.join(out_dir, 'blocks/'),
+                                      box_size, box_size, workers)
+for name, df in tables.items():
+    csv_path = os.path.join(out_dir, '{}_sizes.csv'.format(name))
+    df.to_csv('{}.tmp'.format(csv_path), index=False)
+    os.replace('{}.tmp'.format(csv_path), csv_path)
+    print('{}: {} reservoir pieces in {} regions'.format(
+        name, df.shape[0], df['reg'].nunique()))
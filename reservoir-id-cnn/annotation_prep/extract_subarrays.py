@@ -5,21 +5,57 @@
 This script extracts subset images from a large geoTiff. These images can then
 be annotated to create training/test data for the CNN.
 
+Only the windows of the chosen sub-images are read from the source, so
+memory use does not depend on the scene size. The source can be a local file
+or a remote one read by byte ranges through GDAL, e.g. gs://bucket/eg.tif.
+Sub-image positions are drawn only where the whole window is free of nodata
+(see valid_sampler.py), so exactly the requested number is always extracted.
+The nodata mask is built from a decimated read of the scene, and each window
+is checked again when read. With --exact_mask the mask is built from every
+pixel instead, which reads the whole scene.
+
+With --batch, source_path is a glob (local, or gs:// expanded with gsutil)
+or a text file listing one scene per line, and scenes are processed by a
+pool of worker processes. Chips of each scene go to out_dir/<scene index>/,
+where the scene index is the last '_' separated part of its file name, and
+are written by a thread pool while the next windows are read. A single
+grid_indices.csv covering all scenes is then written atomically to out_dir.
+
 Example:
     Create 5 10x10 sub-images of raster 'eg.tif':
     $ python3 extract_subarrays.py eg.tif 5 10 10 out/ --out_prefix='eg_sub_'
 
+    Create 80 500x500 sub-images of every scene listed in scenes.txt:
+    $ gsutil ls gs://bucket/scenes/*.tif > scenes.txt
+    $ python3 extract_subarrays.py scenes.txt 80 500 500 out/ --batch \
+        --out_prefix='im_' --min_spacing=0
+
 Notes:
     In order to work with Labelbox, the images must be exported as png or jpg.
 """
 
 
-import os.path
+import os
+import sys
+import glob
 import argparse
+import traceback
+import subprocess as sp
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from skimage import io
-import gdal
+import rasterio
+from rasterio.windows import Window
+import valid_sampler
+
+REMOTE_GDAL_OPTIONS = {'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+                       'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif'}
+# GDAL settings avoiding extra requests when reading remote sources
+
+WRITER_THREADS = 4
+# Threads per scene writing chips in batch mode
 
 
 def argparse_init():
@@ -29,7 +65,9 @@ def argparse_init():
             description='Extract subest images from larger raster/image.',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.add_argument('source_path',
-        help = 'Path to raw input image',
+        help = ('Path or URL (e.g. gs://bucket/image.tif) of raw input image.'
+                ' With --batch, a local or gs:// glob, or a text file '
+                'listing images'),
         type = str)
     p.add_argument('num_subsets',
         help = 'Number of subsets to create',
@@ -47,10 +85,47 @@ def argparse_init():
         help = 'Prefix for output tiffs',
         default = 'image_',
         type = str)
+    p.add_argument('--seed',
+        help = 'Random seed for subset locations',
+        default = None,
+        type = int)
+    p.add_argument('--min_spacing',
+        help = 'Minimum gap in pixels between subsets. Overlap if not set',
+        default = None,
+        type = int)
+    p.add_argument('--cell_size',
+        help = 'Cell size in pixels of the nodata validity mask',
+        default = valid_sampler.CELL_SIZE,
+        type = int)
+    p.add_argument('--exact_mask',
+        help = ('Build the nodata mask from every pixel instead of a '
+                'decimated read. Reads the whole scene'),
+        action = 'store_true')
+    p.add_argument('--batch',
+        help = 'Process every scene of the source_path glob or list',
+        action = 'store_true')
+    p.add_argument('--workers',
+        help = 'Number of scenes processed at once in batch mode',
+        default = multiprocessing.cpu_count(),
+        type = int)
+    p.add_argument('--writer_threads',
+        help = 'Threads per scene writing chips in batch mode',
+        default = WRITER_THREADS,
+        type = int)
 
     return(p)
 
 
+def write_csv_atomic(df, csv_path):
+    """Write csv to a temporary file and rename it into place"""
+
+    tmp_path = '{}.tmp'.format(csv_path)
+    df.to_csv(tmp_path, header = True, index=False)
+    os.replace(tmp_path, csv_path)
+
+    return()
+
+
 def write_append_csv(df,csv_path):
     """Check if csv already exists. Append if it does, write w/ header if not"""
 
@@ -103,22 +178,83 @@ def create_gmaps_link(xmin_pix, ymin_pix, xmax_pix, ymax_pix, gt):
     return(gmaps_links)
 
 
-def subset_image(vis_im, og_im, num_subsets, dim_x, dim_y, out_dir,
-        source_path, out_prefix, nodata = 0):
-    """Create num_subsets images of (dim_x, dim_y) size from vis_im."""
+def read_window(src, xmin, ymin, dim_x, dim_y):
+    """Read rows xmin:xmin+dim_x, cols ymin:ymin+dim_y as rows x cols x bands"""
 
-    # Randomly select locations for sub-arrays
-    sub_xmins = np.random.random_integers(0, vis_im.shape[0] - (dim_x + 1),
-                    num_subsets)
-    sub_ymins = np.random.random_integers(0, vis_im.shape[1] - (dim_y + 1),
-                    num_subsets)
+    window = Window(col_off=ymin, row_off=xmin, width=dim_y, height=dim_x)
+
+    return(np.moveaxis(src.read(window=window), 0, -1))
+
+
+def save_subset(sub_og_im, out_dir, out_prefix, snum):
+    """Save NDWI png, for annotating, and original tif, for training"""
+
+    subset_ndwi_path = '{}/{}{}_ndwi.png'.format(out_dir,out_prefix,snum)
+    sub_ndwi_im = normalized_diff(sub_og_im[:,:,1],sub_og_im[:,:,3])
+    sub_ndwi_im_byte = scale_image_tobyte(sub_ndwi_im)
+    io.imsave(subset_ndwi_path, sub_ndwi_im_byte, plugin = 'pil')
+
+    subset_og_path = '{}/{}{}_og.tif'.format(out_dir,out_prefix,snum)
+    io.imsave(subset_og_path, sub_og_im, plugin = 'tifffile', compress = 6)
+
+    return()
+
+
+def subset_image(src, num_subsets, dim_x, dim_y, out_dir,
+        source_path, out_prefix, nodata = 0, seed = None, min_spacing = None,
+        cell_size = valid_sampler.CELL_SIZE, writer = None, write_csv = True,
+        max_pending = 2 * WRITER_THREADS, exact_mask = False):
+    """Create num_subsets images of (dim_x, dim_y) size from open src.
+
+    Each sub-image is read with a windowed read of src, a rasterio dataset.
+    If writer, an Executor, is given, sub-images are saved by it while the
+    next ones are read, with at most max_pending writes in flight. Grid
+    indices are appended to out_dir's grid_indices.csv if write_csv, and
+    returned.
+    """
+
+    # Randomly select locations for sub-arrays, where there is no nodata
+    valid_mask = valid_sampler.validity_mask(src, cell_size, nodata,
+                                             exact = exact_mask)
+    sampler = valid_sampler.WindowSampler(
+        valid_mask, cell_size, src.height, src.width, dim_x, dim_y,
+        seed = seed, min_spacing = min_spacing)
+
+    # Save sub-arrays
+    saves = []
+    snum = 0
+    for xmin, ymin in sampler.candidates():
+        if snum == num_subsets:
+            break
+        sub_og_im = read_window(src, xmin, ymin, dim_x, dim_y)
+        # Skip windows a decimated mask missed nodata in
+        if np.any(sub_og_im == nodata):
+            continue
+        sampler.accept(xmin, ymin)
+        if writer is None:
+            save_subset(sub_og_im, out_dir, out_prefix, snum)
+        else:
+            # Bound chips held in memory waiting to be written
+            if len(saves) >= max_pending:
+                saves.pop(0).result()
+            saves += [writer.submit(save_subset, sub_og_im, out_dir,
+                                    out_prefix, snum)]
+        snum += 1
+    # Wait for writes, raising any error
+    for save in saves:
+        save.result()
+    if snum < num_subsets:
+        raise ValueError('Valid area only holds {} of {} requested '
+                         'windows'.format(snum, num_subsets))
+
+    sub_xmins, sub_ymins = sampler.positions()
 
     # Get xmaxs and ymaxs
     sub_xmaxs = sub_xmins + dim_x
     sub_ymaxs = sub_ymins + dim_y
 
-    # Geotransformation
-    source_geotrans = gdal.Open(source_path).GetGeoTransform()
+    # Geotransformation, in GDAL order
+    source_geotrans = src.transform.to_gdal()
 
     # Get Google maps link
     sub_gmaps_links = create_gmaps_link(sub_xmins, sub_ymins, sub_xmaxs,
@@ -136,34 +272,107 @@ def subset_image(vis_im, og_im, num_subsets, dim_x, dim_y, out_dir,
         'gmaps_link': sub_gmaps_links
         })
 
-    # Save sub-arrays
-    null_im_mask = np.ones(num_subsets, dtype = bool)
-    for snum in range(0, num_subsets):
-        # NDWI image, for annotating
-        subset_ndwi_path = '{}/{}{}_ndwi.png'.format(out_dir,out_prefix,snum)
-        sub_ndwi_im = og_im[sub_xmins[snum]:sub_xmins[snum] + dim_x,
-                      sub_ymins[snum]:sub_ymins[snum] + dim_y,
-                      :]
-        # Check image for no data
-        if np.any(sub_ndwi_im == nodata):
-            null_im_mask[snum] = False
-            continue
-        sub_ndwi_im = normalized_diff(sub_ndwi_im[:,:,1],sub_ndwi_im[:,:,3])
-        sub_ndwi_im_byte = scale_image_tobyte(sub_ndwi_im)
-        io.imsave(subset_ndwi_path, sub_ndwi_im_byte, plugin = 'pil')
+    # Write grid indices to csv
+    if write_csv:
+        write_append_csv(grid_indices_df,'{}/grid_indices.csv'.format(out_dir))
 
-        # Original image, for training
-        subset_og_path = '{}/{}{}_og.tif'.format(out_dir,out_prefix,snum)
-        sub_og_im = og_im[sub_xmins[snum]:sub_xmins[snum] + dim_x,
-                      sub_ymins[snum]:sub_ymins[snum] + dim_y,
-                      :]
-        io.imsave(subset_og_path, sub_og_im, plugin = 'tifffile', compress = 6)
+    return(grid_indices_df)
 
-    # Write grid indices to csv
-    grid_indices_df = grid_indices_df.iloc[null_im_mask]
-    write_append_csv(grid_indices_df,'{}/grid_indices.csv'.format(out_dir))
 
-    return()
+def scene_paths(source_path):
+    """Scenes of a batch: lines of a .txt list, or matches of a glob
+
+    Local globs are expanded with glob, gs:// ones with gsutil ls.
+    """
+
+    if source_path.endswith('.txt'):
+        with open(source_path) as f:
+            return([line.strip() for line in f if line.strip()])
+
+    if source_path.startswith('gs://'):
+        listing = sp.run(['gsutil', 'ls', source_path], check = True,
+                         stdout = sp.PIPE, universal_newlines = True).stdout
+        return(sorted(line.strip() for line in listing.splitlines()
+                      if line.strip()))
+
+    return(sorted(glob.glob(source_path)))
+
+
+def scene_index(source_path):
+    """Last '_' separated part of the scene file name, without extension"""
+
+    return(os.path.splitext(os.path.basename(source_path))[0].split('_')[-1])
+
+
+def extract_scene(task):
+    """Extract sub-images of one scene of a batch, in a worker process.
+
+    Returns:
+        Scene path, and its grid indices or None and the error if it failed.
+    """
+
+    source_path, args, seed = task
+    index = scene_index(source_path)
+    out_dir = os.path.join(args.out_dir, index)
+    try:
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        with rasterio.Env(**REMOTE_GDAL_OPTIONS):
+            with rasterio.open(source_path) as src:
+                with ThreadPoolExecutor(args.writer_threads) as writer:
+                    grid_indices_df = subset_image(
+                        src, args.num_subsets,
+                        args.subset_dim_x, args.subset_dim_y,
+                        out_dir, source_path,
+                        '{}{}_'.format(args.out_prefix, index),
+                        seed = seed, min_spacing = args.min_spacing,
+                        cell_size = args.cell_size, writer = writer,
+                        write_csv = False,
+                        max_pending = 2 * args.writer_threads,
+                        exact_mask = args.exact_mask)
+    except Exception:
+        return(source_path, None, traceback.format_exc())
+
+    return(source_path, grid_indices_df, None)
+
+
+def extract_batch(args):
+    """Extract sub-images of all scenes of a batch with a process pool.
+
+    Writes one grid_indices.csv for all scenes to args.out_dir, in scene
+    order, and returns the list of scenes that failed.
+    """
+
+    sources = scene_paths(args.source_path)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    # Seed each scene by its position, so results do not depend on timing
+    tasks = [(source, args,
+              None if args.seed is None else args.seed + i)
+             for i, source in enumerate(sources)]
+
+    grid_dfs = {}
+    failed = []
+    pool = multiprocessing.Pool(min(args.workers, max(1, len(tasks))))
+    for done, (source, grid_df, error) in enumerate(
+            pool.imap_unordered(extract_scene, tasks)):
+        if grid_df is None:
+            failed += [source]
+            print('Failed: {}\n{}'.format(source, error))
+        else:
+            grid_dfs[source] = grid_df
+        print('Done: {}/{} scenes'.format(done + 1, len(tasks)))
+    pool.close()
+    pool.join()
+
+    if len(grid_dfs) > 0:
+        grid_indices_df = pd.concat([grid_dfs[source] for source in sources
+                                     if source in grid_dfs])
+        write_csv_atomic(grid_indices_df,
+                         os.path.join(args.out_dir, 'grid_indices.csv'))
+
+    return(failed)
 
 
 def main():
@@ -171,14 +380,21 @@ def main():
     parser = argparse_init()
     args = parser.parse_args()
 
-    # Read image
-    base_image = io.imread(args.source_path)
-    base_image_bandselect = base_image[:,:,[2,1,0]]
-
-    # Get subsets
-    subset_image(base_image_bandselect, base_image, args.num_subsets,
-        args.subset_dim_x,args.subset_dim_y,
-        args.out_dir, args.source_path, args.out_prefix)
+    if args.batch:
+        failed = extract_batch(args)
+        if len(failed) > 0:
+            sys.exit('{} scenes failed: {}'.format(len(failed), failed))
+        return()
+
+    # Open image, reading only the windows of the subsets
+    with rasterio.Env(**REMOTE_GDAL_OPTIONS):
+        with rasterio.open(args.source_path) as src:
+            # Get subsets
+            subset_image(src, args.num_subsets,
+                args.subset_dim_x,args.subset_dim_y,
+                args.out_dir, args.source_path, args.out_prefix,
+                seed = args.seed, min_spacing = args.min_spacing,
+                cell_size = args.cell_size, exact_mask = args.exact_mask)
 
     return()
 
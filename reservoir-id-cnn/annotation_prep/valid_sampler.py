@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Sample sub-image positions whose whole window is free of nodata
+
+A coarse validity mask is built once per scene, with a cell marked invalid
+if any band of any of its pixels is nodata. An integral image of invalid
+cells then gives, in constant time per position, whether a window touches
+an invalid cell, so positions are drawn only among windows that are
+entirely valid.
+
+By default the mask is read decimated, one value per cell with min
+resampling, which uses the scene's overviews if it has them, so building it
+reads a small fraction of a remote scene. Overviews built with another
+resampling may miss isolated nodata pixels, so callers still check each
+window they read and reject the rare invalid one (see WindowSampler). With
+exact, every pixel of the scene is read in strips instead, giving a
+conservative mask at the cost of reading the whole scene.
+
+Example:
+    >>> with rasterio.open('eg.tif') as src:
+    ...     mask = validity_mask(src, cell_size=10)
+    ...     xmins, ymins = sample_windows(mask, 10, src.height, src.width,
+    ...                                   80, 500, 500, seed=0,
+    ...                                   min_spacing=0)
+"""
+
+
+import numpy as np
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+
+CELL_SIZE = 10
+# Side in pixels of a validity mask cell
+
+MASK_ROWS = 1024
+# Approximate number of scene rows read at once when building an exact mask
+
+
+def validity_mask(src, cell_size = CELL_SIZE, nodata = 0, exact = False):
+    """Boolean mask of cells of src with no nodata pixel in any band"""
+
+    n_rows = int(np.ceil(src.height / cell_size))
+    n_cols = int(np.ceil(src.width / cell_size))
+    if not exact:
+        # Min of each cell is nodata if any pixel is, for nodata below data
+        cells = src.read(out_shape = (src.count, n_rows, n_cols),
+                         resampling = Resampling.min)
+        return(~np.any(cells == nodata, axis = 0))
+
+    pad_cols = n_cols * cell_size - src.width
+    strip_cells = max(1, MASK_ROWS // cell_size)
+    mask = np.zeros((n_rows, n_cols), dtype = bool)
+    for cell_row in range(0, n_rows, strip_cells):
+        row_off = cell_row * cell_size
+        height = min(strip_cells * cell_size, src.height - row_off)
+        strip = src.read(window=Window(col_off=0, row_off=row_off,
+                                       width=src.width, height=height))
+        invalid = np.any(strip == nodata, axis = 0)
+
+        # Pad partial cells at the edges with valid pixels, windows are
+        # kept inside the scene separately
+        pad_rows = int(np.ceil(height / cell_size)) * cell_size - height
+        invalid = np.pad(invalid, ((0, pad_rows), (0, pad_cols)),
+                         mode = 'constant')
+        invalid = invalid.reshape(invalid.shape[0] // cell_size, cell_size,
+                                  n_cols, cell_size).any(axis = (1, 3))
+        mask[cell_row:cell_row + invalid.shape[0]] = ~invalid
+
+    return(mask)
+
+
+def integral_image(ar):
+    """Summed area table of ar, padded with a leading row and column of 0"""
+
+    sat = np.zeros((ar.shape[0] + 1, ar.shape[1] + 1), dtype = np.int64)
+    sat[1:, 1:] = ar.cumsum(axis = 0).cumsum(axis = 1)
+
+    return(sat)
+
+
+def cell_spans(cell_size, size, dim):
+    """First and past-the-end cells touched by windows starting in a cell
+
+    For each cell a window of dim pixels can start in, inside a scene of
+    size pixels, the cells touched by windows starting anywhere in the cell,
+    up to the last start that keeps the window in the scene.
+    """
+
+    starts = np.arange((size - dim) // cell_size + 1)
+    last_start = np.minimum(starts * cell_size + cell_size - 1, size - dim)
+
+    return(starts, (last_start + dim - 1) // cell_size + 1)
+
+
+def valid_cells(mask, cell_size, height, width, dim_x, dim_y):
+    """Cells from which a dim_x x dim_y window at any pixel offset is valid
+
+    Returns:
+        Row and column indices of cells where a window starting anywhere in
+        the cell, and inside the scene, only touches valid cells.
+    """
+
+    if dim_x > height or dim_y > width:
+        return(np.zeros(0, dtype = int), np.zeros(0, dtype = int))
+    x_starts, x_ends = cell_spans(cell_size, height, dim_x)
+    y_starts, y_ends = cell_spans(cell_size, width, dim_y)
+
+    sat = integral_image(~mask)
+    invalid = (sat[x_ends[:, None], y_ends[None, :]]
+               - sat[x_starts[:, None], y_ends[None, :]]
+               - sat[x_ends[:, None], y_starts[None, :]]
+               + sat[x_starts[:, None], y_starts[None, :]])
+    cell_xs, cell_ys = np.nonzero(invalid == 0)
+
+    return(x_starts[cell_xs], y_starts[cell_ys])
+
+
+class WindowSampler(object):
+    """Random valid window positions, drawn one candidate at a time
+
+    Candidates come in random order, each at least min_spacing from all
+    accepted windows. The caller accepts the ones it keeps, so windows
+    found invalid when read can be skipped.
+
+    Attributes:
+        xmins, ymins (list): Rows and columns of accepted windows.
+    """
+    def __init__(self, mask, cell_size, height, width, dim_x, dim_y,
+            seed = None, min_spacing = None):
+        self.cell_size = cell_size
+        self.height = height
+        self.width = width
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.min_spacing = min_spacing
+        self.rng = np.random.RandomState(seed)
+        self.cell_xs, self.cell_ys = valid_cells(mask, cell_size, height,
+                                                 width, dim_x, dim_y)
+        self.xmins = []
+        self.ymins = []
+
+    def too_close(self, xmin, ymin):
+        if self.min_spacing is None or len(self.xmins) == 0:
+            return(False)
+        return(np.any(
+            (np.abs(np.array(self.xmins) - xmin) < self.dim_x + self.min_spacing)
+            & (np.abs(np.array(self.ymins) - ymin) < self.dim_y + self.min_spacing)))
+
+    def candidates(self):
+        """Yield candidate (xmin, ymin) positions"""
+
+        cell_size = self.cell_size
+        for cand in self.rng.permutation(self.cell_xs.shape[0]):
+            # Random pixel offset within the cell, keeping the window in scene
+            x_base = self.cell_xs[cand] * cell_size
+            y_base = self.cell_ys[cand] * cell_size
+            xmin = x_base + self.rng.randint(
+                min(cell_size, self.height - self.dim_x - x_base + 1))
+            ymin = y_base + self.rng.randint(
+                min(cell_size, self.width - self.dim_y - y_base + 1))
+            if not self.too_close(xmin, ymin):
+                yield (xmin, ymin)
+
+    def accept(self, xmin, ymin):
+        self.xmins += [xmin]
+        self.ymins += [ymin]
+
+        return()
+
+    def positions(self):
+        """Arrays of accepted window xmins (rows) and ymins (columns)"""
+
+        return(np.array(self.xmins, dtype = int),
+               np.array(self.ymins, dtype = int))
+
+
+def sample_windows(mask, cell_size, height, width, num_subsets, dim_x, dim_y,
+        seed = None, min_spacing = None):
+    """Draw exactly num_subsets valid window positions
+
+    Args:
+        mask (array): Validity mask from validity_mask.
+        cell_size (int): Cell size the mask was built with.
+        height, width (int): Scene size in pixels.
+        num_subsets (int): Number of windows to draw.
+        dim_x, dim_y (int): Window rows and columns.
+        seed (int): Random seed, or None.
+        min_spacing (int): Minimum gap in pixels between windows, or None to
+            allow windows to overlap. 0 gives touching, non-overlapping
+            windows.
+
+    Returns:
+        Arrays of window xmins (rows) and ymins (columns).
+
+    Raises:
+        ValueError: If the valid area cannot hold num_subsets windows.
+    """
+
+    sampler = WindowSampler(mask, cell_size, height, width, dim_x, dim_y,
+                            seed = seed, min_spacing = min_spacing)
+    for xmin, ymin in sampler.candidates():
+        sampler.accept(xmin, ymin)
+        if len(sampler.xmins) == num_subsets:
+            break
+
+    if len(sampler.xmins) < num_subsets:
+        raise ValueError('Valid area only holds {} of {} requested '
+                         'windows'.format(len(sampler.xmins), num_subsets))
+
+    return(sampler.positions())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Export trained U-Net to an int8 quantized TensorFlow Lite model
+
+Post-training quantization is calibrated on the prepped validation images.
+After conversion the quantized model is run against the float Keras model on
+the test split and the mask agreement is reported. The band statistics and
+normalized difference scaling are copied next to the artifact as
+<out>_mean_std.npy and <out>_nd_scaling.txt, where predict_map finds them
+automatically.
+
+Example:
+    $ python3 export_model.py structure.txt weights.h5 mean_std.npy \
+        ../train/data/prepped/ unet_int8.tflite
+
+"""
+
+
+import os
+import json
+import argparse
+import numpy as np
+from skimage import transform
+import tensorflow as tf
+import inference_backend
+from predict_map import BAND_SELECTION, RESIZE_ROWS, RESIZE_COLS
+
+PRED_THRESHOLD = 0.5
+# Prediction threshold. > PRED_THRESHOLD will be classified as res.
+
+EVAL_BATCH_SIZE = 12
+# Batch size for comparing float and quantized predictions
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs"""
+
+    p = argparse.ArgumentParser(
+            description='Export U-Net to a quantized TFLite model.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('model_structure',
+                   help = 'Text file containing model structure saved as json.',
+                   type = str)
+    p.add_argument('model_weights',
+                   help = 'hdf5 file containing saved model weights.',
+                   type = str)
+    p.add_argument('mean_std',
+                   help = 'npy file with training band means and stds.',
+                   type = str)
+    p.add_argument('prepped_dir',
+                   help = 'Directory containing imgs_val.npy and imgs_test.npy',
+                   type = str)
+    p.add_argument('out_path',
+                   help = 'Path for output .tflite model.',
+                   type = str)
+    p.add_argument('--calib_samples',
+                   help = 'Number of validation images used for calibration.',
+                   default = 100,
+                   type = int)
+    p.add_argument('--no_quantize',
+                   help = 'Export float32 TFLite model without quantization.',
+                   default = False,
+                   action = 'store_true')
+
+    return p
+
+
+def preprocess_imgs(imgs, mean, std):
+    """Band select, resize, and scale prepped images like train.preprocess"""
+    imgs = imgs[:, :, :, BAND_SELECTION]
+    imgs_p = np.ndarray((imgs.shape[0], RESIZE_ROWS, RESIZE_COLS,
+                         len(BAND_SELECTION)), dtype=np.float32)
+    for i in range(imgs.shape[0]):
+        imgs_p[i] = transform.resize(imgs[i],
+                                     (RESIZE_ROWS, RESIZE_COLS,
+                                      len(BAND_SELECTION)),
+                                     preserve_range=True)
+    imgs_p -= mean
+    imgs_p /= std
+
+    return imgs_p
+
+
+def representative_dataset(imgs_val, mean, std, num_samples):
+    """Generator yielding single calibration images for the converter"""
+    num_samples = min(num_samples, imgs_val.shape[0])
+    for i in range(num_samples):
+        yield [preprocess_imgs(imgs_val[i:i+1], mean, std)]
+
+
+def convert_model(keras_model, imgs_val, mean, std, num_samples, quantize):
+    """Convert keras model to TFLite flatbuffer"""
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: representative_dataset(
+            imgs_val, mean, std, num_samples)
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    return converter.convert()
+
+
+def compare_masks(float_backend, lite_backend, imgs_test, mean, std):
+    """Compare thresholded masks of two backends on the test images
+
+    Returns:
+        Dictionary with pixel agreement, mask IoU and positive pixel counts.
+
+    """
+    agree = 0
+    total = 0
+    intersection = 0
+    union = 0
+    float_pos = 0
+    lite_pos = 0
+    for start in range(0, imgs_test.shape[0], EVAL_BATCH_SIZE):
+        imgs = preprocess_imgs(imgs_test[start:start + EVAL_BATCH_SIZE],
+                               mean, std)
+        float_mask = float_backend.predict(imgs, EVAL_BATCH_SIZE) > PRED_THRESHOLD
+        lite_mask = lite_backend.predict(imgs, EVAL_BATCH_SIZE) > PRED_THRESHOLD
+
+        agree += np.sum(float_mask == lite_mask)
+        total += float_mask.size
+        intersection += np.sum(float_mask & lite_mask)
+        union += np.sum(float_mask | lite_mask)
+        float_pos += np.sum(float_mask)
+        lite_pos += np.sum(lite_mask)
+
+    return {'pixel_agreement': float(agree / total),
+            'mask_iou': float(intersection / union) if union > 0 else 1.0,
+            'float_pos_pixels': int(float_pos),
+            'lite_pos_pixels': int(lite_pos)}
+
+
+def main():
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    mean_std_array = np.load(args.mean_std)
+    mean = mean_std_array[0, :]
+    std = mean_std_array[1, :]
+
+    float_backend = inference_backend.KerasBackend(args.model_structure,
+                                                   args.model_weights)
+
+    print('-'*30)
+    print('Converting model...')
+    print('-'*30)
+    imgs_val = np.load(os.path.join(args.prepped_dir, 'imgs_val.npy'),
+                       mmap_mode='r')
+    tflite_model = convert_model(float_backend.model, imgs_val, mean, std,
+                                 args.calib_samples, not args.no_quantize)
+    with open(args.out_path, 'wb') as f:
+        f.write(tflite_model)
+    np.save('{}_mean_std.npy'.format(os.path.splitext(args.out_path)[0]),
+            mean_std_array)
+    with open('{}_nd_scaling.txt'.format(os.path.splitext(args.out_path)[0]),
+              'w') as f:
+        f.write('{}\n'.format(
+            inference_backend.find_nd_scaling(args.model_weights)))
+    print('Wrote {} ({:.1f} MB)'.format(args.out_path,
+                                        len(tflite_model) / 1e6))
+
+    print('-'*30)
+    print('Comparing with float model on test data...')
+    print('-'*30)
+    lite_backend = inference_backend.TFLiteBackend(args.out_path)
+    imgs_test = np.load(os.path.join(args.prepped_dir, 'imgs_test.npy'),
+                        mmap_mode='r')
+    report = compare_masks(float_backend, lite_backend, imgs_test, mean, std)
+    print('Mask agreement: {}'.format(report))
+
+    report_path = '{}_report.json'.format(os.path.splitext(args.out_path)[0])
+    with open(report_path, 'w') as fp:
+        json.dump(report, fp, sort_keys=True, indent=4)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
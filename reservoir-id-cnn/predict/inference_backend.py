@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Inference backends for reservoir CNN prediction
+
+Each backend wraps a trained U-Net behind the same predict(imgs, batch_size)
+call that ResPredictBatch uses, so predict_map can switch from eager Keras to
+an optimized CPU runtime without touching the tiling code.
+
+Example:
+    >>> backend = load_backend('tflite', None, 'unet_int8.tflite')
+    >>> preds = backend.predict(imgs, 32)
+
+"""
+
+
+import os
+import numpy as np
+
+BACKENDS = ['keras', 'tflite']
+# Names accepted by load_backend
+
+
+class KerasBackend(object):
+    """Keras model rebuilt from json structure and hdf5 weights
+
+    Attributes:
+        model (keras model): CNN model with loaded weights.
+
+    """
+    def __init__(self, model_structure, model_weights):
+        from keras import models
+
+        with open(model_structure, 'r') as struct_file:
+            structure_json = struct_file.read()
+        self.model = models.model_from_json(structure_json)
+        self.model.load_weights(model_weights)
+
+    def predict(self, imgs, batch_size=32):
+        return self.model.predict(imgs, batch_size)
+
+
+class TFLiteBackend(object):
+    """TensorFlow Lite interpreter, optionally int8 quantized
+
+    Inputs and outputs are always float32 to the caller. If the converted
+    model uses integer input/output tensors the (de)quantization is done here
+    with the scale and zero point stored in the model.
+
+    Attributes:
+        interpreter (tf.lite.Interpreter): Interpreter for the artifact.
+        num_threads (int): Number of CPU threads used by the interpreter.
+
+    """
+    def __init__(self, model_path, num_threads=None):
+        import tensorflow as tf
+
+        self.num_threads = num_threads
+        self.interpreter = tf.lite.Interpreter(model_path=model_path,
+                                               num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+        self.batch_size = 1
+
+    def resize_batch(self, batch_size):
+        """Resize the interpreter input to hold batch_size images."""
+        if batch_size == self.batch_size:
+            return
+        shape = list(self.input_detail['shape'])
+        shape[0] = batch_size
+        self.interpreter.resize_tensor_input(self.input_detail['index'], shape)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+        self.batch_size = batch_size
+
+    def quantize_input(self, imgs):
+        dtype = self.input_detail['dtype']
+        if dtype == np.float32:
+            return imgs.astype(np.float32)
+        scale, zero_point = self.input_detail['quantization']
+        info = np.iinfo(dtype)
+        q_imgs = np.round(imgs / scale + zero_point)
+        return np.clip(q_imgs, info.min, info.max).astype(dtype)
+
+    def dequantize_output(self, preds):
+        if self.output_detail['dtype'] == np.float32:
+            return preds
+        scale, zero_point = self.output_detail['quantization']
+        return (preds.astype(np.float32) - zero_point) * scale
+
+    def predict(self, imgs, batch_size=32):
+        preds = []
+        for start in range(0, imgs.shape[0], batch_size):
+            batch = imgs[start:start + batch_size]
+            self.resize_batch(batch.shape[0])
+            self.interpreter.set_tensor(self.input_detail['index'],
+                                        self.quantize_input(batch))
+            self.interpreter.invoke()
+            preds += [self.dequantize_output(self.interpreter.get_tensor(
+                self.output_detail['index']))]
+
+        return np.concatenate(preds, axis=0)
+
+
+def find_mean_std(model_path):
+    """Band statistics file bundled with a model, or None
+
+    Looks for <model>_mean_std.npy, as written by export_model.py, then
+    mean_std.npy in the model's directory, as written by train.train.
+
+    """
+    candidates = ['{}_mean_std.npy'.format(os.path.splitext(model_path)[0]),
+                  os.path.join(os.path.dirname(model_path), 'mean_std.npy')]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+
+    return None
+
+
+def find_nd_scaling(model_path):
+    """Normalized difference band scaling a model was trained with
+
+    Read from <model>_nd_scaling.txt, as written by export_model.py, or
+    nd_scaling.txt in the model's directory, as written by train.train.
+    Models without either were trained with 'minmax' scaling.
+
+    """
+    candidates = ['{}_nd_scaling.txt'.format(os.path.splitext(model_path)[0]),
+                  os.path.join(os.path.dirname(model_path), 'nd_scaling.txt')]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            with open(candidate) as f:
+                return f.read().strip()
+
+    return 'minmax'
+
+
+def load_backend(backend, model_structure, model_weights, num_threads=None):
+    """Create an inference backend by name.
+
+    The backend's mean_std_file attribute is set to the band statistics
+    bundled with the model (see find_mean_std), or None, and its nd_scaling
+    attribute to the model's normalized difference scaling (see
+    find_nd_scaling).
+
+    Args:
+        backend (str): One of BACKENDS.
+        model_structure (str): Model structure json. Only used by keras.
+        model_weights (str): hdf5 weights for keras, or .tflite artifact.
+        num_threads (int): CPU threads for the tflite interpreter.
+
+    """
+    if backend == 'keras':
+        model = KerasBackend(model_structure, model_weights)
+    elif backend == 'tflite':
+        model = TFLiteBackend(model_weights, num_threads=num_threads)
+    else:
+        raise ValueError('Unknown backend {}, expected one of {}'.format(
+            backend, BACKENDS))
+    model.mean_std_file = find_mean_std(model_weights)
+    model.nd_scaling = find_nd_scaling(model_weights)
+
+    return model
@@ -18,7 +18,7 @@ import numpy as np
 from skimage import io, transform
 import rasterio
 import affine
-from keras import models
+import inference_backend
 import tempfile
 import subprocess as sp
 import glob
@@ -43,6 +43,10 @@ BATCH_SIZE =500
 
 BAND_SELECTION = [0, 1, 2, 3, 4, 5, 12, 13, 14, 15]
 
+MEAN_STD_FILE = './model_data/v2/mean_std.npy'
+# Training band means and stds used to scale images, if the model has none
+# bundled with it (see inference_backend.find_mean_std)
+
 def argparse_init():
     """Prepare ArgumentParser for inputs"""
 
@@ -56,7 +60,8 @@ def argparse_init():
                    help = 'Text file containing model structure saved as json.',
                    type = str)
     p.add_argument('model_weights',
-                   help = 'hdf5 file containing saved model weights.',
+                   help = ('hdf5 file containing saved model weights, or the '
+                           '.tflite artifact when --backend=tflite.'),
                    type = str)
     p.add_argument('out_dir',
                    help = 'Output directory for predicted subsets',
@@ -65,6 +70,15 @@ def argparse_init():
                    help = ('Path to mosaiced output file. If not defined, will not create.'),
                    default = None,
                    type = str)
+    p.add_argument('--backend',
+                   help = 'Inference backend used for prediction.',
+                   choices = inference_backend.BACKENDS,
+                   default = 'keras',
+                   type = str)
+    p.add_argument('--num_threads',
+                   help = 'CPU threads for the tflite backend.',
+                   default = None,
+                   type = int)
 
     return p
 
@@ -102,11 +116,14 @@ class ResPredictBatch(object):
         nbands (int): Number of bands in image
         resize_dims (tuple): Dimensions for resizing before CNN prediction.
         out_dir (str): Path to output directory.
-        model (keras model): CNN model with loaded weights.
+        model (inference backend): Model exposing predict(imgs, batch_size).
+        nd_scaling (str): Scaling of normalized difference bands the model
+            was trained with, 'minmax' (per batch) or 'fixed' ([-1, 1]).
 
     """
     def __init__(self, img_srcs, start_indices, batch_size, batch_start_point, dims,
-                 nbands, resize_dims, model, mean_std_file, out_dir='./predict/'):
+                 nbands, resize_dims, model, mean_std_file, out_dir='./predict/',
+                 nd_scaling='minmax'):
         self.img_srcs = img_srcs
         self.start_indices = start_indices
         self.batch_size = batch_size
@@ -117,6 +134,7 @@ class ResPredictBatch(object):
         self.out_dir = out_dir
         self.mean_std_file = mean_std_file
         self.model = model
+        self.nd_scaling = nd_scaling
 
     @property
     def crs(self):
@@ -189,10 +207,14 @@ class ResPredictBatch(object):
 
         nd = normalized_diff(self.imgs[:,:,:,band1], self.imgs[:,:,:,band2])
 
-        # Convert to uint16
-        nd_min = nd.min()
-        nd_max = nd.max()
-        nd = 65535 * (nd - nd_min) / (nd_max - nd_min)
+        # Convert to uint16, as the model's training data
+        if self.nd_scaling == 'fixed':
+            nd = np.nan_to_num(np.clip(nd, -1, 1))
+            nd = 65535 * (nd + 1) / 2
+        else:
+            nd_min = nd.min()
+            nd_max = nd.max()
+            nd = 65535 * (nd - nd_min) / (nd_max - nd_min)
         nd = nd.astype(np.uint16)
 
         # Reshape
@@ -295,19 +317,22 @@ def get_done_list(out_dir):
     return done_indices
 
 
-def prep_batches(source_path, model_structure, model_weights, done_ind):
-    # Load model
-    with open(model_structure, 'r') as struct_file:
-        structure_json = struct_file.read()
-    unet_model = models.model_from_json(structure_json)
-    unet_model.load_weights(model_weights)
+def open_sources(source_path):
+    """Open the s2 10m image and its matching s1 10m and s2 20m images."""
+    s1_10m_path = source_path.replace('s2_10m', 's1_10m')
+    s2_20m_path = source_path.replace('s2_10m', 's2_20m')
+    src_list = [
+        rasterio.open(source_path),
+        rasterio.open(s1_10m_path),
+        rasterio.open(s2_20m_path)]
+
+    return src_list
+
 
-    # Open primary image
-    src = rasterio.open(source_path)
+def get_start_indices(src, done_ind):
+    """Nx2 array of tile row/col starts for src, minus done_ind."""
     total_rows, total_cols = src.height, src.width
 
-    current_row = 0
-    current_col = 0
     row_starts = np.arange(0, total_rows - OG_ROWS, OG_ROWS - OVERLAP)
     col_starts = np.arange(0, total_cols - OG_COLS, OG_COLS - OVERLAP)
 
@@ -325,15 +350,25 @@ def prep_batches(source_path, model_structure, model_weights, done_ind):
         ))
         start_ind = start_ind[todo_list]
 
-    # Open other images and create a list of srcs
-    s1_10m_path = source_path.replace('s2_10m', 's1_10m')
-    s2_20m_path = source_path.replace('s2_10m', 's2_20m')
-    src_list = [
-        src,
-        rasterio.open(s1_10m_path),
-        rasterio.open(s2_20m_path)]
+    return start_ind
 
-    return start_ind, unet_model, src_list
+
+def prep_batches(source_path, model_structure, model_weights, done_ind,
+                 backend='keras', num_threads=None, unet_model=None,
+                 img_srcs=None):
+    """Load model and sources unless already given, and list tiles to do."""
+    # Load model
+    if unet_model is None:
+        unet_model = inference_backend.load_backend(
+            backend, model_structure, model_weights, num_threads=num_threads)
+
+    # Open primary image and create a list of srcs
+    if img_srcs is None:
+        img_srcs = open_sources(source_path)
+
+    start_ind = get_start_indices(img_srcs[0], done_ind)
+
+    return start_ind, unet_model, img_srcs
 
 
 # def predict_batches(start_ind_batches, unet_model, img_srcs, out_dir):
@@ -351,17 +386,28 @@ def prep_batches(source_path, model_structure, model_weights, done_ind):
 #     return
 
 
-def predict_fullmap(source_path, model_structure, model_weights, out_dir):
+def model_mean_std(unet_model):
+    """Band statistics file for a model, bundled or MEAN_STD_FILE"""
+    mean_std_file = getattr(unet_model, 'mean_std_file', None)
+    if mean_std_file is None:
+        print('No band statistics bundled with model, using {}'.format(
+            MEAN_STD_FILE))
+        mean_std_file = MEAN_STD_FILE
 
-    # Create output dir
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    return mean_std_file
 
-    done_indices = get_done_list(out_dir)
 
-    start_ind, unet_model, img_srcs = prep_batches(
-        source_path, model_structure, model_weights, done_indices)
+def predict_indices(start_ind, unet_model, img_srcs, out_dir,
+                    mean_std_file=None):
+    """Predict and write tiles starting at each row/col pair in start_ind.
+
+    Images are scaled with mean_std_file, by default the statistics bundled
+    with the model, and normalized difference bands as the model's
+    nd_scaling (see inference_backend.find_nd_scaling).
 
+    """
+    if mean_std_file is None:
+        mean_std_file = model_mean_std(unet_model)
     batch_start_point = 0
     while batch_start_point < start_ind.shape[0]:
         res_batch = ResPredictBatch(
@@ -369,13 +415,40 @@ def predict_fullmap(source_path, model_structure, model_weights, out_dir):
             batch_size=BATCH_SIZE, batch_start_point=batch_start_point,
             dims=(OG_ROWS, OG_COLS), nbands=NBANDS,
             resize_dims=(RESIZE_ROWS, RESIZE_COLS), out_dir=out_dir,
-            model=unet_model, mean_std_file='./model_data/v2/mean_std.npy')
+            model=unet_model, mean_std_file=mean_std_file,
+            nd_scaling=getattr(unet_model, 'nd_scaling', 'minmax'))
         batch_start_point = res_batch.predict_write_batch() + 1
         print('Dpne with batch, starting new from {}'.format(batch_start_point))
 
     return
 
 
+def predict_fullmap(source_path, model_structure, model_weights, out_dir,
+                    backend='keras', num_threads=None, unet_model=None,
+                    img_srcs=None):
+    """Predict all tiles of a scene not already in out_dir.
+
+    A preloaded unet_model and opened img_srcs can be passed in to avoid
+    reloading them for every scene (see predict_server.py).
+
+    """
+
+    # Create output dir
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    done_indices = get_done_list(out_dir)
+
+    start_ind, unet_model, img_srcs = prep_batches(
+        source_path, model_structure, model_weights, done_indices,
+        backend=backend, num_threads=num_threads, unet_model=unet_model,
+        img_srcs=img_srcs)
+
+    predict_indices(start_ind, unet_model, img_srcs, out_dir)
+
+    return
+
+
 def mosaic_predictions(tile_list, mosaiced_tif):
     """Mosaic output tiles into full raster."""
 
@@ -401,7 +474,8 @@ def main():
     args = parser.parse_args()
 
     predict_fullmap(args.source_path, args.model_structure, args.model_weights,
-                    args.out_dir)
+                    args.out_dir, backend=args.backend,
+                    num_threads=args.num_threads)
 
     if args.mosaic is not None:
         tile_list = glob.glob('{}/*.tif'.format(args.out_dir))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Long-lived local prediction worker
+
+Loads the model once and keeps it warm, then runs scene or tile jobs
+submitted over a small local HTTP API. Jobs are run one at a time in
+submission order by a single worker thread; recently used sources are kept
+open between jobs. The status of the last --max_finished_jobs finished jobs
+is kept, older ones return 404.
+
+API:
+    POST /jobs        Submit a job (json), returns {"id": ...}
+    GET  /jobs/<id>   Job status: queued, running, done or failed
+    GET  /health      Model and queue info
+
+Jobs:
+    {"type": "scene", "source_path": "s2_10m.tif", "out_dir": "./out/x/"}
+    {"type": "tiles", "source_path": "s2_10m.tif", "out_dir": "./out/x/",
+     "indices": [[0, 0], [300, 0]]}
+
+Example:
+    $ python3 predict_server.py structure.txt weights.h5 --port=8470
+    $ python3 predict_wrapper.py --server=http://127.0.0.1:8470
+
+"""
+
+
+import os
+import argparse
+import json
+import time
+import uuid
+import queue
+import threading
+import collections
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import inference_backend
+import predict_map
+
+MAX_OPEN_SOURCES = 4
+# Number of scenes whose rasterio sources are kept open
+
+POLL_INTERVAL = 5
+# Seconds between job status checks in wait_job
+
+MAX_FINISHED_JOBS = 1000
+# Number of done or failed jobs whose status is kept, oldest dropped first
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs"""
+
+    p = argparse.ArgumentParser(
+            description='Run a warm local reservoir prediction worker.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('model_structure',
+                   help = 'Text file containing model structure saved as json.',
+                   type = str)
+    p.add_argument('model_weights',
+                   help = ('hdf5 file containing saved model weights, or the '
+                           '.tflite artifact when --backend=tflite.'),
+                   type = str)
+    p.add_argument('--backend',
+                   help = 'Inference backend used for prediction.',
+                   choices = inference_backend.BACKENDS,
+                   default = 'keras',
+                   type = str)
+    p.add_argument('--num_threads',
+                   help = 'CPU threads for the tflite backend.',
+                   default = None,
+                   type = int)
+    p.add_argument('--host',
+                   help = 'Address to listen on.',
+                   default = '127.0.0.1',
+                   type = str)
+    p.add_argument('--port',
+                   help = 'Port to listen on.',
+                   default = 8470,
+                   type = int)
+    p.add_argument('--max_finished_jobs',
+                   help = 'Number of finished job statuses to keep.',
+                   default = MAX_FINISHED_JOBS,
+                   type = int)
+
+    return p
+
+
+class PredictServer(object):
+    """Warm model plus a FIFO job queue served by one worker thread
+
+    Attributes:
+        unet_model (inference backend): Loaded model, kept for all jobs.
+        jobs (dict): Job id to status dictionary.
+        finished (deque): Ids of done or failed jobs, oldest first. Only the
+            latest max_finished are kept in jobs.
+        sources (OrderedDict): source_path to open rasterio sources, LRU.
+
+    """
+    def __init__(self, unet_model, max_finished=MAX_FINISHED_JOBS):
+        self.unet_model = unet_model
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.max_finished = max_finished
+        self.sources = collections.OrderedDict()
+        self.job_queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run_jobs, daemon=True)
+        self.worker.start()
+
+    def submit(self, job):
+        if not isinstance(job, dict):
+            raise ValueError('Job must be a JSON object')
+        if job.get('type') not in ('scene', 'tiles'):
+            raise ValueError('Job type must be scene or tiles')
+        for key in ('source_path', 'out_dir'):
+            if key not in job:
+                raise ValueError('Job missing {}'.format(key))
+        if job['type'] == 'tiles' and 'indices' not in job:
+            raise ValueError('Tiles job missing indices')
+
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {'id': job_id, 'status': 'queued',
+                                 'job': job, 'submitted': time.time()}
+        self.job_queue.put(job_id)
+
+        return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            return dict(self.jobs[job_id])
+
+    def get_sources(self, source_path):
+        """Return open sources for source_path, closing least recently used."""
+        if source_path in self.sources:
+            self.sources.move_to_end(source_path)
+            return self.sources[source_path]
+
+        self.sources[source_path] = predict_map.open_sources(source_path)
+        while len(self.sources) > MAX_OPEN_SOURCES:
+            _, old_srcs = self.sources.popitem(last=False)
+            for src in old_srcs:
+                src.close()
+
+        return self.sources[source_path]
+
+    def run_job(self, job):
+        # predict_indices writes straight into out_dir
+        os.makedirs(job['out_dir'], exist_ok=True)
+        img_srcs = self.get_sources(job['source_path'])
+        if job['type'] == 'scene':
+            predict_map.predict_fullmap(
+                job['source_path'], None, None, job['out_dir'],
+                unet_model=self.unet_model, img_srcs=img_srcs)
+        else:
+            start_ind = np.asarray(job['indices'], dtype=int).reshape(-1, 2)
+            predict_map.predict_indices(start_ind, self.unet_model, img_srcs,
+                                        job['out_dir'])
+
+    def run_jobs(self):
+        while True:
+            job_id = self.job_queue.get()
+            with self.lock:
+                self.jobs[job_id]['status'] = 'running'
+                self.jobs[job_id]['started'] = time.time()
+                job = self.jobs[job_id]['job']
+            try:
+                self.run_job(job)
+                status, error = 'done', None
+            except Exception as e:
+                status, error = 'failed', repr(e)
+                print('Job {} failed: {}'.format(job_id, error))
+            with self.lock:
+                self.jobs[job_id]['status'] = status
+                self.jobs[job_id]['error'] = error
+                self.jobs[job_id]['finished'] = time.time()
+                self.finished.append(job_id)
+                while len(self.finished) > self.max_finished:
+                    del self.jobs[self.finished.popleft()]
+
+
+def make_handler(server):
+    """Build a request handler class bound to a PredictServer."""
+
+    class PredictHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok',
+                                     'queued': server.job_queue.qsize(),
+                                     'open_sources': list(server.sources)})
+            elif self.path.startswith('/jobs/'):
+                job_id = self.path[len('/jobs/'):]
+                try:
+                    self.send_json(200, server.status(job_id))
+                except KeyError:
+                    self.send_json(404, {'error': 'Unknown job'})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self.send_json(404, {'error': 'Not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job = json.loads(self.rfile.read(length).decode('utf-8'))
+                job_id = server.submit(job)
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.send_json(202, {'id': job_id})
+
+    return PredictHandler
+
+
+def submit_job(server_url, job):
+    """Submit a job dictionary to a running server, returning its id."""
+    req = urllib.request.Request(
+        '{}/jobs'.format(server_url.rstrip('/')),
+        data=json.dumps(job).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read().decode('utf-8'))['id']
+
+
+def get_job(server_url, job_id):
+    """Get the status dictionary of a submitted job."""
+    url = '{}/jobs/{}'.format(server_url.rstrip('/'), job_id)
+    with urllib.request.urlopen(url) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def wait_job(server_url, job_id, poll_interval=POLL_INTERVAL):
+    """Block until a job is done or failed and return its status."""
+    while True:
+        job_status = get_job(server_url, job_id)
+        if job_status['status'] in ('done', 'failed'):
+            return job_status
+        time.sleep(poll_interval)
+
+
+def main():
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    unet_model = inference_backend.load_backend(
+        args.backend, args.model_structure, args.model_weights,
+        num_threads=args.num_threads)
+    server = PredictServer(unet_model, max_finished=args.max_finished_jobs)
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print('Serving predictions on http://{}:{}'.format(args.host, args.port))
+    httpd.serve_forever()
+
+    return
+
+
+if __name__ == '__main__':
+    main()
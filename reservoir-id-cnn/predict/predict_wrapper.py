@@ -4,15 +4,54 @@
 
 Example:
     $ python3 predict_wrapper.py
+    $ python3 predict_wrapper.py --server=http://127.0.0.1:8470
+    $ python3 predict_wrapper.py --queue=/mnt/shared/scenes.db
+
+Notes:
+    With --server, scenes are submitted to a running predict_server.py
+    instead of loading the model in this process.
+    With --queue, any number of wrappers on any number of nodes can share one
+    SQLite queue file. Each leases scenes so no two work on the same one, and
+    scenes from a dead node are retried after their lease expires.
 
 """
 
+import argparse
 import subprocess as sp
 import predict_map
+import predict_server
+import scene_queue as sq
+import time
 from google.cloud import storage
 import os
 
 
+def argparse_init():
+    """Prepare ArgumentParser for inputs"""
+
+    p = argparse.ArgumentParser(
+            description='Predict reservoirs on all rasters in the bucket.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--server',
+                   help = 'URL of a running predict_server.py to submit to.',
+                   default = None,
+                   type = str)
+    p.add_argument('--queue',
+                   help = 'SQLite scene queue file shared between workers.',
+                   default = None,
+                   type = str)
+    p.add_argument('--worker_id',
+                   help = 'Worker name recorded on leases. Default host:pid.',
+                   default = None,
+                   type = str)
+    p.add_argument('--lease_seconds',
+                   help = 'Lease length, extended by heartbeats.',
+                   default = sq.LEASE_SECONDS,
+                   type = float)
+
+    return p
+
+
 def download_rast(gcs_rast):
 
     local_rast_path = './stage/{}'.format(os.path.basename(gcs_rast.name))
@@ -21,26 +60,105 @@ def download_rast(gcs_rast):
     return(local_rast_path)
 
 
-def predict_wrapper():
+def predict_scene(local_rast, out_dir, server=None):
+    """Predict one local raster, in process or on a prediction server."""
+    if server is None:
+        predict_map.predict_fullmap(local_rast, '../train/unet_structure.txt',
+                                    '../train/weights.h5', out_dir)
+    else:
+        job_id = predict_server.submit_job(server, {
+            'type': 'scene',
+            'source_path': os.path.abspath(local_rast),
+            'out_dir': os.path.abspath(out_dir)})
+        job_status = predict_server.wait_job(server, job_id)
+        if job_status['status'] == 'failed':
+            raise RuntimeError('Prediction failed for {}: {}'.format(
+                local_rast, job_status['error']))
+
+    return
+
 
+def get_bucket():
     storage_client = storage.Client()
     gs_bucket = storage_client.get_bucket('res-id')
+
+    return gs_bucket
+
+
+def predict_wrapper(server=None):
+
+    gs_bucket = get_bucket()
     gcs_list = gs_bucket.list_blobs(prefix='ee_exports/sentinel/')
 
     for gcs_rast in gcs_list:
         local_rast = download_rast(gcs_rast)
         tile_out_dir = os.path.splitext(os.path.basename(local_rast))[0]
 
-        predict_map.predict_fullmap(local_rast, '../train/unet_structure.txt',
-                                    '../train/weights.h5',
-                                    './out/{}'.format(tile_out_dir))
+        predict_scene(local_rast, './out/{}'.format(tile_out_dir), server)
         os.remove(local_rast)
 
     return
 
 
+def predict_wrapper_queue(queue_path, server=None, worker_id=None,
+                          lease_seconds=sq.LEASE_SECONDS):
+    """Pull scenes from a shared lease queue until none are left."""
+
+    worker_id = worker_id or sq.default_worker_id()
+    scene_queue = sq.SceneQueue(queue_path, lease_seconds=lease_seconds)
+
+    gs_bucket = get_bucket()
+    gcs_names = [b.name for b in
+                 gs_bucket.list_blobs(prefix='ee_exports/sentinel/')]
+    print('Added {} new scenes to queue'.format(scene_queue.add(gcs_names)))
+
+    while True:
+        scene_name = scene_queue.acquire(worker_id)
+        if scene_name is None:
+            # Other workers may still die and release their leases
+            if scene_queue.counts().get('leased', 0) == 0:
+                break
+            time.sleep(lease_seconds / 2)
+            continue
+
+        print('{} leased {}'.format(worker_id, scene_name))
+        local_rast = None
+        try:
+            with sq.LeaseHeartbeat(scene_queue, scene_name,
+                                   worker_id) as heartbeat:
+                local_rast = download_rast(gs_bucket.blob(scene_name))
+                tile_out_dir = os.path.splitext(os.path.basename(local_rast))[0]
+                # Another worker owns the scene now, don't predict it twice
+                if not heartbeat.lost:
+                    predict_scene(local_rast, './out/{}'.format(tile_out_dir),
+                                  server)
+            if heartbeat.lost:
+                print('{} lost lease on {}, leaving it to its new '
+                      'owner'.format(worker_id, scene_name))
+            else:
+                scene_queue.complete(scene_name, worker_id)
+        except Exception as e:
+            print('Failed {}: {!r}'.format(scene_name, e))
+            scene_queue.fail(scene_name, worker_id, repr(e))
+        finally:
+            if local_rast is not None and os.path.exists(local_rast):
+                os.remove(local_rast)
+
+    print('Queue finished: {}'.format(scene_queue.counts()))
+
+    return
+
+
 def main():
-    predict_wrapper()
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    if args.queue is None:
+        predict_wrapper(args.server)
+    else:
+        predict_wrapper_queue(args.queue, args.server, args.worker_id,
+                              args.lease_seconds)
 
 if __name__ == '__main__':
     main()
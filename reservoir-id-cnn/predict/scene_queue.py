@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lease-based work queue of scenes, backed by SQLite
+
+Several predict_wrapper processes, on one or many nodes, can share a queue
+file. A worker leases one scene at a time and must heartbeat to keep it.
+If a worker dies its lease expires and the scene is handed to another
+worker, up to max_attempts times. Finished scenes are recorded with their
+completion time and owner.
+
+Example:
+    Print queue summary:
+    $ python3 scene_queue.py scenes.db
+
+Notes:
+    SQLite relies on file locking, so on a shared filesystem it must be one
+    with working POSIX locks (e.g. NFSv4), not a FUSE bucket mount.
+
+"""
+
+
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from contextlib import closing
+
+LEASE_SECONDS = 600
+# Default lease length. Heartbeats extend the lease by this much.
+
+MAX_ATTEMPTS = 3
+# Times a scene is leased before it is marked failed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    created REAL,
+    completed REAL
+)
+"""
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs"""
+
+    p = argparse.ArgumentParser(
+            description='Show status of a scene work queue.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('queue_path',
+                   help = 'Path to SQLite queue file.',
+                   type = str)
+    p.add_argument('--failed',
+                   help = 'List failed scenes and their last error.',
+                   default = False,
+                   action = 'store_true')
+
+    return p
+
+
+def default_worker_id():
+    """Worker id unique to this host and process."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class SceneQueue(object):
+    """Scene work queue stored in a SQLite file
+
+    A new connection is opened for every operation so one SceneQueue can be
+    used from the main thread and a heartbeat thread at the same time.
+
+    Attributes:
+        path (str): Path to SQLite file.
+        lease_seconds (float): Lease length granted by acquire and heartbeat.
+        max_attempts (int): Leases per scene before it is marked failed.
+
+    """
+    def __init__(self, path, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with closing(self.connect()) as conn:
+            conn.execute(SCHEMA)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return conn
+
+    def add(self, names):
+        """Add scenes to the queue, ignoring ones already present."""
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cur = conn.executemany(
+                'INSERT OR IGNORE INTO scenes (name, created) VALUES (?, ?)',
+                [(name, now) for name in names])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        return cur.rowcount
+
+    def acquire(self, owner):
+        """Lease the next available scene to owner.
+
+        Returns:
+            Scene name, or None if nothing is available right now.
+
+        """
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Expired leases that used their last attempt are failures
+            conn.execute(
+                "UPDATE scenes SET status = 'failed', lease_owner = NULL, "
+                "last_error = COALESCE(last_error, 'lease expired') "
+                "WHERE status = 'leased' AND lease_expires < ? "
+                "AND attempts >= ?", (now, self.max_attempts))
+            row = conn.execute(
+                "SELECT name FROM scenes WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY name LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE scenes SET status = 'leased', lease_owner = ?, "
+                    "lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE name = ?", (owner, now + self.lease_seconds, row[0]))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        return None if row is None else row[0]
+
+    def heartbeat(self, name, owner):
+        """Extend owner's lease on name. Returns False if the lease was lost."""
+        with closing(self.connect()) as conn:
+            cur = conn.execute(
+                "UPDATE scenes SET lease_expires = ? WHERE name = ? "
+                "AND lease_owner = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, name, owner))
+
+        return cur.rowcount == 1
+
+    def complete(self, name, owner):
+        """Record name as done by owner."""
+        with closing(self.connect()) as conn:
+            cur = conn.execute(
+                "UPDATE scenes SET status = 'done', completed = ?, "
+                "lease_expires = NULL WHERE name = ? AND lease_owner = ?",
+                (time.time(), name, owner))
+
+        return cur.rowcount == 1
+
+    def fail(self, name, owner, error):
+        """Release name after an error, to be retried if attempts remain."""
+        with closing(self.connect()) as conn:
+            cur = conn.execute(
+                "UPDATE scenes SET status = CASE WHEN attempts >= ? "
+                "THEN 'failed' ELSE 'pending' END, lease_owner = NULL, "
+                "lease_expires = NULL, last_error = ? "
+                "WHERE name = ? AND lease_owner = ? AND status = 'leased'",
+                (self.max_attempts, error, name, owner))
+
+        return cur.rowcount == 1
+
+    def counts(self):
+        """Dictionary of number of scenes per status."""
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                'SELECT status, COUNT(*) FROM scenes GROUP BY status').fetchall()
+
+        return dict(rows)
+
+    def failed(self):
+        """List of (name, attempts, last_error) for failed scenes."""
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT name, attempts, last_error FROM scenes "
+                "WHERE status = 'failed' ORDER BY name").fetchall()
+
+        return rows
+
+
+class LeaseHeartbeat(object):
+    """Context manager heartbeating a lease from a background thread
+
+    Example:
+        >>> with LeaseHeartbeat(scene_queue, name, owner):
+        ...     process(name)
+
+    Attributes:
+        lost (bool): True if a heartbeat found the lease taken by another
+            worker.
+
+    """
+    def __init__(self, scene_queue, name, owner, interval=None):
+        self.scene_queue = scene_queue
+        self.name = name
+        self.owner = owner
+        self.interval = interval or scene_queue.lease_seconds / 3
+        self.lost = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            if not self.scene_queue.heartbeat(self.name, self.owner):
+                print('Lost lease on {}'.format(self.name))
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def main():
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    scene_queue = SceneQueue(args.queue_path)
+    for status, count in sorted(scene_queue.counts().items()):
+        print('{}: {}'.format(status, count))
+    if args.failed:
+        for name, attempts, error in scene_queue.failed():
+            print('{} ({} attempts): {}'.format(name, attempts, error))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Streaming per-band statistics of prepped images
+
+Band means and variances are accumulated in one pass over blocks of pixels
+with Welford's update, combining blocks with Chan et al.'s parallel formula,
+so statistics are numerically stable and never need the whole dataset in
+memory. Statistics of separate chunks or chips can be merged, which lets a
+sharded dataset keep per-chip statistics and recombine them after updates.
+
+Statistics are computed when a dataset is prepped and stored with it, in
+the manifest of a sharded dataset or in band_stats.json next to monolithic
+.npy files, so training does not need its own pass over the images.
+
+Example:
+    >>> stats = BandStats.from_images(imgs_train)
+    >>> mean, std = stats.select([0, 1, 2, 3])
+
+Notes:
+    Statistics are of the stored chips, before resizing for the CNN.
+    Bilinear resizing from 500 to 512 pixels barely changes them, and
+    train and predict both scale by the same stored values.
+
+"""
+
+
+import os
+import json
+import numpy as np
+
+STATS_FILE = 'band_stats.json'
+# Name of statistics file in a monolithic prepped directory
+
+CHUNK_SIZE = 8
+# Number of images per chunk when computing statistics
+
+BLOCK_PIXELS = 2**18
+# Pixels per float32 block folded into the statistics at a time
+
+
+class BandStats(object):
+    """Running count, mean and sum of squared deviations for each band
+
+    Attributes:
+        count (int): Number of pixels seen per band.
+        mean (array): Running mean of each band.
+        m2 (array): Sum of squared deviations from the mean of each band.
+
+    """
+    def __init__(self, nbands, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = (np.zeros(nbands) if mean is None
+                     else np.asarray(mean, dtype=np.float64))
+        self.m2 = (np.zeros(nbands) if m2 is None
+                   else np.asarray(m2, dtype=np.float64))
+
+    def merge(self, other):
+        """Combine with another BandStats, in place."""
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / total)
+        self.m2 = (self.m2 + other.m2 +
+                   np.square(delta) * (self.count * other.count / total))
+        self.count = total
+
+        return
+
+    def update(self, imgs):
+        """Add pixels of images with bands on the last axis, in place.
+
+        Pixels are converted to float32 in blocks of BLOCK_PIXELS, and each
+        block's sums are folded into the float64 statistics, so memory use
+        does not grow with the number of images.
+
+        """
+        pixels = np.asarray(imgs).reshape(-1, self.mean.size)
+        for start in range(0, pixels.shape[0], BLOCK_PIXELS):
+            block = pixels[start:start + BLOCK_PIXELS].astype(np.float32)
+            block_mean = block.sum(axis=0, dtype=np.float64) / block.shape[0]
+            block -= block_mean.astype(np.float32)
+            block_m2 = np.square(block).sum(axis=0, dtype=np.float64)
+            self.merge(BandStats(self.mean.size, block.shape[0], block_mean,
+                                 block_m2))
+
+        return
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def select(self, band_selection):
+        """Float32 (mean, std) of the selected bands"""
+        return (self.mean[band_selection].astype(np.float32),
+                self.std[band_selection].astype(np.float32))
+
+    def to_dict(self):
+        return {'count': int(self.count),
+                'mean': [float(m) for m in self.mean],
+                'm2': [float(m) for m in self.m2]}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(len(d['mean']), d['count'], d['mean'], d['m2'])
+
+    @classmethod
+    def from_images(cls, imgs, chunk_size=CHUNK_SIZE):
+        """Statistics of an N x rows x cols x bands array, chunk by chunk"""
+        stats = cls(imgs.shape[-1])
+        for start in range(0, imgs.shape[0], chunk_size):
+            stats.update(imgs[start:start + chunk_size])
+
+        return stats
+
+
+def write_stats(stats, prepped_dir):
+    """Write band_stats.json to a monolithic prepped directory"""
+    with open(os.path.join(prepped_dir, STATS_FILE), 'w') as fp:
+        json.dump(stats.to_dict(), fp, indent=4)
+
+    return
+
+
+def read_stats(prepped_dir):
+    """BandStats from band_stats.json in a prepped directory, or None"""
+    stats_path = os.path.join(prepped_dir, STATS_FILE)
+    if not os.path.isfile(stats_path):
+        return None
+    with open(stats_path) as fp:
+        return BandStats.from_dict(json.load(fp))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Batched, seeded augmentation of img-mask batches
+
+Vectorized counterpart of augment_data.random_aug for use inside the
+training loader. Each image gets a random flip, crop-resize and rotation,
+so every epoch sees fresh augmentations without storing extra copies.
+Rotations are multiples of 90 degrees and done exactly with rot90.
+
+"""
+
+
+import numpy as np
+
+RESIZE_RANGE = (0.7, 1.0)
+# Range of crop size, as a fraction of image size
+
+
+def crop_resize(ar, crop_rows, crop_cols, crop_sizes):
+    """Bilinear crop-resize of each square image back to its original size
+
+    Args:
+        ar (array): N x size x size x bands array.
+        crop_rows (array): Upper row of each crop.
+        crop_cols (array): Left column of each crop.
+        crop_sizes (array): Side length of each crop.
+
+    """
+    n, size = ar.shape[0], ar.shape[1]
+    # Source coordinates of output pixel centers, as in skimage resize
+    out_pos = np.arange(size) + 0.5
+    scale = (crop_sizes / size)[:, None]
+    rows = np.clip(crop_rows[:, None] + out_pos * scale - 0.5,
+                   crop_rows[:, None], (crop_rows + crop_sizes - 1)[:, None])
+    cols = np.clip(crop_cols[:, None] + out_pos * scale - 0.5,
+                   crop_cols[:, None], (crop_cols + crop_sizes - 1)[:, None])
+
+    row0 = np.floor(rows).astype(int)
+    col0 = np.floor(cols).astype(int)
+    row1 = np.minimum(row0 + 1, size - 1)
+    col1 = np.minimum(col0 + 1, size - 1)
+    row_w = (rows - row0)[:, :, None, None]
+    col_w = (cols - col0)[:, None, :, None]
+
+    b = np.arange(n)[:, None, None]
+    top = (ar[b, row0[:, :, None], col0[:, None, :]] * (1 - col_w) +
+           ar[b, row0[:, :, None], col1[:, None, :]] * col_w)
+    bottom = (ar[b, row1[:, :, None], col0[:, None, :]] * (1 - col_w) +
+              ar[b, row1[:, :, None], col1[:, None, :]] * col_w)
+
+    return (top * (1 - row_w) + bottom * row_w).astype(ar.dtype)
+
+
+class BatchAugmenter(object):
+    """Random flips, crop-resize and 90 degree rotations for whole batches
+
+    Random draws come from a generator seeded with (seed, epoch, batch), so
+    results do not depend on which worker thread prepares a batch.
+
+    Attributes:
+        seed (int): Base seed for all random draws.
+        resize_range (tuple): Range of crop size as fraction of image size.
+
+    """
+    def __init__(self, seed=None, resize_range=RESIZE_RANGE):
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.seed = seed
+        self.resize_range = resize_range
+
+    def augment(self, imgs, masks, epoch=0, batch=0):
+        """Augment square N x size x size x bands imgs and matching masks."""
+        rng = np.random.RandomState([self.seed, epoch, batch])
+        n, size = imgs.shape[0], imgs.shape[1]
+
+        # Flip
+        flip_v = rng.randint(0, 2, n).astype(bool)
+        flip_h = rng.randint(0, 2, n).astype(bool)
+        imgs[flip_v] = imgs[flip_v, ::-1]
+        masks[flip_v] = masks[flip_v, ::-1]
+        imgs[flip_h] = imgs[flip_h, :, ::-1]
+        masks[flip_h] = masks[flip_h, :, ::-1]
+
+        # Crop and resize
+        crop_ratios = rng.uniform(self.resize_range[0], self.resize_range[1], n)
+        crop_sizes = np.floor(size * crop_ratios).astype(int)
+        crop_rows = (rng.uniform(size=n) * (size - crop_sizes + 1)).astype(int)
+        crop_cols = (rng.uniform(size=n) * (size - crop_sizes + 1)).astype(int)
+        imgs = crop_resize(imgs, crop_rows, crop_cols, crop_sizes)
+        masks = crop_resize(masks, crop_rows, crop_cols, crop_sizes)
+        masks = (masks >= 0.5).astype(masks.dtype)
+
+        # Rotate
+        rot_k = rng.randint(0, 4, n)
+        for k in range(1, 4):
+            sel = rot_k == k
+            if np.any(sel):
+                imgs[sel] = np.rot90(imgs[sel], k, axes=(1, 2))
+                masks[sel] = np.rot90(masks[sel], k, axes=(1, 2))
+
+        return imgs, masks
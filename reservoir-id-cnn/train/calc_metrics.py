@@ -1,6 +1,7 @@
 import sys
 import numpy as np
 from skimage import transform
+import pixel_metrics
 
 # test_npy_path = sys.argv[1]
 # pred_npy_path = sys.argv[2]
@@ -19,25 +20,9 @@ test = np.load(test_npy_path)
 test = np.delete(test, -11,axis=0) # Remove HUGE reservoir)
 pred = np.delete(pred, -11,axis=0)
 
-true_pos = np.sum((pred==255)*(test==255))
-false_pos = np.sum((pred==255)*(test==0))
-true_neg = np.sum((pred==0)*(test==0))
-false_neg = np.sum((pred==0)*(test==255))
-
-precision = true_pos/(true_pos + false_pos)
-recall = true_pos/(true_pos + false_neg)
-pfa = false_pos/(true_pos + false_pos)
-pmd = false_neg/(true_pos + false_neg)
-agree = true_pos + true_neg
-total = (true_pos + false_pos + false_neg + true_neg)
-pcc = (agree)/(total)
-exp_a =  ((((true_pos+false_pos)*(true_pos+false_neg))+
-           ((false_pos+true_neg)*(false_neg+true_neg)))/
-          total
-          )
-kappa = (agree - exp_a)/(total - exp_a)
-f1 = 2*(precision*recall)/(precision+recall)
-iou = true_pos/(true_pos + false_pos + false_neg)
-print(agree, exp_a, kappa)
-print(pfa, pmd, pcc)
-print(precision, recall, f1, iou, true_pos, false_pos, true_neg, false_neg)
+m = pixel_metrics.metrics_from_counts(
+    pixel_metrics.confusion_counts(pred == 255, test == 255).sum(axis=0))
+print(m['true_pos'] + m['true_neg'], m['kappa'])
+print(m['pfa'], m['pmd'], m['pcc'])
+print(m['precision'], m['recall'], m['f1'], m['iou'], m['true_pos'],
+      m['false_pos'], m['true_neg'], m['false_neg'])
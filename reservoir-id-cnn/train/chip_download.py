@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Concurrent, resumable download of annotation chips
+
+Files that already exist locally with the same size and md5 hash as the
+remote copy are skipped, so reruns only fetch new or changed chips. Files
+are downloaded to a temporary name and renamed when complete, so an
+interrupted run never leaves a partial file that looks finished.
+
+Storage is reached through a small backend interface (stat and download),
+with a Google Cloud Storage backend and a local directory backend that can
+act as a fake bucket.
+
+"""
+
+
+import os
+import time
+import base64
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+DOWNLOAD_WORKERS = 16
+# Number of concurrent downloads
+
+RETRIES = 3
+# Attempts per file before giving up
+
+HASH_BLOCK_SIZE = 1 << 20
+# Bytes read at a time when hashing local files
+
+
+def file_md5(path):
+    """Base64 encoded md5 digest of a file, as reported by GCS"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+
+    return base64.b64encode(md5.digest()).decode('ascii')
+
+
+class GCSBackend(object):
+    """Google Cloud Storage bucket
+
+    Attributes:
+        bucket (google.cloud.storage.Bucket): Source bucket.
+
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def stat(self, path):
+        """Return (size, base64 md5) of path, or None if missing."""
+        blob = self.bucket.get_blob(path)
+        if blob is None:
+            return None
+        return blob.size, blob.md5_hash
+
+    def download(self, path, dest):
+        self.bucket.blob(path).download_to_filename(dest)
+
+
+class LocalBackend(object):
+    """Directory standing in for a bucket, e.g. for testing
+
+    Attributes:
+        root (str): Directory that object paths are relative to.
+
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def stat(self, path):
+        """Return (size, base64 md5) of path, or None if missing."""
+        full_path = os.path.join(self.root, path)
+        if not os.path.isfile(full_path):
+            return None
+        return os.path.getsize(full_path), file_md5(full_path)
+
+    def download(self, path, dest):
+        shutil.copyfile(os.path.join(self.root, path), dest)
+
+
+class ChipDownloader(object):
+    """Download many files from a backend with a thread pool
+
+    Attributes:
+        backend (GCSBackend or LocalBackend): Storage to download from.
+        workers (int): Number of concurrent downloads.
+        retries (int): Attempts per file before giving up.
+
+    """
+    def __init__(self, backend, workers=DOWNLOAD_WORKERS, retries=RETRIES):
+        self.backend = backend
+        self.workers = workers
+        self.retries = retries
+
+    def is_current(self, dest, remote_stat):
+        """True if dest exists with the remote size and hash."""
+        if not os.path.isfile(dest):
+            return False
+        size, md5_hash = remote_stat
+        if os.path.getsize(dest) != size:
+            return False
+        return md5_hash is None or file_md5(dest) == md5_hash
+
+    def fetch(self, path, dest):
+        """Download one file unless current.
+
+        Returns:
+            Tuple of (status, bytes downloaded, error) where status is one
+            of 'downloaded', 'skipped' or 'failed'.
+
+        """
+        error = None
+        for attempt in range(self.retries):
+            try:
+                remote_stat = self.backend.stat(path)
+                if remote_stat is None:
+                    return 'failed', 0, 'missing {}'.format(path)
+                if self.is_current(dest, remote_stat):
+                    return 'skipped', 0, None
+
+                part_path = '{}.part'.format(dest)
+                self.backend.download(path, part_path)
+                os.replace(part_path, dest)
+                if not self.is_current(dest, remote_stat):
+                    raise IOError('hash mismatch for {}'.format(path))
+                return 'downloaded', remote_stat[0], None
+            except Exception as e:
+                error = repr(e)
+                if attempt < self.retries - 1:
+                    time.sleep(2 ** attempt)
+
+        return 'failed', 0, error
+
+    def download_all(self, path_dest_pairs):
+        """Download (remote path, local dest) pairs concurrently.
+
+        Returns:
+            Dictionary of counts per status, bytes and failed paths.
+
+        """
+        start_time = time.time()
+        summary = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0,
+                   'failed_paths': []}
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = [(path, executor.submit(self.fetch, path, dest))
+                       for path, dest in path_dest_pairs]
+            for count, (path, future) in enumerate(futures, 1):
+                status, nbytes, error = future.result()
+                summary[status] += 1
+                summary['bytes'] += nbytes
+                if error is not None:
+                    summary['failed_paths'] += [path]
+                    print('Failed {}: {}'.format(path, error))
+                if count % 100 == 0 or count == len(futures):
+                    elapsed = time.time() - start_time
+                    print('Download: {}/{} files, {:.1f} MB/s'.format(
+                        count, len(futures),
+                        summary['bytes'] / 1e6 / max(elapsed, 1e-9)))
+
+        print('Downloaded {downloaded}, skipped {skipped}, failed {failed}'
+              .format(**summary))
+
+        return summary
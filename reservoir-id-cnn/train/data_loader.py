@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Streaming loader for prepped training data
+
+Prepped .npy files are memory-mapped and only the images of the current
+batch are read, band selected, resized, and scaled. Batches are produced by
+Keras worker threads and queued ahead of the model, so the full dataset
+never has to be held in memory.
+
+Example:
+    >>> imgs = np.load('./data/prepped/imgs_train.npy', mmap_mode='r')
+    >>> masks = np.load('./data/prepped/imgs_mask_train.npy', mmap_mode='r')
+    >>> mean, std = compute_mean_std(imgs, band_selection)
+    >>> seq = PreppedSequence(imgs, masks, band_selection, mean, std)
+    >>> model.fit(seq, workers=4, max_queue_size=8)
+
+"""
+
+
+import os
+import math
+import numpy as np
+from skimage import transform
+from keras.utils import Sequence
+import shard_dataset
+import band_stats
+
+RESIZE_DIMS = (512, 512)
+# Resized dimensions for training/testing.
+
+STATS_CHUNK_SIZE = 64
+# Number of images per chunk when computing band statistics
+
+
+def load_prepped(prepped_dir, split):
+    """Memory-map the images and masks of a prepped split
+
+    prepped_dir can hold either monolithic .npy files or a sharded dataset
+    (see shard_dataset.py).
+
+    """
+    if shard_dataset.is_sharded(prepped_dir):
+        return shard_dataset.ShardedDataset(prepped_dir).load_split(split)
+
+    imgs = np.load('{}imgs_{}.npy'.format(prepped_dir, split), mmap_mode='r')
+    masks = np.load('{}imgs_mask_{}.npy'.format(prepped_dir, split),
+                    mmap_mode='r')
+
+    return imgs, masks
+
+
+def has_split(prepped_dir, split):
+    """Whether prepped_dir holds any images of split"""
+    if shard_dataset.is_sharded(prepped_dir):
+        return len(shard_dataset.ShardedDataset(prepped_dir).records(split)) > 0
+
+    return os.path.isfile('{}imgs_{}.npy'.format(prepped_dir, split))
+
+
+def load_band_stats(prepped_dir):
+    """Training split band_stats.BandStats stored with the data, or None"""
+    if shard_dataset.is_sharded(prepped_dir):
+        return shard_dataset.ShardedDataset(prepped_dir).band_stats('train')
+
+    return band_stats.read_stats(prepped_dir)
+
+
+def nd_scaling(prepped_dir):
+    """Scaling of normalized difference bands of prepped data, see nd_bands"""
+    if shard_dataset.is_sharded(prepped_dir):
+        return shard_dataset.ShardedDataset(prepped_dir).nd_scaling()
+
+    return 'minmax'
+
+
+def preprocess_batch(imgs, masks, band_selection, resize_dims=RESIZE_DIMS):
+    """Band select and resize a batch of imgs and masks to float32
+
+    Same result as train.preprocess, but only for the given images.
+
+    """
+    num_bands = len(band_selection)
+    imgs_p = np.empty((imgs.shape[0], resize_dims[0], resize_dims[1],
+                       num_bands), dtype=np.float32)
+    masks_p = np.empty((masks.shape[0], resize_dims[0], resize_dims[1], 1),
+                       dtype=np.float32)
+    for i in range(imgs.shape[0]):
+        imgs_p[i] = transform.resize(imgs[i][:, :, band_selection],
+                                     (resize_dims[0], resize_dims[1],
+                                      num_bands),
+                                     preserve_range=True)
+        masks_p[i] = transform.resize(masks[i],
+                                      (resize_dims[0], resize_dims[1], 1),
+                                      preserve_range=True)
+
+    masks_p /= 255.  # scale masks to [0, 1]
+    masks_p[masks_p >= 0.5] = 1
+    masks_p[masks_p < 0.5] = 0
+
+    return imgs_p, masks_p
+
+
+def compute_mean_std(imgs, band_selection, resize_dims=RESIZE_DIMS,
+                     chunk_size=STATS_CHUNK_SIZE):
+    """Per band mean and std of resized images, in one chunked pass
+
+    Returns:
+        Tuple of float32 arrays (mean, std), one value per selected band.
+
+    """
+    num_bands = len(band_selection)
+    count = 0
+    band_sum = np.zeros(num_bands, dtype=np.float64)
+    band_sumsq = np.zeros(num_bands, dtype=np.float64)
+    for start in range(0, imgs.shape[0], chunk_size):
+        chunk = imgs[start:start + chunk_size]
+        chunk_p = np.empty((chunk.shape[0], resize_dims[0], resize_dims[1],
+                            num_bands), dtype=np.float64)
+        for i in range(chunk.shape[0]):
+            chunk_p[i] = transform.resize(chunk[i][:, :, band_selection],
+                                          (resize_dims[0], resize_dims[1],
+                                           num_bands),
+                                          preserve_range=True)
+        count += chunk_p.shape[0] * resize_dims[0] * resize_dims[1]
+        band_sum += chunk_p.sum(axis=(0, 1, 2))
+        band_sumsq += np.square(chunk_p).sum(axis=(0, 1, 2))
+
+    mean = band_sum / count
+    std = np.sqrt(np.maximum(band_sumsq / count - np.square(mean), 0))
+
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+class PreppedSequence(Sequence):
+    """Keras Sequence of preprocessed batches from memory-mapped arrays
+
+    Attributes:
+        imgs (array): N x rows x cols x bands images, usually memory-mapped.
+        masks (array): N x rows x cols masks with values 0 or 255.
+        band_selection (list): Indices of bands to use.
+        mean (array): Per selected band mean for scaling.
+        std (array): Per selected band std for scaling.
+        batch_size (int): Images per batch.
+        shuffle (bool): Reshuffle image order at the end of every epoch.
+        resize_dims (tuple): Dimensions for resizing before the CNN.
+        augmenter (BatchAugmenter): Applied to every batch if not None.
+        epoch (int): Current epoch, used to seed augmentation.
+        preprocessed (bool): imgs and masks are already band selected,
+            resized and scaled (see preprocess_cache.py).
+        order (array): Indices into imgs of the images used, in batch order.
+            Defaults to all images; a subset is read batch by batch without
+            loading the others.
+
+    """
+    def __init__(self, imgs, masks, band_selection, mean, std, batch_size=12,
+                 shuffle=False, seed=None, resize_dims=RESIZE_DIMS,
+                 augmenter=None, preprocessed=False, indices=None):
+        self.imgs = imgs
+        self.masks = masks
+        self.band_selection = list(band_selection)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.resize_dims = resize_dims
+        self.augmenter = augmenter
+        self.epoch = 0
+        self.preprocessed = preprocessed
+        self.rng = np.random.RandomState(seed)
+        if indices is None:
+            indices = np.arange(imgs.shape[0])
+        self.order = np.array(indices, dtype=np.int64)
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return int(math.ceil(self.order.size / self.batch_size))
+
+    def batch_indices(self, idx):
+        """Sorted image indices of batch idx, for sequential mmap reads"""
+        return np.sort(self.order[idx * self.batch_size:
+                                  (idx + 1) * self.batch_size])
+
+    def __getitem__(self, idx):
+        indices = self.batch_indices(idx)
+        if self.preprocessed:
+            imgs = np.array(self.imgs[indices], dtype=np.float32)
+            masks = np.array(self.masks[indices], dtype=np.float32)
+        else:
+            imgs, masks = preprocess_batch(self.imgs[indices],
+                                           self.masks[indices],
+                                           self.band_selection,
+                                           self.resize_dims)
+            imgs -= self.mean
+            imgs /= self.std
+        if self.augmenter is not None:
+            imgs, masks = self.augmenter.augment(imgs, masks, self.epoch, idx)
+
+        return imgs, masks
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.shuffle:
+            self.rng.shuffle(self.order)
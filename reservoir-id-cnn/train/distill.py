@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Distill a trained U-Net into a slimmer, faster student
+
+The teacher's soft predictions on the prepped training images are computed
+once and stored as a memory-mapped array. A student U-Net with fewer
+filters (width) and/or levels (depth) is then trained on targets blending
+those soft predictions with the true masks, and validated against the true
+masks. Finally teacher and student are compared on the test split for pixel
+F1/IoU and prediction speed in tiles per second.
+
+The student is written to out_dir like train.train's outputs
+(unet_10band.txt, weights.h5, mean_std.npy), so it can be used directly by
+predict_map.py or export_model.py.
+
+Example:
+    python3 distill.py ./teacher/ ./student/ --width 0.5 --depth 4
+
+Notes:
+    Training batches are not augmented, since batch augmentation re-binarizes
+    masks after resizing and would destroy the soft targets.
+
+"""
+
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from keras import models
+from keras.utils import Sequence
+from keras.callbacks import ModelCheckpoint, EarlyStopping
+import loss_functions as lf
+import data_loader
+import nd_bands
+import pixel_metrics
+import train
+
+ALPHA = 0.7
+# Weight of teacher soft predictions in student targets, vs true masks
+
+TEMPERATURE = 2.0
+# Softening of teacher predictions, applied to their logits
+
+SPEED_BATCHES = 5
+# Number of test batches timed for tiles per second
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Distill a trained U-Net into a slimmer student.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('teacher_dir',
+                   help=('Directory with the teacher unet_10band.txt, '
+                         'weights.h5 and mean_std.npy.'),
+                   type=str)
+    p.add_argument('out_dir',
+                   help='Output directory for the student.',
+                   type=str)
+    p.add_argument('--width',
+                   help='Student filter width multiplier.',
+                   default=0.5,
+                   type=float)
+    p.add_argument('--depth',
+                   help='Student number of poolings.',
+                   default=4,
+                   type=int)
+    p.add_argument('--alpha',
+                   help='Weight of teacher predictions in targets.',
+                   default=ALPHA,
+                   type=float)
+    p.add_argument('--temperature',
+                   help='Softening of teacher predictions.',
+                   default=TEMPERATURE,
+                   type=float)
+    p.add_argument('--lr',
+                   help='Student learning rate.',
+                   default=1e-4,
+                   type=float)
+    p.add_argument('--loss',
+                   help='Student loss, a name in loss_functions.py or Keras.',
+                   default='binary_crossentropy',
+                   type=str)
+    p.add_argument('--bands',
+                   help='Comma separated band selection of the teacher.',
+                   default='0,1,2,3,4,5,12,13,14,15',
+                   type=str)
+    p.add_argument('--epochs',
+                   help='Maximum number of epochs.',
+                   default=train.EPOCHS,
+                   type=int)
+    p.add_argument('--prepped-dir',
+                   help='Prepped .npy or sharded dataset directory.',
+                   default=train.PREPPED_DIR,
+                   type=str)
+    return p
+
+
+def load_model(model_dir):
+    """Keras model from unet_10band.txt and weights.h5 in model_dir"""
+    with open(os.path.join(model_dir, 'unet_10band.txt')) as struct_file:
+        model = models.model_from_json(struct_file.read())
+    model.load_weights(os.path.join(model_dir, 'weights.h5'))
+
+    return model
+
+
+def soften(probs, temperature):
+    """Apply temperature to sigmoid probabilities via their logits"""
+    probs = np.clip(probs, 1e-6, 1 - 1e-6)
+    logits = np.log(probs / (1 - probs))
+
+    return 1 / (1 + np.exp(-logits / temperature))
+
+
+def teacher_targets(teacher, seq, path, temperature):
+    """Memory-mapped soft teacher predictions for every image of seq"""
+    num_imgs = seq.imgs.shape[0]
+    soft = None
+    for idx in range(len(seq)):
+        imgs, _ = seq[idx]
+        preds = soften(teacher.predict_on_batch(imgs), temperature)
+        if soft is None:
+            soft = np.lib.format.open_memmap(
+                path, mode='w+', dtype=np.float16,
+                shape=(num_imgs,) + preds.shape[1:])
+        soft[seq.batch_indices(idx)] = preds
+    soft.flush()
+
+    return soft
+
+
+class SoftTargetSequence(Sequence):
+    """Batches of a PreppedSequence with targets blended with soft labels
+
+    Attributes:
+        seq (PreppedSequence): Unshuffled, unaugmented training sequence.
+        soft (array): Soft teacher predictions for each image of seq.
+        alpha (float): Weight of soft predictions in the targets.
+
+    """
+    def __init__(self, seq, soft, alpha):
+        self.seq = seq
+        self.soft = soft
+        self.alpha = alpha
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self, idx):
+        imgs, masks = self.seq[idx]
+        soft = np.asarray(self.soft[self.seq.batch_indices(idx)],
+                          dtype=np.float32)
+
+        return imgs, self.alpha * soft + (1 - self.alpha) * masks
+
+
+def evaluate(model, seq, speed_batches=SPEED_BATCHES):
+    """Pixel metrics on seq at train.PRED_THRESHOLD, and tiles per second"""
+    counts = np.zeros(4, dtype=np.int64)
+    for idx in range(len(seq)):
+        imgs, masks = seq[idx]
+        preds = model.predict_on_batch(imgs)
+        counts += pixel_metrics.confusion_counts(
+            preds[..., 0] > train.PRED_THRESHOLD, masks[..., 0] > 0.5).sum(0)
+    metrics = pixel_metrics.metrics_from_counts(counts)
+
+    # Time prediction alone, after a warmup batch
+    imgs, _ = seq[0]
+    model.predict_on_batch(imgs)
+    start_time = time.time()
+    for _ in range(speed_batches):
+        model.predict_on_batch(imgs)
+    elapsed = time.time() - start_time
+
+    return {'f1': float(metrics['f1']),
+            'iou': float(metrics['iou']),
+            'precision': float(metrics['precision']),
+            'recall': float(metrics['recall']),
+            'params': int(model.count_params()),
+            'tiles_per_sec': speed_batches * imgs.shape[0] / elapsed}
+
+
+def distill(teacher_dir, out_dir, band_selection, width=0.5, depth=4,
+            alpha=ALPHA, temperature=TEMPERATURE, learn_rate=1e-4,
+            loss_func='binary_crossentropy', epochs=train.EPOCHS,
+            prepped_dir=train.PREPPED_DIR):
+    """Train a student from a teacher and compare them on the test split.
+
+    Returns:
+        Report dictionary with teacher and student metrics and speed.
+
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    mean_std = np.load(os.path.join(teacher_dir, 'mean_std.npy'))
+    np.save(os.path.join(out_dir, 'mean_std.npy'), mean_std)
+    nd_bands.write_nd_scaling(out_dir, data_loader.nd_scaling(prepped_dir))
+    mean, std = mean_std[0], mean_std[1]
+
+    train_seq = train.make_sequence(prepped_dir, 'train', band_selection,
+                                    mean, std)
+    # If no val set, test data is used as val/early stopping set, as train.py
+    val_split = 'val'
+    if not data_loader.has_split(prepped_dir, 'val'):
+        val_split = 'test'
+    val_seq = train.make_sequence(prepped_dir, val_split, band_selection,
+                                  mean, std)
+    test_seq = train.make_sequence(prepped_dir, 'test', band_selection,
+                                   mean, std)
+
+    print('-'*30)
+    print('Predicting teacher soft targets...')
+    print('-'*30)
+    teacher = load_model(teacher_dir)
+    soft = teacher_targets(teacher, train_seq,
+                           os.path.join(out_dir, 'teacher_soft_train.npy'),
+                           temperature)
+
+    print('-'*30)
+    print('Fitting student...')
+    print('-'*30)
+    student = train.get_unet(
+        train.RESIZE_ROWS, train.RESIZE_COLS, len(band_selection), loss_func,
+        learn_rate, structure_path=os.path.join(out_dir, 'unet_10band.txt'),
+        width=width, depth=depth)
+    weights_path = os.path.join(out_dir, 'weights.h5')
+    student.fit(SoftTargetSequence(train_seq, soft, alpha), epochs=epochs,
+                verbose=2, shuffle=False, validation_data=val_seq,
+                callbacks=[ModelCheckpoint(weights_path, monitor='val_loss',
+                                           mode='min', save_best_only=True),
+                           EarlyStopping(monitor='val_loss', patience=25,
+                                         mode='min')],
+                workers=train.WORKERS, use_multiprocessing=False,
+                max_queue_size=train.MAX_QUEUE_SIZE)
+    student.load_weights(weights_path)
+
+    print('-'*30)
+    print('Comparing teacher and student on test data...')
+    print('-'*30)
+    report = {'teacher': evaluate(teacher, test_seq),
+              'student': evaluate(student, test_seq),
+              'width': width, 'depth': depth, 'alpha': alpha,
+              'temperature': temperature}
+    report['speedup'] = (report['student']['tiles_per_sec'] /
+                         report['teacher']['tiles_per_sec'])
+    report['f1_change'] = report['student']['f1'] - report['teacher']['f1']
+    with open(os.path.join(out_dir, 'distill_report.json'), 'w') as fp:
+        json.dump(report, fp, sort_keys=True, indent=4)
+    print(report)
+
+    return report
+
+
+def main():
+
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    distill(args.teacher_dir, args.out_dir,
+            [int(b) for b in args.bands.split(',')], width=args.width,
+            depth=args.depth, alpha=args.alpha, temperature=args.temperature,
+            learn_rate=args.lr, loss_func=getattr(lf, args.loss, args.loss),
+            epochs=args.epochs, prepped_dir=args.prepped_dir)
+
+    return
+
+
+if __name__=='__main__':
+    main()
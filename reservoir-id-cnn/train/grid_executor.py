@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Parallel, resumable executor for grid search trials
+
+Each trial runs train.train in its own process, pinned to its own set of
+CPU cores with TensorFlow and OpenMP thread pools sized to match. A trial's
+result is written to <results_dir>/<trial id>/result.json as soon as it
+finishes, and trials that already have a result are skipped, so a crashed
+or interrupted search can simply be restarted.
+
+Trials share the read-only training data through the memory-mapped
+preprocess cache (see preprocess_cache.py), so the page cache holds one
+copy no matter how many trials run.
+
+Notes:
+    Trial processes are started with the 'spawn' method and import train
+    only after setting thread limits, because TensorFlow reads them when it
+    is first imported. Loss functions are therefore passed by name.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+def trial_id(trial):
+    """Directory name of a trial, from its loss, learning rate and bands"""
+    return '{}_{}_{}'.format(trial['loss'], trial['lr'], trial['bands_name'])
+
+
+def write_json_atomic(obj, path):
+    """Write json to a temporary file and rename it over path"""
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(obj, fp, sort_keys=True, indent=4)
+    os.replace(tmp_path, path)
+
+    return
+
+
+def load_result(trial_dir, result_name='result.json'):
+    """Result dictionary of a finished trial, or None"""
+    result_path = os.path.join(trial_dir, result_name)
+    if not os.path.isfile(result_path):
+        return None
+    with open(result_path) as fp:
+        return json.load(fp)
+
+
+def limit_threads(cores):
+    """Pin this process to cores and size thread pools to match."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                'TF_NUM_INTRAOP_THREADS']:
+        os.environ[var] = str(len(cores))
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+
+
+def run_trial(trial, trial_dir, cores, train_kwargs, result_name):
+    """Process target running one trial and writing its result.
+
+    Keyword arguments in trial['train_kwargs'] override train_kwargs.
+
+    """
+    limit_threads(cores)
+    log_file = open(os.path.join(trial_dir, 'train.log'), 'a')
+    sys.stdout = log_file
+    sys.stderr = log_file
+
+    import loss_functions as lf
+    import train
+
+    start_time = time.time()
+    loss_func = getattr(lf, trial['loss'], trial['loss'])
+    kwargs = dict(train_kwargs, **trial.get('train_kwargs', {}))
+    results = train.train(trial['lr'], loss_func, trial['bands'],
+                          out_dir='{}/'.format(trial_dir), **kwargs)
+
+    write_json_atomic({'trial': trial,
+                       'results': {k: float(v) for k, v in results.items()},
+                       'cores': sorted(cores),
+                       'seconds': time.time() - start_time},
+                      os.path.join(trial_dir, result_name))
+    log_file.close()
+
+
+def core_slots(parallel, cores_per_trial):
+    """Disjoint sets of CPU cores, one per concurrent trial"""
+    if hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count()))
+    if parallel * cores_per_trial > len(available):
+        raise ValueError('{} trials x {} cores needs more than the {} '
+                         'available cores'.format(parallel, cores_per_trial,
+                                                  len(available)))
+
+    return [set(available[i * cores_per_trial:(i + 1) * cores_per_trial])
+            for i in range(parallel)]
+
+
+def run_grid(trials, results_dir, parallel=1, cores_per_trial=None,
+             train_kwargs=None, result_name='result.json'):
+    """Run trials concurrently, skipping those with saved results.
+
+    Args:
+        trials (list): Dictionaries with loss (name), lr, bands_name, bands.
+        results_dir (str): Directory holding one subdirectory per trial.
+        parallel (int): Number of trials run at once.
+        cores_per_trial (int): Cores per trial. Default splits all cores.
+        train_kwargs (dict): Extra keyword arguments for train.train.
+        result_name (str): Result file name within each trial directory.
+
+    Returns:
+        Dictionary of trial id to result dictionary, for finished trials.
+
+    """
+    train_kwargs = train_kwargs or {}
+    if cores_per_trial is None:
+        cores_per_trial = max(1, len(os.sched_getaffinity(0)) // parallel)
+    free_slots = core_slots(parallel, cores_per_trial)
+
+    pending = []
+    for trial in trials:
+        trial_dir = os.path.join(results_dir, trial_id(trial))
+        if load_result(trial_dir, result_name) is not None:
+            print('Skipping finished trial {}'.format(trial_id(trial)))
+            continue
+        if not os.path.isdir(trial_dir):
+            os.makedirs(trial_dir)
+        pending += [(trial, trial_dir)]
+
+    ctx = multiprocessing.get_context('spawn')
+    running = {}
+    while pending or running:
+        while pending and free_slots:
+            trial, trial_dir = pending.pop(0)
+            cores = free_slots.pop(0)
+            proc = ctx.Process(target=run_trial,
+                               args=(trial, trial_dir, cores, train_kwargs,
+                                     result_name))
+            proc.start()
+            running[proc.sentinel] = (proc, trial, trial_dir, cores)
+            print('STARTING: {} on cores {}'.format(trial_id(trial),
+                                                    sorted(cores)))
+
+        for sentinel in wait(list(running.keys())):
+            proc, trial, trial_dir, cores = running.pop(sentinel)
+            proc.join()
+            free_slots.append(cores)
+            if proc.exitcode == 0:
+                print('DONE: {}'.format(trial_id(trial)))
+            else:
+                print('FAILED: {} (exit code {}), see {}/train.log'.format(
+                    trial_id(trial), proc.exitcode, trial_dir))
+
+    results = {}
+    for trial in trials:
+        result = load_result(os.path.join(results_dir, trial_id(trial)),
+                             result_name)
+        if result is not None:
+            results[trial_id(trial)] = result
+
+    return results
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 """Grid search over loss functions and learning rates
 
+Trials run in parallel on disjoint sets of cores and each trial's results
+are saved as soon as it finishes, so an interrupted search can be rerun and
+only unfinished trials are trained (see grid_executor.py).
+
+With --halving, trials are run as a successive halving search instead,
+training all of them briefly and only continuing the best (see
+successive_halving.py).
+
 Example:
-    python3 gridsearch.py
+    python3 gridsearch.py --parallel 2 --cores-per-trial 8
+    python3 gridsearch.py --halving --min-epochs 10 --eta 3
 
 Notes:
     Must be run from reservoir-id-cnn/train/
@@ -10,14 +19,72 @@ Notes:
 
 """
 
-import train
 import json
-import loss_functions as lf
+import argparse
 from collections import OrderedDict
+import grid_executor
+import successive_halving as sh
+
+CACHE_DIR = './data/cache/'
+# Preprocessed tensors shared by all runs with the same band combo
+
+RESULTS_DIR = './data/grid/'
+# Directory with one subdirectory of outputs per trial
+
+MAX_EPOCHS = 500
+# Epoch budget of the last successive halving rung, as train.EPOCHS
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Grid search over loss functions and learning rates.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--parallel',
+                   help='Number of trials trained at once.',
+                   default=1,
+                   type=int)
+    p.add_argument('--cores-per-trial',
+                   help='CPU cores per trial. Default splits all cores.',
+                   default=None,
+                   type=int)
+    p.add_argument('--results-dir',
+                   help='Directory for per trial outputs and results.',
+                   default=RESULTS_DIR,
+                   type=str)
+    p.add_argument('--halving',
+                   help='Run a successive halving search.',
+                   action='store_true')
+    p.add_argument('--min-epochs',
+                   help='Epochs of the first successive halving rung.',
+                   default=sh.MIN_EPOCHS,
+                   type=int)
+    p.add_argument('--max-epochs',
+                   help='Epochs of the last successive halving rung.',
+                   default=MAX_EPOCHS,
+                   type=int)
+    p.add_argument('--eta',
+                   help='Keep the best 1/eta of trials at each rung.',
+                   default=sh.ETA,
+                   type=int)
+    p.add_argument('--metric',
+                   help='Validation metric to rank trials by.',
+                   default='val_loss',
+                   choices=sorted(sh.METRICS.keys()),
+                   type=str)
+    return p
+
 
 def main():
+
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
     lr_list = [1e-4, 2e-4, 6e-5]
-    lf_list = [lf.dice_coef_wgt_loss]
+    # Loss functions by name in loss_functions.py, or Keras loss names
+    lf_list = ['dice_coef_wgt_loss']
     band_combo_dict = OrderedDict([
 #         ('all',list(range(16))),
 #         ('all_old', [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 14, 15]),
@@ -26,25 +93,39 @@ def main():
 #         ('rgbn_nds_radar_old', [0, 1, 2, 3, 4, 5, 14, 15])
     ])
 
-
-    out_dict = {}
-    for lfunc in lf_list:
-        if type(lfunc) == str:
-            lf_name = lfunc
-        else:
-            lf_name = lfunc.__name__
-        out_dict[lf_name] = {}
+    trials = []
+    for lf_name in lf_list:
         for lr in lr_list:
-            out_dict[lf_name][str(lr)] = {}
             for bc_name in sorted(band_combo_dict.keys()):
-                print("STARTING:", bc_name, lf_name, lr)
-                train_results = train.train(lr, lfunc, band_combo_dict[bc_name],
-                                            test=True, val=True)
-                out_dict[lf_name][str(lr)][bc_name] = train_results
-                print("DONE:", bc_name, lf_name, lr)
-                print("SO FAR:", out_dict)
+                trials += [{'loss': lf_name, 'lr': lr, 'bands_name': bc_name,
+                            'bands': band_combo_dict[bc_name]}]
+
+    train_kwargs = {'val': True, 'cache_dir': CACHE_DIR}
+    if args.halving:
+        rungs = sh.successive_halving(
+            trials, args.results_dir, args.max_epochs,
+            min_epochs=args.min_epochs, eta=args.eta, metric=args.metric,
+            parallel=args.parallel, cores_per_trial=args.cores_per_trial,
+            train_kwargs=train_kwargs)
+        print('Best trial: {}'.format(rungs[-1]['trials'][:1]))
+        with open('halving_results.json', 'w') as fp:
+            json.dump(rungs, fp, sort_keys=True, indent=4)
+        return
+
+    results = grid_executor.run_grid(
+        trials, args.results_dir, parallel=args.parallel,
+        cores_per_trial=args.cores_per_trial, train_kwargs=train_kwargs)
+
+    out_dict = {}
+    for trial in trials:
+        result = results.get(grid_executor.trial_id(trial))
+        if result is None:
+            continue
+        out_dict.setdefault(trial['loss'], {}).setdefault(
+            str(trial['lr']), {})[trial['bands_name']] = result['results']
 
     print(out_dict)
+    print('{}/{} trials finished'.format(len(results), len(trials)))
 
     with open('grid_results.json', 'w') as fp:
         json.dump(out_dict, fp, sort_keys=True, indent=4)
@@ -54,4 +135,3 @@ def main():
 
 if __name__=='__main__':
     main()
-
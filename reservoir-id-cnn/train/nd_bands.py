@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Normalized difference bands and how they are scaled to uint16
+
+Prepped .npy datasets (prep_train_test.py) scale each normalized difference
+band from the min and max of the whole dataset, and predict_map.py scales
+from the min and max of each batch. Sharded datasets (shard_dataset.py)
+scale from the fixed [-1, 1] range instead. The scaling a model was trained
+with is written to its directory as nd_scaling.txt, so prediction can apply
+the same one.
+
+"""
+
+
+import os
+import numpy as np
+
+ND_BANDS = [(3, 11), (1, 11), (1, 3), (3, 2)]
+# Band pairs for Gao NDWI, MNDWI, McFeeters NDWI and NDVI, appended in order
+
+ND_SCALINGS = ['minmax', 'fixed']
+# Scalings of normalized difference bands to uint16
+
+ND_SCALING_NAME = 'nd_scaling.txt'
+# File in a model directory naming its normalized difference scaling
+
+
+def normalized_diff(ar1, ar2):
+    """Returns normalized difference of two arrays."""
+
+    # Convert arrays to float32
+    ar1 = ar1.astype('float32')
+    ar2 = ar2.astype('float32')
+
+    return((ar1 - ar2) / (ar1 + ar2))
+
+
+def scale_nd_fixed(nd):
+    """Scale normalized difference from [-1, 1] to uint16"""
+    nd = np.nan_to_num(np.clip(nd, -1, 1))
+
+    return (65535 * (nd + 1) / 2).astype(np.uint16)
+
+
+def fill_nd_fixed(imgs, band1, band2, out_band, chunk_size=256):
+    """Write normalized difference scaled from [-1, 1] to out_band, in place.
+
+    Computed in chunks of images, like prep_train_test.fill_nd.
+
+    """
+    for start in range(0, imgs.shape[0], chunk_size):
+        nd = normalized_diff(imgs[start:start + chunk_size, :, :, band1],
+                             imgs[start:start + chunk_size, :, :, band2])
+        imgs[start:start + chunk_size, :, :, out_band] = scale_nd_fixed(nd)
+
+    return
+
+
+def write_nd_scaling(model_dir, nd_scaling):
+    """Write the normalized difference scaling of a model to model_dir."""
+    if nd_scaling not in ND_SCALINGS:
+        raise ValueError('Unknown ND scaling {}, expected one of {}'.format(
+            nd_scaling, ND_SCALINGS))
+    with open(os.path.join(model_dir, ND_SCALING_NAME), 'w') as f:
+        f.write('{}\n'.format(nd_scaling))
+
+    return
+
+
+def read_nd_scaling(model_dir):
+    """Normalized difference scaling of a model, 'minmax' if not recorded"""
+    path = os.path.join(model_dir, ND_SCALING_NAME)
+    if not os.path.isfile(path):
+        return 'minmax'
+    with open(path) as f:
+        return f.read().strip()
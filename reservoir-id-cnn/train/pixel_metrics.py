@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Pixel confusion counts and accuracy metrics for mask stacks
+
+Per image true/false positive/negative counts are found with a single
+bincount over chunks of the predicted and true stacks, and every metric is
+derived from those counts, so per image and aggregate metrics come from the
+same pass.
+
+ThresholdHistogram bins predicted probabilities of reservoir and background
+pixels in a streaming pass, then gives counts and metrics at every threshold
+from cumulative sums, without re-thresholding the predictions.
+
+Example:
+    >>> counts = confusion_counts(pred > 0.5, true == 255)
+    >>> image_metrics = metrics_from_counts(counts)
+    >>> total_metrics = metrics_from_counts(counts.sum(axis=0))
+    >>> hist = ThresholdHistogram()
+    >>> hist.update(pred, true == 255)
+    >>> thresholds, curves = hist.curves()
+
+"""
+
+
+import csv
+import numpy as np
+
+COUNT_NAMES = ['true_pos', 'false_pos', 'true_neg', 'false_neg']
+# Order of counts in the last axis of confusion_counts output
+
+CHUNK_SIZE = 64
+# Number of images per bincount pass
+
+THRESHOLD_BINS = 1000
+# Number of probability bins, and thresholds, for threshold curves
+
+_CODE_ORDER = [3, 2, 0, 1]
+# Index of each of COUNT_NAMES in bincount codes, code = 2*pred + true
+
+
+def confusion_counts(pred, true, chunk_size=CHUNK_SIZE):
+    """Per image TP/FP/TN/FN counts of boolean prediction and truth stacks
+
+    Args:
+        pred (array): N x rows x cols predicted masks, True for reservoir.
+        true (array): N x rows x cols true masks, True for reservoir.
+        chunk_size (int): Number of images per bincount pass.
+
+    Returns:
+        N x 4 int64 array of counts, in COUNT_NAMES order.
+
+    """
+    num_imgs = pred.shape[0]
+    counts = np.empty((num_imgs, 4), dtype=np.int64)
+    for start in range(0, num_imgs, chunk_size):
+        pred_chunk = np.asarray(pred[start:start + chunk_size], dtype=bool)
+        true_chunk = np.asarray(true[start:start + chunk_size], dtype=bool)
+        n = pred_chunk.shape[0]
+        codes = 2 * pred_chunk.reshape(n, -1) + true_chunk.reshape(n, -1)
+        codes = codes + 4 * np.arange(n)[:, np.newaxis]
+        chunk_counts = np.bincount(codes.ravel(), minlength=4 * n)
+        counts[start:start + n] = chunk_counts.reshape(n, 4)[:, _CODE_ORDER]
+
+    return counts
+
+
+def metrics_from_counts(counts):
+    """Accuracy metrics from confusion counts
+
+    Args:
+        counts (array): ... x 4 counts in COUNT_NAMES order, e.g. one row per
+            image or a single row of totals.
+
+    Returns:
+        Dictionary of counts and metrics, each with the leading shape of
+        counts. Undefined ratios (e.g. precision with no predictions) are nan.
+
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    tp, fp, tn, fn = [counts[..., i] for i in range(4)]
+    total = tp + fp + tn + fn
+    agree = tp + tn
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exp_agree = ((tp + fp) * (tp + fn) + (fp + tn) * (fn + tn)) / total
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        metrics = {'precision': precision,
+                   'recall': recall,
+                   'f1': 2 * precision * recall / (precision + recall),
+                   'iou': tp / (tp + fp + fn),
+                   'pfa': fp / (tp + fp),
+                   'pmd': fn / (tp + fn),
+                   'pcc': agree / total,
+                   'kappa': (agree - exp_agree) / (total - exp_agree)}
+    for name, count in zip(COUNT_NAMES, [tp, fp, tn, fn]):
+        metrics[name] = count.astype(np.int64)
+
+    return metrics
+
+
+class ThresholdHistogram(object):
+    """Histograms of predicted probability for true and false pixels
+
+    Threshold k of the curves is k / bins, and a pixel is predicted as
+    reservoir if its probability falls in bin k or above.
+
+    Attributes:
+        bins (int): Number of equal width probability bins over [0, 1].
+        hist (array): 2 x bins counts, row 0 for false and row 1 for true
+            pixels.
+
+    """
+    def __init__(self, bins=THRESHOLD_BINS):
+        self.bins = bins
+        self.hist = np.zeros((2, bins), dtype=np.int64)
+
+    def update(self, probs, true):
+        """Add pixels of probability and boolean truth arrays, in place."""
+        bin_idx = np.clip((np.asarray(probs, dtype=np.float64).ravel() *
+                           self.bins).astype(np.int64), 0, self.bins - 1)
+        true_idx = np.asarray(true, dtype=bool).ravel()
+        self.hist += np.bincount(bin_idx + self.bins * true_idx,
+                                 minlength=2 * self.bins).reshape(2, self.bins)
+
+        return
+
+    def counts(self):
+        """bins x 4 confusion counts at each threshold, as confusion_counts"""
+        # Pixels in bin k or above, for every k
+        neg_above = np.cumsum(self.hist[0, ::-1])[::-1]
+        pos_above = np.cumsum(self.hist[1, ::-1])[::-1]
+
+        return np.stack([pos_above, neg_above,
+                         self.hist[0].sum() - neg_above,
+                         self.hist[1].sum() - pos_above], axis=1)
+
+    def curves(self):
+        """Thresholds and metrics_from_counts dictionary at each threshold"""
+        thresholds = np.arange(self.bins) / self.bins
+
+        return thresholds, metrics_from_counts(self.counts())
+
+    def best_threshold(self, metric='f1'):
+        """Threshold maximizing metric, and the metric value there
+
+        Both are nan if metric is undefined at every threshold, e.g. f1 when
+        there are no true pixels.
+
+        """
+        thresholds, curves = self.curves()
+        if np.all(np.isnan(curves[metric])):
+            return float('nan'), float('nan')
+        best = np.nanargmax(curves[metric])
+
+        return float(thresholds[best]), float(curves[metric][best])
+
+    def write_csv(self, path):
+        """Write a row of counts and metrics for each threshold"""
+        thresholds, curves = self.curves()
+        names = ['precision', 'recall', 'f1', 'iou', 'kappa'] + COUNT_NAMES
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['threshold'] + names)
+            for k, threshold in enumerate(thresholds):
+                writer.writerow([threshold] + [curves[n][k] for n in names])
+
+        return
@@ -20,7 +20,12 @@ from skimage import morphology
 import random
 import argparse
 import augment_data as augment
+import chip_download
+import band_stats
+from nd_bands import ND_BANDS, normalized_diff
 import glob
+import time
+import multiprocessing
 
 # Set random seed for
 random.seed(5781)
@@ -38,6 +43,20 @@ def argparse_init():
                    help='Skip download step, just do ingestion.',
                    default=False,
                    action='store_true')
+    p.add_argument('--no-ingest',
+                   help=('Only download. Use shard_dataset.py to ingest into '
+                         'a sharded dataset instead.'),
+                   default=False,
+                   action='store_true')
+    p.add_argument('--download-workers',
+                   help=('Concurrent downloads. Files already present with '
+                         'matching size and hash are skipped.'),
+                   default=chip_download.DOWNLOAD_WORKERS,
+                   type=int)
+    p.add_argument('--bucket-dir',
+                   help='Download from this local directory instead of GCS.',
+                   default=None,
+                   type=str)
     p.add_argument('--no-val',
                    help='Don\'t create  a validation set, just train and test',
                    default=False,
@@ -46,6 +65,16 @@ def argparse_init():
                    help='Skip val and test sets, just creating a training set',
                    default=False,
                    action='store_true')
+    p.add_argument('--workers',
+                   help='Processes for loading chips. Default all cores.',
+                   default=None,
+                   type=int)
+    p.add_argument('--augment',
+                   help=('Also store a statically augmented copy of the '
+                         'training set. Only for training without train.py\'s '
+                         'on the fly augmentation, which it duplicates.'),
+                   default=False,
+                   action='store_true')
     return p
 
 
@@ -94,16 +123,6 @@ def save_empty_mask(mask_path, dim_x, dim_y):
     return None
 
 
-def normalized_diff(ar1, ar2):
-    """Returns normalized difference of two arrays."""
-
-    # Convert arrays to float32
-    ar1 = ar1.astype('float32')
-    ar2 = ar2.astype('float32')
-
-    return((ar1 - ar2) / (ar1 + ar2))
-
-
 def add_nd(imgs, band1, band2):
     """Add band containing NDWI."""
 
@@ -124,31 +143,19 @@ def add_nd(imgs, band1, band2):
     return imgs_wnd
 
 
-def download_ims_mask_pair(og_urls, mask_url, gs_bucket,
-                          destination_dir='./data/', dim_x=500, dim_y=500):
-    """Downloads original image and mask, renaming mask to match image."""
-
-    name_mask = True
-    for im_url in og_urls:
-        # Download og file from google cloud storage using gsutil
-        og_dest_file = '{}/{}'.format(destination_dir, os.path.basename(im_url))
-        og_gs_path = im_url.replace('https://storage.googleapis.com/{}/'
-                                 .format(gs_bucket.name), '')
-        blob = gs_bucket.blob(og_gs_path)
-        blob.download_to_filename(og_dest_file)
+def list_downloads(og_mask_tuples, gs_bucket_name, destination_dir='./data/'):
+    """List (bucket path, local file) pairs for all original images."""
 
-        # Using first og url (sentinel 2 10m bands) name local mask file
-        if name_mask:
-            mask_dest_file = og_dest_file.replace('og.tif', 'mask.png')
-            name_mask = False
+    path_dest_pairs = []
+    for og_mask_pair in og_mask_tuples:
+        for im_url in og_mask_pair[0:3]:
+            og_dest_file = '{}/{}'.format(destination_dir,
+                                          os.path.basename(im_url))
+            og_gs_path = im_url.replace('https://storage.googleapis.com/{}/'
+                                        .format(gs_bucket_name), '')
+            path_dest_pairs += [(og_gs_path, og_dest_file)]
 
-#     if mask_url is None:
-#         save_empty_mask(mask_dest_file, dim_x, dim_y)
-#     else:
-#         print(mask_url)
-#         urllib.request.urlretrieve(mask_url, filename=mask_dest_file)
-
-    return None
+    return path_dest_pairs
 
 
 def pad_mask(img_mask):
@@ -159,6 +166,128 @@ def pad_mask(img_mask):
     return img_mask_padded
 
 
+def load_chip(image_base, data_path, flip_names):
+    """Read mask and og images of one chip, fixing Labelbox quirks.
+
+    Returns:
+        Tuple of (img_mask, stacked og image, name of last og image).
+
+    """
+    # Prep mask
+    image_mask_name = '{}mask.png'.format(os.path.basename(image_base))
+    img_mask = io.imread(os.path.join(data_path, image_mask_name),
+                            as_grey=True)
+    img_mask = np.array(img_mask)
+    img_mask[img_mask==1] = 255
+
+    ### Labelbox quirks
+    # If only one pixel non-zero in mask, set to all 0s
+    if np.sum(img_mask) == 255:
+        img_mask[:] = 0
+
+    # Flip over 0 axis, bc labelbox decided to flip the masks
+    if '{}og.tif'.format(os.path.basename(image_base)) in flip_names:
+        print('flipping','{}og.tif'.format(image_base), image_mask_name)
+        img_mask = np.flip(img_mask, axis=0)
+
+    og_img_list = []
+    for og_img in sorted(glob.glob('{}*og.tif'.format(image_base))):
+        # Using sorted, the order is: s2 10m, s1 10m, s2 20m.
+        img = io.imread(og_img, as_grey=False)
+        img = np.array(img)
+        og_img_list += [img]
+
+    return img_mask, np.dstack(og_img_list), os.path.basename(og_img)
+
+
+_ingest = {}
+# Per worker process state for ingest_chip, set by init_ingest
+
+
+def init_ingest(imgs_path, masks_path, data_path, flip_names):
+    """Pool initializer opening the output arrays once per worker."""
+    _ingest['imgs'] = np.load(imgs_path, mmap_mode='r+')
+    _ingest['imgs_mask'] = np.load(masks_path, mmap_mode='r+')
+    _ingest['data_path'] = data_path
+    _ingest['flip_names'] = flip_names
+
+
+def ingest_chip(task):
+    """Load chip i and write it to index i of the output arrays."""
+    i, image_base = task
+    img_mask, img, og_img_name = load_chip(
+        image_base, _ingest['data_path'], _ingest['flip_names'])
+    _ingest['imgs_mask'][i] = img_mask
+    _ingest['imgs'][i, :, :, :img.shape[2]] = img
+
+    return i, og_img_name
+
+
+def ingest_chips(image_patterns, imgs_path, masks_path, data_path, flip_names,
+                 workers=None):
+    """Load all chips into the preallocated arrays with a process pool.
+
+    Returns:
+        List of og image names, in the same order as image_patterns.
+
+    """
+    total_ims = len(image_patterns)
+    tasks = list(enumerate(image_patterns))
+    init_args = (imgs_path, masks_path, data_path, flip_names)
+    og_img_names = [None] * total_ims
+
+    start_time = time.time()
+    if workers == 1:
+        init_ingest(*init_args)
+        results = map(ingest_chip, tasks)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=init_ingest,
+                                    initargs=init_args)
+        results = pool.imap_unordered(ingest_chip, tasks, chunksize=8)
+
+    done = 0
+    for i, og_img_name in results:
+        og_img_names[i] = og_img_name
+        done += 1
+        if done % 100 == 0 or done == total_ims:
+            elapsed = time.time() - start_time
+            print('Done: {}/{} images ({:.1f} images/s)'.format(
+                done, total_ims, done / elapsed))
+
+    if workers != 1:
+        pool.close()
+        pool.join()
+    else:
+        _ingest['imgs'].flush()
+        _ingest['imgs_mask'].flush()
+
+    return og_img_names
+
+
+def fill_nd(imgs, band1, band2, out_band, chunk_size=256):
+    """Write normalized difference of two bands to out_band, in place.
+
+    Same values as add_nd, but computed in chunks into a preallocated band
+    instead of appending to a copy of the whole array.
+
+    """
+    nd_min = np.inf
+    nd_max = -np.inf
+    for start in range(0, imgs.shape[0], chunk_size):
+        nd = normalized_diff(imgs[start:start + chunk_size, :, :, band1],
+                             imgs[start:start + chunk_size, :, :, band2])
+        nd_min = min(nd_min, nd.min())
+        nd_max = max(nd_max, nd.max())
+
+    for start in range(0, imgs.shape[0], chunk_size):
+        nd = normalized_diff(imgs[start:start + chunk_size, :, :, band1],
+                             imgs[start:start + chunk_size, :, :, band2])
+        nd = 65535 * (nd - nd_min) / (nd_max - nd_min)
+        imgs[start:start + chunk_size, :, :, out_band] = nd.astype(np.uint16)
+
+    return
+
+
 def split_train_test(imgs, imgs_mask, img_names, test_frac, val_frac):
     """Split data into train, test, val (or just train)
 
@@ -238,82 +367,68 @@ def write_prepped_data(data_path, img_dict, mask_dict, name_dict):
 
 
 def create_train_test_data(dim_x=500, dim_y=500, nbands=12, data_path='./data/',
-                           test_frac=0.2, val_frac=0.2):
-    """Save training and test data into easy .npy file"""
+                           test_frac=0.2, val_frac=0.2, augment=False,
+                           workers=None):
+    """Save training and test data into easy .npy file
+
+    Chips are decoded by a pool of `workers` processes, each writing straight
+    into memory-mapped output arrays by chip index, so the result does not
+    depend on the number of workers.
+
+    """
     flip_names = [line.rstrip('\n') for line in open('flip_names.txt')]
 
 
     # Get mask image names and base image patterns
-    mask_images = glob.glob('{}*mask.png'.format(data_path))
+    mask_images = sorted(glob.glob('{}*mask.png'.format(data_path)))
     image_patterns = [mi.replace('mask.png', '') for mi in mask_images]
 
     total_ims = len(mask_images)
 
-    imgs = np.ndarray((total_ims, dim_x, dim_y, nbands), dtype=np.uint16)
-    imgs_mask = np.ndarray((total_ims, dim_x, dim_y), dtype=np.uint8)
+    # Preallocate on disk, with room for the 4 normalized difference bands
+    ingest_path = '{}/prepped/'.format(data_path)
+    if not os.path.isdir(ingest_path):
+        os.makedirs(ingest_path)
+    imgs_path = '{}ingest_imgs.npy'.format(ingest_path)
+    masks_path = '{}ingest_masks.npy'.format(ingest_path)
+    imgs = np.lib.format.open_memmap(
+        imgs_path, mode='w+', dtype=np.uint16,
+        shape=(total_ims, dim_x, dim_y, nbands + len(ND_BANDS)))
+    imgs_mask = np.lib.format.open_memmap(
+        masks_path, mode='w+', dtype=np.uint8, shape=(total_ims, dim_x, dim_y))
 
-    i = 0
     print('-'*30)
     print('Loading images')
     print('-'*30)
-    og_img_names = []
-    for image_base in image_patterns:
-
-        # Prep mask
-        image_mask_name = '{}mask.png'.format(os.path.basename(image_base))
-        img_mask = io.imread(os.path.join(data_path, image_mask_name),
-                                as_grey=True)
-        img_mask = np.array(img_mask)
-        img_mask[img_mask==1] = 255
-
-        ### Labelbox quirks
-        # If only one pixel non-zero in mask, set to all 0s
-        if np.sum(img_mask) == 255:
-            img_mask[:] = 0
-
-        # Flip over 0 axis, bc labelbox decided to flip the masks
-        if '{}og.tif'.format(os.path.basename(image_base)) in flip_names:
-            print('flipping','{}og.tif'.format(image_base), image_mask_name)
-            img_mask = np.flip(img_mask, axis=0)
-
-        imgs_mask[i] = img_mask
-
-        og_img_list = []
-        for og_img in sorted(glob.glob('{}*og.tif'.format(image_base))):
-            # Using sorted, the order is: s2 10m, s1 10m, s2 20m.
-            img = io.imread(og_img, as_grey=False)
-            img = np.array(img)
-            og_img_list += [img]
-
-        imgs[i] = np.dstack(og_img_list)
-
-        if i % 100 == 0:
-            print('Done: {}/{} images'.format(i, total_ims))
-        i += 1
-
-        og_img_names += [os.path.basename(og_img)]
-
+    og_img_names = ingest_chips(image_patterns, imgs_path, masks_path,
+                                data_path, flip_names, workers)
     print('Loading done.')
 
-    # Add  Gao NDWI
-    imgs = add_nd(imgs, 3, 11)
-    # Add  MNDWI
-    imgs = add_nd(imgs, 1, 11)
-    # Add McFeeters NDWI band
-    imgs = add_nd(imgs, 1, 3)
-    # Add NDVI band
-    imgs = add_nd(imgs, 3, 2)
+    # Add Gao NDWI, MNDWI, McFeeters NDWI and NDVI bands
+    for nd_i, (band1, band2) in enumerate(ND_BANDS):
+        fill_nd(imgs, band1, band2, nbands + nd_i)
+    imgs.flush()
 
     # Split into training, test, val
     img_dict, mask_dict, name_dict = split_train_test(
         imgs, imgs_mask, og_img_names, test_frac, val_frac)
 
+    # Band statistics of training chips, in one streaming pass
+    train_stats = band_stats.BandStats.from_images(img_dict['train'])
+
     # Augment training data
-    img_dict['train'], mask_dict['train'] = augment_all_training(
-        img_dict['train'], mask_dict['train'])
+    if augment:
+        img_dict['train'], mask_dict['train'] = augment_all_training(
+            img_dict['train'], mask_dict['train'])
 
     # Write images
     write_prepped_data(data_path, img_dict, mask_dict, name_dict)
+    band_stats.write_stats(train_stats, ingest_path)
+
+    # Remove ingestion arrays
+    del imgs, imgs_mask, img_dict, mask_dict
+    os.remove(imgs_path)
+    os.remove(masks_path)
 
 
 def main():
@@ -325,12 +440,20 @@ def main():
     if not args.no_download:
         og_mask_tuples, gs_bucket_name = find_ims_masks(args.labelbox_json)
 
-        # Download imgs using Google Cloud Storage client
-        storage_client = storage.Client()
-        gs_bucket = storage_client.get_bucket(gs_bucket_name)
-        for og_mask_pair in og_mask_tuples:
-            download_ims_mask_pair(og_mask_pair[0:3], og_mask_pair[3],
-                                   gs_bucket)
+        # Download imgs using Google Cloud Storage client, or a local
+        # directory laid out like the bucket
+        if args.bucket_dir is None:
+            storage_client = storage.Client()
+            backend = chip_download.GCSBackend(
+                storage_client.get_bucket(gs_bucket_name))
+        else:
+            backend = chip_download.LocalBackend(args.bucket_dir)
+        downloader = chip_download.ChipDownloader(
+            backend, workers=args.download_workers)
+        downloader.download_all(list_downloads(og_mask_tuples, gs_bucket_name))
+
+    if args.no_ingest:
+        return
 
     val_frac = 0.2
     test_frac = 0.2
@@ -340,7 +463,8 @@ def main():
     if args.no_val:
         val_frac = 0
 
-    create_train_test_data(val_frac=val_frac, test_frac=test_frac)
+    create_train_test_data(val_frac=val_frac, test_frac=test_frac,
+                           augment=args.augment, workers=args.workers)
 
     return
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""Disk cache of preprocessed training tensors
+
+Band selection, resizing, float conversion, mask thresholding and scaling
+give the same result every time for a given dataset, band selection and
+geometry. This cache stores those float32 tensors as .npy files that are
+memory-mapped on use, so only the first run of a grid search pays for
+preprocessing. Entries are evicted least recently used first when the cache
+grows past its disk budget.
+
+Example:
+    >>> cache = PreprocessCache('./data/cache/')
+    >>> mean, std = cache.get_stats('./data/prepped/', band_selection)
+    >>> imgs, masks = cache.get_split('./data/prepped/', 'train',
+    ...                               band_selection, mean, std)
+
+"""
+
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+import data_loader
+import shard_dataset
+
+CACHE_BUDGET = 100e9
+# Disk budget for all cache entries, in bytes
+
+CHUNK_SIZE = 32
+# Number of images preprocessed at a time when building an entry
+
+
+def dataset_version(prepped_dir):
+    """String identifying the current contents of a prepped directory
+
+    Uses the manifest hash for sharded datasets, otherwise the size and
+    modification time of the .npy files.
+
+    """
+    if shard_dataset.is_sharded(prepped_dir):
+        manifest_path = os.path.join(prepped_dir, shard_dataset.MANIFEST_NAME)
+        with open(manifest_path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    parts = []
+    for npy in sorted(os.listdir(prepped_dir)):
+        if npy.endswith('.npy'):
+            st = os.stat(os.path.join(prepped_dir, npy))
+            parts += ['{}:{}:{}'.format(npy, st.st_size, st.st_mtime_ns)]
+
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def cache_key(**params):
+    """Hash of the parameters that determine an entry"""
+    key_json = json.dumps(params, sort_keys=True)
+
+    return hashlib.sha1(key_json.encode('utf-8')).hexdigest()[:16]
+
+
+class PreprocessCache(object):
+    """Directory of preprocessed tensors with LRU eviction
+
+    Each entry is a subdirectory named by its key holding meta.json and
+    either imgs.npy/masks.npy or band statistics. Entries are built in a
+    temporary directory and renamed into place, under a lock so concurrent
+    trials do not build the same entry twice.
+
+    Attributes:
+        cache_dir (str): Cache directory.
+        budget (float): Disk budget in bytes.
+
+    """
+    def __init__(self, cache_dir, budget=CACHE_BUDGET):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lock(self, key):
+        """Exclusive lock on building one entry. Caller closes the file."""
+        lock_file = open(os.path.join(self.cache_dir,
+                                      '{}.lock'.format(key)), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        return lock_file
+
+    def meta_path(self, key):
+        return os.path.join(self.entry_path(key), 'meta.json')
+
+    def touch(self, key):
+        """Record use of an entry, for LRU eviction. False if missing."""
+        try:
+            os.utime(self.meta_path(key))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def get_or_build(self, key, meta, build):
+        """Return path of entry key, calling build(tmp_dir) if missing.
+
+        An entry evicted by another process after it was found is treated
+        as missing and built again.
+
+        """
+        path = self.entry_path(key)
+        while True:
+            if not os.path.isfile(self.meta_path(key)):
+                lock_file = self.lock(key)
+                try:
+                    if not os.path.isfile(self.meta_path(key)):
+                        self.build_entry(key, meta, build)
+                finally:
+                    lock_file.close()
+            if self.touch(key):
+                return path
+
+    def build_entry(self, key, meta, build):
+        """Build entry key in a temporary directory and rename it in place"""
+        path = self.entry_path(key)
+        print('Building preprocess cache entry {}'.format(key))
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        build(tmp_path)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp, sort_keys=True, indent=4)
+        # Remains of an entry being evicted by another process
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        self.evict(keep=key)
+
+        return
+
+    def get_stats(self, prepped_dir, band_selection,
+                  resize_dims=data_loader.RESIZE_DIMS):
+        """Mean and std of the training split for a band selection"""
+        meta = {'kind': 'stats',
+                'dataset_version': dataset_version(prepped_dir),
+                'band_selection': list(band_selection),
+                'resize_dims': list(resize_dims)}
+        key = cache_key(**meta)
+
+        def build(tmp_path):
+            imgs, _ = data_loader.load_prepped(prepped_dir, 'train')
+            mean, std = data_loader.compute_mean_std(imgs, band_selection,
+                                                     resize_dims)
+            np.save(os.path.join(tmp_path, 'mean_std.npy'),
+                    np.vstack((mean, std)))
+
+        path = self.get_or_build(key, meta, build)
+        mean_std = np.load(os.path.join(path, 'mean_std.npy'))
+
+        return mean_std[0], mean_std[1]
+
+    def get_split(self, prepped_dir, split, band_selection, mean, std,
+                  resize_dims=data_loader.RESIZE_DIMS):
+        """Memory-mapped float32 (imgs, masks) ready for training
+
+        Images are band selected, resized and scaled by mean and std; masks
+        are resized and thresholded to 0/1.
+
+        """
+        meta = {'kind': 'split',
+                'dataset_version': dataset_version(prepped_dir),
+                'split': split,
+                'band_selection': list(band_selection),
+                'resize_dims': list(resize_dims),
+                'mean': [float(m) for m in mean],
+                'std': [float(s) for s in std]}
+        key = cache_key(**meta)
+
+        def build(tmp_path):
+            imgs, masks = data_loader.load_prepped(prepped_dir, split)
+            imgs_out = np.lib.format.open_memmap(
+                os.path.join(tmp_path, 'imgs.npy'), mode='w+',
+                dtype=np.float32,
+                shape=(imgs.shape[0], resize_dims[0], resize_dims[1],
+                       len(band_selection)))
+            masks_out = np.lib.format.open_memmap(
+                os.path.join(tmp_path, 'masks.npy'), mode='w+',
+                dtype=np.float32,
+                shape=(masks.shape[0], resize_dims[0], resize_dims[1], 1))
+            for start in range(0, imgs.shape[0], CHUNK_SIZE):
+                chunk = np.arange(start, min(start + CHUNK_SIZE,
+                                             imgs.shape[0]))
+                imgs_p, masks_p = data_loader.preprocess_batch(
+                    imgs[chunk], masks[chunk], band_selection, resize_dims)
+                imgs_p -= np.asarray(mean, dtype=np.float32)
+                imgs_p /= np.asarray(std, dtype=np.float32)
+                imgs_out[chunk] = imgs_p
+                masks_out[chunk] = masks_p
+            imgs_out.flush()
+            masks_out.flush()
+
+        path = self.get_or_build(key, meta, build)
+
+        return (np.load(os.path.join(path, 'imgs.npy'), mmap_mode='r'),
+                np.load(os.path.join(path, 'masks.npy'), mmap_mode='r'))
+
+    def entries(self):
+        """List of (last used time, size in bytes, key) of all entries"""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = self.entry_path(key)
+            meta_path = self.meta_path(key)
+            if not os.path.isfile(meta_path):
+                continue
+            # Entries may be evicted by another process while listed
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f))
+                           for f in os.listdir(path))
+                entries += [(os.path.getmtime(meta_path), size, key)]
+            except FileNotFoundError:
+                continue
+
+        return entries
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until within budget."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            print('Evicting preprocess cache entry {}'.format(key))
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+
+        return
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""Structured filter pruning of a trained U-Net
+
+Filters of every convolution with at least min_filters filters are ranked,
+either by the L1 norm of their kernels or by their mean absolute activation
+on validation images, and the lowest ranked fraction is removed. Removed
+filters are cut out of the layer's kernel and bias and out of the input
+channels of every layer that consumes them, including the skip connection
+channels of the decoder's concatenations. The result is a smaller, dense
+U-Net built by train.get_unet with per layer filter counts, which is then
+fine-tuned and compared with the original.
+
+Outputs are written like train.train's (unet_10band.txt, weights.h5,
+mean_std.npy), so predict_map.py and export_model.py can use the pruned
+model directly. prune_report.json has speed and metric deltas.
+
+Example:
+    python3 prune_unet.py ./model/ ./pruned/ --ratio 0.5 --min-filters 256
+
+"""
+
+
+import os
+import json
+import argparse
+import numpy as np
+from keras.layers import Conv2D, Conv2DTranspose
+from keras.models import Model
+from keras.callbacks import ModelCheckpoint, EarlyStopping
+import loss_functions as lf
+import data_loader
+import nd_bands
+import batch_augment
+import distill
+import train
+
+CRITERIA = ['magnitude', 'activation']
+# Ways of ranking filters
+
+CALIB_IMAGES = 16
+# Validation images used for activation statistics
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Prune filters of a trained U-Net and fine-tune.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('model_dir',
+                   help=('Directory with unet_10band.txt, weights.h5 and '
+                         'mean_std.npy.'),
+                   type=str)
+    p.add_argument('out_dir',
+                   help='Output directory for the pruned model.',
+                   type=str)
+    p.add_argument('--ratio',
+                   help='Fraction of filters removed from pruned layers.',
+                   default=0.5,
+                   type=float)
+    p.add_argument('--min-filters',
+                   help='Only prune layers with at least this many filters.',
+                   default=256,
+                   type=int)
+    p.add_argument('--criterion',
+                   help='How filters are ranked.',
+                   choices=CRITERIA,
+                   default='magnitude',
+                   type=str)
+    p.add_argument('--lr',
+                   help='Fine-tuning learning rate.',
+                   default=2e-5,
+                   type=float)
+    p.add_argument('--loss',
+                   help='Loss, a name in loss_functions.py or Keras.',
+                   default='dice_coef_wgt_loss',
+                   type=str)
+    p.add_argument('--epochs',
+                   help='Maximum fine-tuning epochs.',
+                   default=20,
+                   type=int)
+    p.add_argument('--bands',
+                   help='Comma separated band selection of the model.',
+                   default='0,1,2,3,4,5,12,13,14,15',
+                   type=str)
+    p.add_argument('--prepped-dir',
+                   help='Prepped .npy or sharded dataset directory.',
+                   default=train.PREPPED_DIR,
+                   type=str)
+    return p
+
+
+def conv_layers(model):
+    """Convolution layers of a get_unet model, in creation order"""
+    return [layer for layer in model.layers
+            if isinstance(layer, (Conv2D, Conv2DTranspose))]
+
+
+def is_transpose(layer):
+    return isinstance(layer, Conv2DTranspose)
+
+
+def out_axis(transpose):
+    """Kernel axis of output filters: Conv2DTranspose kernels are
+    rows x cols x out x in, Conv2D kernels rows x cols x in x out."""
+    return 2 if transpose else 3
+
+
+def magnitude_scores(kernel, transpose):
+    """L1 norm of each output filter's kernel"""
+    axes = tuple(a for a in range(4) if a != out_axis(transpose))
+    return np.abs(kernel).sum(axis=axes)
+
+
+def activation_scores(model, layers, imgs):
+    """Mean absolute activation of each filter of layers over imgs"""
+    probe = Model(inputs=model.inputs, outputs=[l.output for l in layers])
+    scores = [np.zeros(l.get_weights()[0].shape[out_axis(is_transpose(l))])
+              for l in layers]
+    for i in range(imgs.shape[0]):
+        # One image at a time, since all activations are held at once
+        activations = probe.predict_on_batch(imgs[i:i + 1])
+        for score, act in zip(scores, activations):
+            score += np.abs(act).mean(axis=(0, 1, 2)) / imgs.shape[0]
+
+    return scores
+
+
+def keep_indices(scores, ratio, min_filters):
+    """Sorted indices of the filters kept, the highest scoring"""
+    num_filters = scores.shape[0]
+    if num_filters < min_filters:
+        return np.arange(num_filters)
+    num_keep = max(1, int(round(num_filters * (1 - ratio))))
+
+    return np.sort(np.argsort(scores)[::-1][:num_keep])
+
+
+def prune_weights(weights, transposes, keeps, nbands, depth):
+    """Slice kernels and biases of a get_unet network to kept filters
+
+    Follows get_unet's topology: each encoder level's second convolution is
+    also a skip connection concatenated after the matching decoder level's
+    transposed convolution.
+
+    Args:
+        weights (list): (kernel, bias) of every convolution in creation
+            order, including the final 1x1 convolution.
+        transposes (list): Whether each convolution is transposed.
+        keeps (list): Kept filter indices of every convolution but the last.
+        nbands (int): Number of input bands.
+        depth (int): Number of poolings of the network.
+
+    Returns:
+        List of sliced (kernel, bias), in the same order.
+
+    """
+    keeps = list(keeps) + [np.arange(weights[-1][1].shape[0])]
+    pruned = []
+    layer = iter(range(len(weights)))
+
+    def slice_layer(i, in_idx):
+        kernel, bias = weights[i]
+        o_axis = out_axis(transposes[i])
+        i_axis = 5 - o_axis
+        if in_idx.max() >= kernel.shape[i_axis]:
+            raise ValueError('Layer {} does not match the U-Net '
+                             'structure'.format(i))
+        kernel = np.take(np.take(kernel, in_idx, axis=i_axis), keeps[i],
+                         axis=o_axis)
+        pruned.append((kernel, bias[keeps[i]]))
+        return keeps[i]
+
+    prev = np.arange(nbands)
+    skips = []
+    for _ in range(depth):
+        prev = slice_layer(next(layer), prev)
+        prev = slice_layer(next(layer), prev)
+        skips += [prev]
+
+    prev = slice_layer(next(layer), prev)
+    prev = slice_layer(next(layer), prev)
+
+    for skip_keep in skips[::-1]:
+        i = next(layer)
+        up_keep = slice_layer(i, prev)
+        # Concatenation of transposed convolution output and skip channels
+        concat = np.concatenate([up_keep,
+                                 weights[i][1].shape[0] + skip_keep])
+        prev = slice_layer(next(layer), concat)
+        prev = slice_layer(next(layer), prev)
+
+    slice_layer(next(layer), prev)
+
+    return pruned
+
+
+def prune(model_dir, out_dir, band_selection, ratio=0.5, min_filters=256,
+          criterion='magnitude', learn_rate=2e-5,
+          loss_func=lf.dice_coef_wgt_loss, epochs=20,
+          prepped_dir=train.PREPPED_DIR):
+    """Prune, fine-tune and compare a model with the original.
+
+    Returns:
+        Report dictionary with original and pruned metrics and speed.
+
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    mean_std = np.load(os.path.join(model_dir, 'mean_std.npy'))
+    np.save(os.path.join(out_dir, 'mean_std.npy'), mean_std)
+    nd_bands.write_nd_scaling(out_dir, data_loader.nd_scaling(prepped_dir))
+    mean, std = mean_std[0], mean_std[1]
+
+    original = distill.load_model(model_dir)
+    layers = conv_layers(original)
+    transposes = [is_transpose(l) for l in layers]
+    depth = (len(layers) - 3) // 5
+    if len(layers) != 5 * depth + 3:
+        raise ValueError('{} convolutions is not a get_unet '
+                         'network'.format(len(layers)))
+
+    # If no val set, test data is used for calibration and early stopping
+    val_split = 'val'
+    if not data_loader.has_split(prepped_dir, 'val'):
+        val_split = 'test'
+
+    print('-'*30)
+    print('Ranking filters by {}...'.format(criterion))
+    print('-'*30)
+    if criterion == 'magnitude':
+        scores = [magnitude_scores(l.get_weights()[0], t)
+                  for l, t in zip(layers[:-1], transposes)]
+    else:
+        val_seq = train.make_sequence(prepped_dir, val_split, band_selection,
+                                      mean, std)
+        num_batches = int(np.ceil(CALIB_IMAGES / val_seq.batch_size))
+        imgs = np.concatenate([val_seq[i][0] for i in
+                               range(min(num_batches, len(val_seq)))])
+        scores = activation_scores(original, layers[:-1],
+                                   imgs[:CALIB_IMAGES])
+    keeps = [keep_indices(s, ratio, min_filters) for s in scores]
+
+    pruned_weights = prune_weights([tuple(l.get_weights()) for l in layers],
+                                   transposes, keeps, len(band_selection),
+                                   depth)
+    layer_filters = [k.size for k in keeps]
+    print('Filters: {} -> {}'.format([s.size for s in scores],
+                                     layer_filters))
+
+    model = train.get_unet(
+        train.RESIZE_ROWS, train.RESIZE_COLS, len(band_selection), loss_func,
+        learn_rate, structure_path=os.path.join(out_dir, 'unet_10band.txt'),
+        depth=depth, layer_filters=layer_filters)
+    for layer, layer_weights in zip(conv_layers(model), pruned_weights):
+        layer.set_weights(list(layer_weights))
+
+    print('-'*30)
+    print('Fine-tuning pruned model...')
+    print('-'*30)
+    train_seq = train.make_sequence(prepped_dir, 'train', band_selection,
+                                    mean, std,
+                                    augmenter=batch_augment.BatchAugmenter())
+    val_seq = train.make_sequence(prepped_dir, val_split, band_selection,
+                                  mean, std)
+    weights_path = os.path.join(out_dir, 'weights.h5')
+    model.save_weights(weights_path)
+    model.fit(train_seq, epochs=epochs, verbose=2, shuffle=False,
+              validation_data=val_seq,
+              callbacks=[ModelCheckpoint(weights_path, monitor='val_loss',
+                                         mode='min', save_best_only=True),
+                         EarlyStopping(monitor='val_loss', patience=5,
+                                       mode='min')],
+              workers=train.WORKERS, use_multiprocessing=False,
+              max_queue_size=train.MAX_QUEUE_SIZE)
+    model.load_weights(weights_path)
+
+    print('-'*30)
+    print('Comparing original and pruned on test data...')
+    print('-'*30)
+    test_seq = train.make_sequence(prepped_dir, 'test', band_selection,
+                                   mean, std)
+    report = {'original': distill.evaluate(original, test_seq),
+              'pruned': distill.evaluate(model, test_seq),
+              'layer_filters': layer_filters, 'ratio': ratio,
+              'min_filters': min_filters, 'criterion': criterion}
+    report['speedup'] = (report['pruned']['tiles_per_sec'] /
+                         report['original']['tiles_per_sec'])
+    for metric in ['f1', 'iou', 'params']:
+        report['{}_change'.format(metric)] = (report['pruned'][metric] -
+                                              report['original'][metric])
+    with open(os.path.join(out_dir, 'prune_report.json'), 'w') as fp:
+        json.dump(report, fp, sort_keys=True, indent=4)
+    print(report)
+
+    return report
+
+
+def main():
+
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    prune(args.model_dir, args.out_dir,
+          [int(b) for b in args.bands.split(',')], ratio=args.ratio,
+          min_filters=args.min_filters, criterion=args.criterion,
+          learn_rate=args.lr, loss_func=getattr(lf, args.loss, args.loss),
+          epochs=args.epochs, prepped_dir=args.prepped_dir)
+
+    return
+
+
+if __name__=='__main__':
+    main()
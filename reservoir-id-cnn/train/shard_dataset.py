@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Incremental, sharded prepped dataset
+
+Instead of rebuilding monolithic imgs_{split}.npy files for every Labelbox
+export, chips are stored in append-only shards described by a manifest.
+Each update only ingests chips that are new or whose source files changed,
+writing them to a new shard.
+
+Every chip is assigned to train/val/test by a hash of its name, so the
+assignment is stable across rebuilds and does not depend on which other
+chips exist. Readers memory-map shards and can fetch single samples.
+
+Band statistics of every chip are stored in its manifest record and merged
+into per split statistics (see band_stats.py), so replacing a changed chip
+updates them without a pass over the other chips.
+
+Example:
+    Download chips, then add new ones to the sharded dataset:
+    $ python3 prep_train_test.py labelbox.json --no-ingest
+    $ python3 shard_dataset.py ./data/ ./data/shards/
+
+Notes:
+    Normalized difference bands are scaled from their fixed [-1, 1] range to
+    uint16, not from the min and max of the whole dataset as in
+    prep_train_test.add_nd, so that stored chips never need rescaling when
+    new chips are added. The manifest records this as nd_scaling, and models
+    trained on the dataset are marked to be predicted with it (see
+    nd_bands.py).
+
+"""
+
+
+import os
+import glob
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import nd_bands
+from band_stats import BandStats
+from chip_download import file_md5
+
+MANIFEST_NAME = 'manifest.json'
+# Name of manifest file in the dataset directory
+
+REGION_COLUMNS = ['state', 'ecoregion', 'biome']
+# Columns of the regions csv recorded for each chip
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Add new chips to a sharded prepped dataset.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('data_path',
+                   help='Directory with downloaded chips and masks.',
+                   type=str)
+    p.add_argument('out_dir',
+                   help='Sharded dataset directory.',
+                   type=str)
+    p.add_argument('--test-frac',
+                   help='Fraction of chips assigned to test.',
+                   default=0.2,
+                   type=float)
+    p.add_argument('--val-frac',
+                   help='Fraction of chips assigned to val.',
+                   default=0.2,
+                   type=float)
+    p.add_argument('--regions',
+                   help=('CSV with filename and {} columns, such as '
+                         'centers_ecoregions_states.csv.'
+                         .format('/'.join(REGION_COLUMNS))),
+                   default=None,
+                   type=str)
+    p.add_argument('--workers',
+                   help='Processes for loading chips. Default all cores.',
+                   default=None,
+                   type=int)
+    return p
+
+
+def assign_split(name, test_frac, val_frac):
+    """Stable split for a chip name, from a hash of the name"""
+    hash_frac = int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:8], 16)
+    hash_frac /= 2.0**32
+    if hash_frac < test_frac:
+        return 'test'
+    elif hash_frac < test_frac + val_frac:
+        return 'val'
+    else:
+        return 'train'
+
+
+def source_hashes(image_base):
+    """md5 of the mask and each original image of a chip"""
+    paths = (['{}mask.png'.format(image_base)] +
+             sorted(glob.glob('{}*og.tif'.format(image_base))))
+
+    return {os.path.basename(p): file_md5(p) for p in paths}
+
+
+def write_json_atomic(obj, path):
+    """Write json to a temporary file and rename it over path"""
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(obj, fp, sort_keys=True, indent=4)
+    os.replace(tmp_path, path)
+
+    return
+
+
+class ShardedArray(object):
+    """Array-like view over the images or masks of a list of chips
+
+    Supports len, shape and indexing with an int, slice or index array, so
+    it can be used in place of a memory-mapped .npy file.
+
+    Attributes:
+        dataset (ShardedDataset): Dataset the chips belong to.
+        records (list): Manifest chip records, in view order.
+        kind (str): 'imgs' or 'masks'.
+
+    """
+    def __init__(self, dataset, records, kind):
+        self.dataset = dataset
+        self.records = records
+        self.kind = kind
+        sample_shape = dataset.sample_shape(kind)
+        self.shape = (len(records),) + sample_shape
+        self.dtype = np.uint16 if kind == 'imgs' else np.uint8
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            rec = self.records[key]
+            return np.asarray(self.dataset.shard(rec['shard'], self.kind)
+                              [rec['index']])
+
+        if isinstance(key, slice):
+            indices = range(*key.indices(len(self.records)))
+        else:
+            indices = np.asarray(key)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for i, idx in enumerate(indices):
+            out[i] = self[int(idx)]
+
+        return out
+
+
+class ShardedDataset(object):
+    """Sharded prepped dataset described by a manifest
+
+    Attributes:
+        root (str): Dataset directory.
+        manifest (dict): Parsed manifest, see update().
+
+    """
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as fp:
+                self.manifest = json.load(fp)
+        else:
+            self.manifest = {'version': 1, 'shards': [], 'chips': []}
+        self.shards = {}
+
+    def sample_shape(self, kind):
+        shape = tuple(self.manifest['dims'])
+        if kind == 'imgs':
+            shape += (self.manifest['nbands'],)
+        return shape
+
+    def shard(self, shard_name, kind):
+        """Memory-mapped imgs or masks array of a shard"""
+        key = (shard_name, kind)
+        if key not in self.shards:
+            self.shards[key] = np.load(
+                os.path.join(self.root, '{}_{}.npy'.format(shard_name, kind)),
+                mmap_mode='r')
+        return self.shards[key]
+
+    def records(self, split=None):
+        return [rec for rec in self.manifest['chips']
+                if split is None or rec['split'] == split]
+
+    def load_split(self, split):
+        """Array-like (imgs, masks) views of one split"""
+        records = self.records(split)
+        return (ShardedArray(self, records, 'imgs'),
+                ShardedArray(self, records, 'masks'))
+
+    def names(self, split):
+        return [rec['name'] for rec in self.records(split)]
+
+    def nd_scaling(self):
+        """Scaling of the dataset's normalized difference bands"""
+        return self.manifest.get('nd_scaling', 'fixed')
+
+    def band_stats(self, split):
+        """BandStats of a split stored in the manifest, or None"""
+        stats = self.manifest.get('band_stats', {}).get(split)
+        if stats is None:
+            return None
+        return BandStats.from_dict(stats)
+
+    def merge_band_stats(self):
+        """Per split BandStats from the statistics of each chip
+
+        Statistics missing from records written before they were stored are
+        computed from the shards and added to the records.
+
+        """
+        nbands = self.manifest['nbands']
+        split_stats = {}
+        for rec in self.manifest['chips']:
+            if 'band_stats' not in rec:
+                shard_imgs = self.shard(rec['shard'], 'imgs')
+                rec['band_stats'] = BandStats.from_images(
+                    shard_imgs[rec['index']:rec['index'] + 1]).to_dict()
+            stats = split_stats.setdefault(rec['split'], BandStats(nbands))
+            stats.merge(BandStats.from_dict(rec['band_stats']))
+
+        return {split: stats.to_dict() for split, stats in split_stats.items()}
+
+    def update(self, data_path, test_frac=0.2, val_frac=0.2, regions=None,
+               dim_x=500, dim_y=500, nbands=12, workers=None):
+        """Ingest new or changed chips from data_path into a new shard.
+
+        Returns:
+            Number of chips ingested.
+
+        """
+        # Only needed for ingest, and slow to import with side effects
+        import prep_train_test as ptt
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        flip_names = [line.rstrip('\n') for line in open('flip_names.txt')]
+
+        # Find chips that are new or whose source files changed
+        known = {rec['image_base']: rec for rec in self.manifest['chips']}
+        mask_images = sorted(glob.glob('{}*mask.png'.format(data_path)))
+        todo = []
+        for mask_image in mask_images:
+            image_base = os.path.basename(mask_image.replace('mask.png', ''))
+            hashes = source_hashes(mask_image.replace('mask.png', ''))
+            rec = known.get(image_base)
+            if rec is None or rec['sources'] != hashes:
+                todo += [(image_base, hashes)]
+        print('{} new or changed chips'.format(len(todo)))
+        if len(todo) == 0:
+            return 0
+
+        # Ingest into a new shard
+        shard_name = 'shard_{:05d}'.format(len(self.manifest['shards']))
+        imgs_path = os.path.join(self.root, '{}_imgs.npy'.format(shard_name))
+        masks_path = os.path.join(self.root, '{}_masks.npy'.format(shard_name))
+        imgs = np.lib.format.open_memmap(
+            imgs_path, mode='w+', dtype=np.uint16,
+            shape=(len(todo), dim_x, dim_y, nbands + len(nd_bands.ND_BANDS)))
+        np.lib.format.open_memmap(
+            masks_path, mode='w+', dtype=np.uint8,
+            shape=(len(todo), dim_x, dim_y)).flush()
+        image_patterns = [os.path.join(data_path, image_base)
+                          for image_base, _ in todo]
+        og_img_names = ptt.ingest_chips(image_patterns, imgs_path, masks_path,
+                                        data_path, flip_names, workers)
+        for nd_i, (band1, band2) in enumerate(nd_bands.ND_BANDS):
+            nd_bands.fill_nd_fixed(imgs, band1, band2, nbands + nd_i)
+        imgs.flush()
+        chip_stats = [BandStats.from_images(imgs[i:i + 1]).to_dict()
+                      for i in range(imgs.shape[0])]
+        del imgs
+
+        # Update manifest, replacing records of changed chips
+        region_df = None
+        if regions is not None:
+            region_df = pd.read_csv(regions).set_index('filename')
+        todo_bases = set(image_base for image_base, _ in todo)
+        chips = [rec for rec in self.manifest['chips']
+                 if rec['image_base'] not in todo_bases]
+        for i, ((image_base, hashes), name, stats) in enumerate(
+                zip(todo, og_img_names, chip_stats)):
+            region = None
+            if region_df is not None and name in region_df.index:
+                region = {c: str(region_df.loc[name, c])
+                          for c in REGION_COLUMNS if c in region_df.columns}
+            chips += [{'name': name,
+                       'image_base': image_base,
+                       'split': assign_split(name, test_frac, val_frac),
+                       'shard': shard_name,
+                       'index': i,
+                       'sources': hashes,
+                       'region': region,
+                       'band_stats': stats}]
+
+        self.manifest.update({'dims': [dim_x, dim_y],
+                              'nbands': nbands + len(nd_bands.ND_BANDS),
+                              'nd_scaling': 'fixed',
+                              'test_frac': test_frac,
+                              'val_frac': val_frac,
+                              'chips': chips})
+        self.manifest['shards'] += [{'name': shard_name, 'count': len(todo)}]
+        self.manifest['band_stats'] = self.merge_band_stats()
+        write_json_atomic(self.manifest, self.manifest_path)
+        self.write_names()
+
+        return len(todo)
+
+    def write_names(self):
+        """Write {split}_names.csv files like write_prepped_data"""
+        for split in ['train', 'val', 'test']:
+            with open(os.path.join(self.root, '{}_names.csv'.format(split)),
+                      'w') as wf:
+                for img_name in self.names(split):
+                    wf.write('{}\n'.format(img_name))
+
+        return
+
+
+def is_sharded(prepped_dir):
+    """True if prepped_dir holds a sharded dataset"""
+    return os.path.isfile(os.path.join(prepped_dir, MANIFEST_NAME))
+
+
+def main():
+
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    dataset = ShardedDataset(args.out_dir)
+    added = dataset.update(args.data_path, test_frac=args.test_frac,
+                           val_frac=args.val_frac, regions=args.regions,
+                           workers=args.workers)
+    print('Added {} chips, {} total'.format(added, len(dataset.records())))
+
+    return
+
+
+if __name__=='__main__':
+    main()
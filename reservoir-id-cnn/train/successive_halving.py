@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Successive halving search over grid search trials
+
+All trials train for a small number of epochs, the best 1/eta of them by a
+validation metric are promoted to train eta times longer, and so on until
+max_epochs or a single trial remains. Promoted trials continue from their
+last epoch checkpoint rather than starting over (see train.train).
+
+Every rung is run with grid_executor, so rungs train trials in parallel and
+each trial's rung result is saved as rung_<k>.json in its directory. A
+rerun skips finished rung results and resumes the search where it stopped.
+
+Example:
+    python3 gridsearch.py --halving --min-epochs 10 --eta 3
+
+"""
+
+
+import math
+import grid_executor
+
+ETA = 3
+# Fraction 1/ETA of trials promoted at each rung
+
+MIN_EPOCHS = 10
+# Epoch budget of the first rung
+
+METRICS = {'val_loss': min, 'val_f1': max}
+# Metrics trials can be ranked by, and whether lower or higher is better
+
+
+def rung_budgets(min_epochs, max_epochs, eta):
+    """Cumulative epoch budget of each rung, ending at max_epochs"""
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets += [budget]
+        budget *= eta
+    budgets += [max_epochs]
+
+    return budgets
+
+
+def rank_trials(trials, results, metric):
+    """Trials with results, best first by metric"""
+    ranked = [t for t in trials if grid_executor.trial_id(t) in results]
+    reverse = METRICS[metric] is max
+    ranked.sort(key=lambda t: results[grid_executor.trial_id(t)]
+                ['results'][metric], reverse=reverse)
+
+    return ranked
+
+
+def successive_halving(trials, results_dir, max_epochs, min_epochs=MIN_EPOCHS,
+                       eta=ETA, metric='val_loss', parallel=1,
+                       cores_per_trial=None, train_kwargs=None):
+    """Run trials in rungs of increasing epochs, promoting the best.
+
+    Args:
+        trials (list): Trial dictionaries, as for grid_executor.run_grid.
+        results_dir (str): Directory holding one subdirectory per trial.
+        max_epochs (int): Epoch budget of the final rung.
+        min_epochs (int): Epoch budget of the first rung.
+        eta (int): Keep the best 1/eta of trials at each rung.
+        metric (str): Validation metric to rank by, a key of METRICS.
+        parallel (int): Number of trials run at once.
+        cores_per_trial (int): Cores per trial. Default splits all cores.
+        train_kwargs (dict): Extra keyword arguments for train.train.
+
+    Returns:
+        List of rung dictionaries with epochs, trial ids and results.
+
+    """
+    train_kwargs = dict(train_kwargs or {})
+    budgets = rung_budgets(min_epochs, max_epochs, eta)
+    survivors = list(trials)
+    epochs_done = {grid_executor.trial_id(t): 0 for t in trials}
+    rungs = []
+    for k, budget in enumerate(budgets):
+        last_rung = k == len(budgets) - 1 or len(survivors) == 1
+        if last_rung:
+            # A single survivor trains for the full budget
+            budget = max_epochs
+        print('-'*30)
+        print('Rung {}: {} trials to {} epochs'.format(k, len(survivors),
+                                                       budget))
+        print('-'*30)
+
+        rung_trials = []
+        for trial in survivors:
+            trial = dict(trial)
+            trial['train_kwargs'] = {
+                'epochs': budget,
+                'initial_epoch': epochs_done[grid_executor.trial_id(trial)],
+                'test': last_rung}
+            rung_trials += [trial]
+        results = grid_executor.run_grid(
+            rung_trials, results_dir, parallel=parallel,
+            cores_per_trial=cores_per_trial, train_kwargs=train_kwargs,
+            result_name='rung_{}.json'.format(k))
+
+        ranked = rank_trials(survivors, results, metric)
+        for trial in ranked:
+            t_id = grid_executor.trial_id(trial)
+            epochs_done[t_id] = int(results[t_id]['results']['epochs'])
+        rungs += [{'epochs': budget,
+                   'trials': [grid_executor.trial_id(t) for t in ranked],
+                   'results': {t_id: r['results']
+                               for t_id, r in results.items()}}]
+        if last_rung:
+            break
+
+        survivors = ranked[:max(1, int(math.ceil(len(ranked) / eta)))]
+        print('Promoted: {}'.format(
+            [grid_executor.trial_id(t) for t in survivors]))
+
+    return rungs
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Precision, recall, F1 and IoU curves over all prediction thresholds
+
+Streams predicted probabilities and true masks once, in chunks, into
+histograms (see pixel_metrics.ThresholdHistogram) and writes metrics at
+every threshold to a csv, along with the F1 optimal threshold.
+
+Example:
+    python3 threshold_curves.py ./data/predict/pred_test_masks.npy \
+        ./data/prepped/imgs_mask_test.npy ./data/predict/threshold_curves.csv
+
+"""
+
+
+import json
+import argparse
+import numpy as np
+from skimage import transform
+import pixel_metrics
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Metrics over all prediction thresholds.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('pred_npy',
+                   help='Predicted probabilities, N x rows x cols x 1.',
+                   type=str)
+    p.add_argument('mask_npy',
+                   help='True masks with values 0 or 255, N x rows x cols.',
+                   type=str)
+    p.add_argument('out_csv',
+                   help='Output csv with metrics for each threshold.',
+                   type=str)
+    p.add_argument('--bins',
+                   help='Number of thresholds.',
+                   default=pixel_metrics.THRESHOLD_BINS,
+                   type=int)
+    p.add_argument('--chunk-size',
+                   help='Images read at a time.',
+                   default=pixel_metrics.CHUNK_SIZE,
+                   type=int)
+    return p
+
+
+def stream_histogram(pred, masks, bins=pixel_metrics.THRESHOLD_BINS,
+                     chunk_size=pixel_metrics.CHUNK_SIZE):
+    """ThresholdHistogram of predictions resized to the true mask size"""
+    hist = pixel_metrics.ThresholdHistogram(bins)
+    for start in range(0, pred.shape[0], chunk_size):
+        pred_chunk = np.asarray(pred[start:start + chunk_size])[..., 0]
+        mask_chunk = np.asarray(masks[start:start + chunk_size])
+        if pred_chunk.shape[1:] != mask_chunk.shape[1:]:
+            pred_chunk = transform.resize(pred_chunk, mask_chunk.shape,
+                                          preserve_range=True)
+        hist.update(pred_chunk, mask_chunk == 255)
+
+    return hist
+
+
+def main():
+
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    pred = np.load(args.pred_npy, mmap_mode='r')
+    masks = np.load(args.mask_npy, mmap_mode='r')
+    hist = stream_histogram(pred, masks, args.bins, args.chunk_size)
+    hist.write_csv(args.out_csv)
+
+    best_threshold, best_f1 = hist.best_threshold('f1')
+    summary = {'best_threshold': best_threshold, 'best_f1': best_f1}
+    print(summary)
+    with open('{}.json'.format(args.out_csv.rsplit('.', 1)[0]), 'w') as fp:
+        json.dump(summary, fp, sort_keys=True, indent=4)
+
+    return
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Training throughput instrumentation
+
+ThroughputLogger is a Keras callback recording, for every epoch, wall time,
+training samples per second, time spent waiting for batches from the data
+loader versus time in the model's train step, validation time, and peak
+resident memory. Records are appended to a JSON-lines file and written as
+TensorBoard scalars, so runs on different hardware or loader settings can
+be compared.
+
+Example:
+    >>> logger = ThroughputLogger('./throughput.jsonl', './logs/throughput',
+    ...                           samples_per_epoch=imgs_train.shape[0])
+    >>> model.fit(train_seq, callbacks=[logger])
+
+Notes:
+    Data wait is the time from the end of one train step to the start of
+    the next, which is mostly the wait for the next batch from the queue.
+    If it is a large fraction of the epoch, the loader is the bottleneck.
+
+"""
+
+
+import json
+import time
+import resource
+import tensorflow as tf
+from keras.callbacks import Callback
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class ThroughputLogger(Callback):
+    """Keras callback logging per epoch throughput and timing
+
+    Attributes:
+        jsonl_path (str): JSON-lines file records are appended to.
+        log_dir (str): TensorBoard log directory, or None to skip.
+        samples_per_epoch (int): Training images per epoch.
+        records (list): Record dictionaries of epochs so far.
+
+    """
+    def __init__(self, jsonl_path, log_dir=None, samples_per_epoch=None):
+        super(ThroughputLogger, self).__init__()
+        self.jsonl_path = jsonl_path
+        self.log_dir = log_dir
+        self.samples_per_epoch = samples_per_epoch
+        self.records = []
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        if self.log_dir is not None and self.writer is None:
+            self.writer = tf.summary.create_file_writer(self.log_dir)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.last_batch_end = self.epoch_start
+        self.data_wait = 0.
+        self.compute = 0.
+        self.val_time = 0.
+        self.batches = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.data_wait += self.batch_start - self.last_batch_end
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.time()
+        self.compute += self.last_batch_end - self.batch_start
+        self.batches += 1
+
+    def on_test_begin(self, logs=None):
+        self.val_start = time.time()
+
+    def on_test_end(self, logs=None):
+        self.val_time += time.time() - self.val_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.time() - self.epoch_start
+        train_time = self.data_wait + self.compute
+        record = {'epoch': epoch,
+                  'epoch_seconds': epoch_time,
+                  'train_seconds': train_time,
+                  'data_wait_seconds': self.data_wait,
+                  'compute_seconds': self.compute,
+                  'val_seconds': self.val_time,
+                  'data_wait_frac': self.data_wait / max(train_time, 1e-9),
+                  'batches': self.batches,
+                  'peak_memory_mb': peak_memory_mb()}
+        if self.samples_per_epoch is not None:
+            record['samples_per_sec'] = (self.samples_per_epoch /
+                                         max(train_time, 1e-9))
+        self.records += [record]
+
+        with open(self.jsonl_path, 'a') as f:
+            f.write('{}\n'.format(json.dumps(record, sort_keys=True)))
+
+        if self.writer is not None:
+            with self.writer.as_default():
+                for key, value in record.items():
+                    if key != 'epoch':
+                        tf.summary.scalar('throughput/{}'.format(key), value,
+                                          step=epoch)
+            self.writer.flush()
+
+    def on_train_end(self, logs=None):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
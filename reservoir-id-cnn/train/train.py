@@ -12,15 +12,25 @@ Notes:
 
 
 import os
+import json
+import argparse
 from skimage import transform
 import numpy as np
 from keras.models import Model
 from keras.layers import Input, concatenate, Conv2D, MaxPooling2D, Conv2DTranspose, UpSampling2D
 from keras.optimizers import Adam, SGD
-from keras.callbacks import ModelCheckpoint, TensorBoard, EarlyStopping
+from keras.callbacks import (ModelCheckpoint, TensorBoard, EarlyStopping,
+                             LambdaCallback)
 from keras import backend as K
 from skimage import io
 import loss_functions as lf
+import data_loader
+import batch_augment
+import preprocess_cache
+import pixel_metrics
+import throughput
+import training_state
+import nd_bands
 
 
 K.set_image_data_format('channels_last')  # TF dimension ordering in this code
@@ -34,6 +44,16 @@ RESIZE_COLS = 512
 # Number of bands in image.
 PRED_THRESHOLD = 0.5
 # Prediction threshold. > PRED_THRESHOLD will be classified as res.
+PREPPED_DIR = './data/prepped/'
+# Directory containing prepped .npy files
+BATCH_SIZE = 12
+# Images per training batch
+WORKERS = 4
+# Threads preparing batches in parallel with training
+MAX_QUEUE_SIZE = 8
+# Number of prepared batches queued ahead of the model
+EPOCHS = 500
+# Maximum number of training epochs
 
 
 def scale_image_tobyte(ar):
@@ -81,54 +101,64 @@ def f1(y_true, y_pred):
     return 2*((prec*rec)/(prec+rec+K.epsilon()))
 
 
-def get_unet(img_rows, img_cols, nbands, loss_func, learn_rate):
-    """U-Net Structure
+def unet_filters(width=1.0, depth=4):
+    """Filters of each U-Net level, from the input level to the bottleneck"""
+    return [max(1, int(round(32 * 2**level * width)))
+            for level in range(depth + 1)]
 
-    @author: jocicmarko
-    @url: https://github.com/jocicmarko/ultrasound-nerve-segmentation
-    """
 
-    inputs = Input((img_rows, img_cols, nbands))
-    conv1 = Conv2D(32, (3, 3), activation='relu', padding='same')(inputs)
-    conv1 = Conv2D(32, (3, 3), activation='relu', padding='same')(conv1)
-    pool1 = MaxPooling2D(pool_size=(2, 2))(conv1)
+def unet_layer_filters(width=1.0, depth=4):
+    """Filters of every convolution in get_unet, in creation order"""
+    filters = unet_filters(width, depth)
+    layer_filters = []
+    for level_filters in filters[:-1]:
+        layer_filters += [level_filters] * 2
+    layer_filters += [filters[-1]] * 2
+    for level_filters in filters[-2::-1]:
+        # Transposed convolution, then two convolutions
+        layer_filters += [level_filters] * 3
 
-    conv2 = Conv2D(64, (3, 3), activation='relu', padding='same')(pool1)
-    conv2 = Conv2D(64, (3, 3), activation='relu', padding='same')(conv2)
-    pool2 = MaxPooling2D(pool_size=(2, 2))(conv2)
+    return layer_filters
 
-    conv3 = Conv2D(128, (3, 3), activation='relu', padding='same')(pool2)
-    conv3 = Conv2D(128, (3, 3), activation='relu', padding='same')(conv3)
-    pool3 = MaxPooling2D(pool_size=(2, 2))(conv3)
 
-    conv4 = Conv2D(256, (3, 3), activation='relu', padding='same')(pool3)
-    conv4 = Conv2D(256, (3, 3), activation='relu', padding='same')(conv4)
-    pool4 = MaxPooling2D(pool_size=(2, 2))(conv4)
+def get_unet(img_rows, img_cols, nbands, loss_func, learn_rate,
+             structure_path='unet_10band.txt', width=1.0, depth=4,
+             layer_filters=None):
+    """U-Net Structure
 
-    conv5 = Conv2D(512, (3, 3), activation='relu', padding='same')(pool4)
-    conv5 = Conv2D(512, (3, 3), activation='relu', padding='same')(conv5)
+    Level i has 32 * 2**i * width filters, with depth poolings. The
+    defaults give the original 32/64/128/256/512 network, with layers
+    created in the same order so existing weights files still load.
+    layer_filters overrides the filters of each convolution, in the order
+    of unet_layer_filters, e.g. for pruned networks (see prune_unet.py).
 
-    up6 = concatenate([Conv2DTranspose(256, (2, 2), strides=(2, 2),
-                                       padding='same')(conv5), conv4], axis=3)
-    conv6 = Conv2D(256, (3, 3), activation='relu', padding='same')(up6)
-    conv6 = Conv2D(256, (3, 3), activation='relu', padding='same')(conv6)
+    @author: jocicmarko
+    @url: https://github.com/jocicmarko/ultrasound-nerve-segmentation
+    """
+    filters = unet_filters(width, depth)
+    if layer_filters is None:
+        layer_filters = unet_layer_filters(width, depth)
+    counts = iter(layer_filters)
 
-    up7 = concatenate([Conv2DTranspose(128, (2, 2), strides=(2, 2),
-                                       padding='same')(conv6), conv3], axis=3)
-    conv7 = Conv2D(128, (3, 3), activation='relu', padding='same')(up7)
-    conv7 = Conv2D(128, (3, 3), activation='relu', padding='same')(conv7)
+    inputs = Input((img_rows, img_cols, nbands))
+    skips = []
+    x = inputs
+    for _ in filters[:-1]:
+        x = Conv2D(next(counts), (3, 3), activation='relu', padding='same')(x)
+        x = Conv2D(next(counts), (3, 3), activation='relu', padding='same')(x)
+        skips += [x]
+        x = MaxPooling2D(pool_size=(2, 2))(x)
 
-    up8 = concatenate([Conv2DTranspose(64, (2, 2), strides=(2, 2),
-                                       padding='same')(conv7), conv2], axis=3)
-    conv8 = Conv2D(64, (3, 3), activation='relu', padding='same')(up8)
-    conv8 = Conv2D(64, (3, 3), activation='relu', padding='same')(conv8)
+    x = Conv2D(next(counts), (3, 3), activation='relu', padding='same')(x)
+    x = Conv2D(next(counts), (3, 3), activation='relu', padding='same')(x)
 
-    up9 = concatenate([Conv2DTranspose(32, (2, 2), strides=(2, 2),
-                                       padding='same')(conv8), conv1], axis=3)
-    conv9 = Conv2D(32, (3, 3), activation='relu', padding='same')(up9)
-    conv9 = Conv2D(32, (3, 3), activation='relu', padding='same')(conv9)
+    for skip in skips[::-1]:
+        x = concatenate([Conv2DTranspose(next(counts), (2, 2), strides=(2, 2),
+                                         padding='same')(x), skip], axis=3)
+        x = Conv2D(next(counts), (3, 3), activation='relu', padding='same')(x)
+        x = Conv2D(next(counts), (3, 3), activation='relu', padding='same')(x)
 
-    conv10 = Conv2D(1, (1, 1), activation='sigmoid')(conv9)
+    conv10 = Conv2D(1, (1, 1), activation='sigmoid')(x)
 
     model = Model(inputs=[inputs], outputs=[conv10])
 
@@ -139,7 +169,7 @@ def get_unet(img_rows, img_cols, nbands, loss_func, learn_rate):
     # Save structure
     model_json = model.to_json()
     print(model_json)
-    with open("unet_10band.txt", 'w') as outfile:
+    with open(structure_path, 'w') as outfile:
         outfile.write(model_json)
 
     print('done')
@@ -178,120 +208,236 @@ def preprocess(imgs, masks, band_selection):
     return imgs, masks
 
 
-def train(learn_rate, loss_func, band_selection, val):
-    """Master function for training"""
+def get_mean_std(prepped_dir, band_selection, cache=None):
+    """Training mean and std of selected bands, for scaling images
+
+    Uses statistics stored with the dataset if it was prepped with them,
+    otherwise computes them or reads them from cache.
+
+    """
+    train_stats = data_loader.load_band_stats(prepped_dir)
+    if train_stats is not None:
+        return train_stats.select(band_selection)
+    elif cache is None:
+        imgs_train, _ = data_loader.load_prepped(prepped_dir, 'train')
+        return data_loader.compute_mean_std(imgs_train, band_selection)
+    else:
+        return cache.get_stats(prepped_dir, band_selection)
+
+
+def make_sequence(prepped_dir, split, band_selection, mean, std, cache=None,
+                  augmenter=None, shard=None, batch_size=BATCH_SIZE):
+    """PreppedSequence of a split, read from cache if one is given
+
+    If shard is a (index, count) tuple, only every count-th image starting
+    at index is used, e.g. one worker's part of distributed training. The
+    shard is read batch by batch, like the whole split.
+
+    """
+    if cache is None:
+        imgs, masks = data_loader.load_prepped(prepped_dir, split)
+    else:
+        imgs, masks = cache.get_split(prepped_dir, split, band_selection,
+                                      mean, std)
+    indices = None
+    if shard is not None:
+        indices = np.arange(shard[0], imgs.shape[0], shard[1])
+
+    return data_loader.PreppedSequence(
+        imgs, masks, band_selection, mean, std, batch_size=batch_size,
+        augmenter=augmenter, preprocessed=cache is not None, indices=indices)
+
+
+def write_fit_state(fit_state_path, epoch, best_val_loss):
+    """Record the epoch last_weights.h5 is from and the best val_loss"""
+    with open('{}.tmp'.format(fit_state_path), 'w') as fp:
+        json.dump({'epoch': epoch, 'best_val_loss': float(best_val_loss)}, fp)
+    os.replace('{}.tmp'.format(fit_state_path), fit_state_path)
+
+    return
+
+
+def train(learn_rate, loss_func, band_selection, val, workers=WORKERS,
+          augment=True, seed=None, prepped_dir=PREPPED_DIR, cache_dir=None,
+          out_dir='./', epochs=EPOCHS, initial_epoch=0, test=True,
+          resume=False, width=1.0, depth=4):
+    """Master function for training
+
+    Prepped arrays are memory-mapped and fed to the model batch by batch
+    through data_loader.PreppedSequence, prepared by `workers` threads.
+    If augment, training batches get fresh random flips, crops and
+    rotations every epoch, reproducible for a given seed.
+    prepped_dir may hold .npy files or a sharded dataset.
+    Band statistics stored with the dataset (see band_stats.py) are used
+    for scaling when present, otherwise they are computed.
+    If cache_dir is given, preprocessed tensors and band statistics are
+    read from (or added to) a preprocess_cache.PreprocessCache there.
+    Model structure, weights, band statistics, logs and test predictions
+    are written under out_dir, with per epoch throughput and timing in
+    throughput.jsonl (see throughput.py).
+    Training runs from initial_epoch up to epochs. If initial_epoch > 0,
+    training continues from the last epoch weights of an earlier call with
+    the same out_dir, e.g. for successive halving (successive_halving.py),
+    at the epoch recorded with them in fit_state.json.
+    If not test, returns after the val evaluation.
+    Full training state is checkpointed under out_dir/state/ every epoch,
+    and if resume, training continues exactly from the latest checkpoint
+    (see training_state.py).
+    width and depth scale the U-Net, see get_unet.
+
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
     print('-'*30)
     print('Loading and preprocessing train data...')
     print('-'*30)
 
     num_bands = len(band_selection)
-    model = get_unet(RESIZE_ROWS, RESIZE_COLS, num_bands, loss_func, learn_rate)
 
-    # Prep train
-    imgs_train = np.load('./data/prepped/imgs_train.npy')
-    imgs_mask_train = np.load('./data/prepped/imgs_mask_train.npy')
-    imgs_train, imgs_mask_train = preprocess(imgs_train, imgs_mask_train, band_selection)
+    cache = None
+    if cache_dir is not None:
+        cache = preprocess_cache.PreprocessCache(cache_dir)
 
     # Scale imgs based on train mean and std
-    mean = np.mean(imgs_train, axis=(0,1,2))  # mean for data centering
-    std = np.std(imgs_train, axis=(0,1,2))  # std for data normalization
-    np.save('mean_std.npy', np.vstack((mean, std)))
-    imgs_train -= mean
-    imgs_train /= std
+    mean, std = get_mean_std(prepped_dir, band_selection, cache)
+    np.save(os.path.join(out_dir, 'mean_std.npy'), np.vstack((mean, std)))
+    nd_bands.write_nd_scaling(out_dir, data_loader.nd_scaling(prepped_dir))
+
+    # Prep train
+    augmenter = batch_augment.BatchAugmenter(seed) if augment else None
+    train_seq = make_sequence(prepped_dir, 'train', band_selection, mean, std,
+                              cache, augmenter)
 
     # Prep val
     if val:
-        val_path = './data/prepped/imgs_val.npy'
-        val_mask_path = './data/prepped/imgs_mask_val.npy'
+        val_split = 'val'
     else:
         # If no val set, test data is used as val/early stopping set
-        val_path = './data/prepped/imgs_test.npy'
-        val_mask_path = './data/prepped/imgs_mask_test.npy'
+        val_split = 'test'
 
     # Load val data
-    imgs_val = np.load(val_path)
-    imgs_mask_val = np.load(val_mask_path)
-    imgs_val, imgs_mask_val = preprocess(imgs_val, imgs_mask_val, band_selection)
-    imgs_val -= mean
-    imgs_val /= std
-    val_data = (imgs_val, imgs_mask_val)
+    val_seq = make_sequence(prepped_dir, val_split, band_selection, mean, std,
+                            cache)
 
     print('-'*30)
     print('Creating and compiling model...')
     print('-'*30)
-    num_bands = len(band_selection)
-    model = get_unet(RESIZE_ROWS, RESIZE_COLS, num_bands, loss_func, learn_rate)
+    model = get_unet(RESIZE_ROWS, RESIZE_COLS, num_bands, loss_func, learn_rate,
+                     structure_path=os.path.join(out_dir, 'unet_10band.txt'),
+                     width=width, depth=depth)
 
     # Setup callbacks
-    model_checkpoint = ModelCheckpoint('weights.h5', monitor='val_loss',
+    weights_path = os.path.join(out_dir, 'weights.h5')
+    last_weights_path = os.path.join(out_dir, 'last_weights.h5')
+    fit_state_path = os.path.join(out_dir, 'fit_state.json')
+    model_checkpoint = ModelCheckpoint(weights_path, monitor='val_loss',
                                        mode='min', save_best_only=True)
-    tensorboard = TensorBoard(log_dir='./logs', histogram_freq=0,
+    last_checkpoint = ModelCheckpoint(last_weights_path,
+                                      save_weights_only=True)
+    # Written every epoch right after the last weights, so an interrupted
+    # call continues from the epoch the weights are actually from
+    fit_state_logger = LambdaCallback(
+        on_epoch_end=lambda epoch, logs: write_fit_state(
+            fit_state_path, epoch + 1, model_checkpoint.best))
+    if initial_epoch > 0 and not resume:
+        # Continue from the last epoch, keeping the best val_loss so far
+        model.load_weights(last_weights_path)
+        with open(fit_state_path) as fp:
+            fit_state = json.load(fp)
+        model_checkpoint.best = fit_state['best_val_loss']
+        initial_epoch = fit_state['epoch']
+    tensorboard = TensorBoard(log_dir=os.path.join(out_dir, 'logs'), histogram_freq=0,
                               write_images=True)
     early_stopping = EarlyStopping(monitor='val_loss', min_delta=0, patience=25,
                                    verbose=0, mode='min')
+    throughput_logger = throughput.ThroughputLogger(
+        os.path.join(out_dir, 'throughput.jsonl'),
+        log_dir=os.path.join(out_dir, 'logs', 'throughput'),
+        samples_per_epoch=train_seq.order.size)
+    # Last, so state is restored after other callbacks reset theirs
+    train_state = training_state.TrainingState(
+        os.path.join(out_dir, 'state'), train_seq,
+        [early_stopping, model_checkpoint], resume=resume)
+    if train_state.initial_epoch() > 0:
+        initial_epoch = train_state.initial_epoch()
+    # Restore shuffle order and augmentation seed before batches are loaded
+    train_state.restore_sequence()
 
 
     print('-'*30)
     print('Fitting model...')
     print('-'*30)
 
-    model.fit(imgs_train, imgs_mask_train, batch_size=12, epochs=500,
-              verbose=2, shuffle=False,
-              validation_data=val_data,
-              callbacks=[model_checkpoint, tensorboard, early_stopping])
+    history = model.fit(train_seq, epochs=epochs,
+                        initial_epoch=initial_epoch,
+                        verbose=2, shuffle=False,
+                        validation_data=val_seq,
+                        callbacks=[model_checkpoint, last_checkpoint,
+                                   fit_state_logger, tensorboard,
+                                   early_stopping,
+                                   throughput_logger, train_state],
+                        workers=workers, use_multiprocessing=False,
+                        max_queue_size=MAX_QUEUE_SIZE)
+    epochs_done = initial_epoch + len(history.history.get('loss', []))
 
     # Record results as dictionary
     out_dict = {}
+    out_dict['epochs'] = epochs_done
 
     print('-'*30)
     print('Loading saved weights for val, testing...')
     print('-'*30)
-    model.load_weights('weights.h5')
-    val_eval = model.evaluate(imgs_val, imgs_mask_val, batch_size=12, verbose=0)
+    model.load_weights(weights_path)
+    val_eval = model.evaluate(val_seq, verbose=0, workers=workers)
     print('Final Val Scores: {}'.format(val_eval))
     # Validation results
     out_dict['val_f1'] = val_eval[-1]
     out_dict['val_recall'] = val_eval[-2]
     out_dict['val_prec'] = val_eval[-3]
+    out_dict['val_loss'] = val_eval[0]
+
+    if not test:
+        return out_dict
 
     if not val:
         # Val and test are together, so we'll run tests on val set
-        imgs_test = imgs_val
-        imgs_mask_test = imgs_mask_val
+        test_seq = val_seq
     else:
         print('-'*30)
         print('Loading and preprocessing test data...')
         print('-'*30)
-        imgs_test = np.load('./data/prepped/imgs_test.npy')
-        imgs_mask_test = np.load('./data/prepped/imgs_mask_test.npy')
-        imgs_test, imgs_mask_test = preprocess(imgs_test, imgs_mask_test, band_selection)
-        imgs_test -= mean
-        imgs_test /= std
+        test_seq = make_sequence(prepped_dir, 'test', band_selection, mean,
+                                 std, cache)
 
     print('-'*30)
     print('Predicting masks on test data...')
     print('-'*30)
-    pred_test_masks = model.predict(imgs_test, batch_size=12, verbose=0)
+    pred_test_masks = model.predict(test_seq, verbose=0, workers=workers)
 
     # Save predicted masks
-    predict_dir = './data/predict/'
+    predict_dir = os.path.join(out_dir, 'data', 'predict')
     if not os.path.isdir(predict_dir):
         os.makedirs(predict_dir)
 
-    np.save('{}pred_test_masks.npy'.format(predict_dir), pred_test_masks)
-    test_img_names = open('./data/prepped/test_names.csv').read().splitlines()
+    np.save(os.path.join(predict_dir, 'pred_test_masks.npy'), pred_test_masks)
+    test_img_names = open('{}test_names.csv'.format(prepped_dir)).read().splitlines()
 
 
-    # For calculating total error metrics
-    total_res_pixels = 0
-    total_true_positives = 0
-    total_false_positives = 0
+    # Per image confusion counts, for total error metrics, and probability
+    # histograms for metrics at every threshold
+    test_counts = np.zeros((pred_test_masks.shape[0], 4), dtype=np.int64)
+    test_hist = pixel_metrics.ThresholdHistogram()
     for i in range(pred_test_masks.shape[0]):
+        # Test sequence is unshuffled, so batch b holds images b*size onward
+        j = i % test_seq.batch_size
+        if j == 0:
+            imgs_test, imgs_mask_test = test_seq[i // test_seq.batch_size]
         pred_mask = pred_test_masks[i]
-        true_mask = imgs_mask_test[i]
+        true_mask = imgs_mask_test[j]
+        test_hist.update(pred_mask, true_mask > 0.5)
 
         # Get ndwi as byte
-        ndwi_img = imgs_test[i,:,:,num_bands-2]
+        ndwi_img = imgs_test[j,:,:,num_bands-2]
         ndwi_img = transform.resize(ndwi_img,
                                     (OG_ROWS, OG_COLS),
                                     preserve_range = True)
@@ -311,7 +457,7 @@ def train(learn_rate, loss_func, band_selection, val):
 
         # Save predicted masks
         pred_mask_filename = test_img_names[i].replace('og.tif', 'predmask.png')
-        io.imsave('{}{}'.format(predict_dir, pred_mask_filename), pred_mask)
+        io.imsave(os.path.join(predict_dir, pred_mask_filename), pred_mask)
 
         # Save NDWI, predicted mask, and actual masks side by side
         compare_filename = test_img_names[i].replace('og.tif', 'results.png')
@@ -319,18 +465,30 @@ def train(learn_rate, loss_func, band_selection, val):
         compare_im[0:OG_ROWS, 0:OG_COLS] = ndwi_img
         compare_im[0:OG_ROWS, (OG_COLS + 10):(OG_COLS * 2 + 10)] = true_mask
         compare_im[0:OG_ROWS, (OG_COLS * 2 + 20):] = pred_mask
-        io.imsave('{}{}'.format(predict_dir, compare_filename), compare_im)
+        io.imsave(os.path.join(predict_dir, compare_filename), compare_im)
 
         # Calculate basic error
-        total_res_pixels += np.sum(true_mask == 255)
-        total_true_positives += np.sum((true_mask == 255) * (pred_mask == 255))
-        total_false_positives += np.sum((true_mask == 0) * (pred_mask == 255))
+        test_counts[i] = pixel_metrics.confusion_counts(
+            pred_mask[np.newaxis] == 255, true_mask[np.newaxis] > 127)[0]
 
+    pixel_eval = pixel_metrics.metrics_from_counts(test_counts.sum(axis=0))
+    total_res_pixels = pixel_eval['true_pos'] + pixel_eval['false_neg']
     print('Total Res Pixels: {}'.format(total_res_pixels))
     print('Total True Pos: {} ({})'.format(
-        total_true_positives, total_true_positives/total_res_pixels))
+        pixel_eval['true_pos'], pixel_eval['true_pos']/total_res_pixels))
     print('Total False Pos: {} ({})'.format(
-        total_false_positives, total_false_positives/total_res_pixels))
+        pixel_eval['false_pos'], pixel_eval['false_pos']/total_res_pixels))
+    for metric in ['precision', 'recall', 'f1', 'iou', 'kappa']:
+        out_dict['test_pixel_{}'.format(metric)] = float(pixel_eval[metric])
+    print('Test Pixel Metrics: {}'.format(
+        {k: v for k, v in out_dict.items() if k.startswith('test_pixel')}))
+
+    # Metrics at every threshold, and the F1 optimal threshold
+    test_hist.write_csv(os.path.join(predict_dir, 'threshold_curves.csv'))
+    best_threshold, best_f1 = test_hist.best_threshold('f1')
+    out_dict['test_best_threshold'] = best_threshold
+    out_dict['test_best_threshold_f1'] = best_f1
+    print('Best Threshold: {} (F1 {})'.format(best_threshold, best_f1))
 
 #         # Format test masks for eval
 #         imgs_mask_test = resize_imgs(imgs_mask_test, 1)
@@ -340,8 +498,7 @@ def train(learn_rate, loss_func, band_selection, val):
 #         imgs_mask_test[imgs_mask_test < 0.5] = 0
 
     # Test results
-    test_eval = model.evaluate(imgs_test, imgs_mask_test,
-                                batch_size=12, verbose=0)
+    test_eval = model.evaluate(test_seq, verbose=0, workers=workers)
     out_dict['test_f1'] = test_eval[-1]
     out_dict['test_recall'] = test_eval[-2]
     out_dict['test_prec'] = test_eval[-3]
@@ -349,6 +506,23 @@ def train(learn_rate, loss_func, band_selection, val):
 
     return out_dict
 
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Train U-Net on reservoir images.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--resume',
+                   help='Continue from the latest training state checkpoint.',
+                   action='store_true')
+    p.add_argument('--out-dir',
+                   help='Directory for model, weights, logs and state.',
+                   default='./',
+                   type=str)
+    return p
+
+
 if __name__=='__main__':
+    args = argparse_init().parse_args()
     train(6.5E-5, lf.dice_coef_wgt_loss, [0, 1, 2, 3, 4, 5, 12, 13, 14, 15],
-          val=False)
+          val=False, out_dir=args.out_dir, resume=args.resume)
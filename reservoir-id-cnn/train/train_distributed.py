@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Data-parallel U-Net training on several CPU workers
+
+Each worker trains a replica of the model on its own shard of the training
+set (every n-th image), and gradients are all-reduced synchronously with
+tf.distribute.MultiWorkerMirroredStrategy, so the model sees a global batch
+of batch_size x workers images per step.
+
+Workers find each other through the TF_CONFIG environment variable. On a
+cluster, set TF_CONFIG on every node and run this script with --worker.
+For testing on one machine, --num-workers N launches N local worker
+processes with TF_CONFIG set for ports on localhost, each pinned to its own
+cores. --scaling runs short trainings for several worker counts and writes
+a report of samples per second against workers.
+
+Example:
+    python3 train_distributed.py --num-workers 4 --cores-per-worker 4
+    python3 train_distributed.py --scaling 1,2,4 --epochs 2
+
+Notes:
+    Only the chief (worker 0) writes the model, weights and band statistics
+    to out_dir. Other workers write theirs under out_dir/worker_<i>/.
+    Test predictions and metrics are not run here; use train.py or
+    export_model.py on the saved weights.
+
+"""
+
+
+import os
+import sys
+import json
+import argparse
+import subprocess as sp
+import numpy as np
+
+EPOCHS = 500
+# Maximum number of training epochs, as train.EPOCHS
+
+BASE_PORT = 23456
+# First localhost port used by locally launched workers
+
+
+def argparse_init():
+    """Prepare ArgumentParser for inputs."""
+
+    p = argparse.ArgumentParser(
+            description='Data-parallel U-Net training on CPU workers.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--worker',
+                   help='Run as one worker, configured by TF_CONFIG.',
+                   action='store_true')
+    p.add_argument('--num-workers',
+                   help='Number of local worker processes to launch.',
+                   default=2,
+                   type=int)
+    p.add_argument('--cores-per-worker',
+                   help='Cores per local worker. Default splits all cores.',
+                   default=None,
+                   type=int)
+    p.add_argument('--scaling',
+                   help=('Comma separated worker counts to time, writing '
+                         'scaling_report.json to out-dir.'),
+                   default=None,
+                   type=str)
+    p.add_argument('--lr',
+                   help='Learning rate.',
+                   default=6.5E-5,
+                   type=float)
+    p.add_argument('--loss',
+                   help='Loss function name in loss_functions.py.',
+                   default='dice_coef_wgt_loss',
+                   type=str)
+    p.add_argument('--bands',
+                   help='Comma separated band selection.',
+                   default='0,1,2,3,4,5,12,13,14,15',
+                   type=str)
+    p.add_argument('--batch-size',
+                   help='Images per worker per step.',
+                   default=12,
+                   type=int)
+    p.add_argument('--epochs',
+                   help='Maximum number of epochs.',
+                   default=EPOCHS,
+                   type=int)
+    p.add_argument('--loader-threads',
+                   help='Threads preparing batches on each worker.',
+                   default=4,
+                   type=int)
+    p.add_argument('--prepped-dir',
+                   help='Prepped .npy or sharded dataset directory.',
+                   default='./data/prepped/',
+                   type=str)
+    p.add_argument('--cache-dir',
+                   help='Preprocess cache directory, or none.',
+                   default='./data/cache/',
+                   type=str)
+    p.add_argument('--out-dir',
+                   help='Directory for model, weights and logs.',
+                   default='./distributed/',
+                   type=str)
+    p.add_argument('--port',
+                   help='First localhost port for local workers.',
+                   default=BASE_PORT,
+                   type=int)
+    return p
+
+
+def shard_steps(num_imgs, num_workers, batch_size):
+    """Steps per epoch and batch size giving every worker full batches
+
+    Every worker gets the same number of full batches, so the remainder of
+    the split is dropped on all workers alike and no worker runs short of
+    data in a collective step. Batches are made smaller if the split does
+    not fill one batch per worker.
+
+    """
+    per_worker = num_imgs // num_workers
+    if per_worker == 0:
+        raise ValueError('{} images cannot be split across {} workers'.format(
+            num_imgs, num_workers))
+    batch_size = min(batch_size, per_worker)
+
+    return per_worker // batch_size, batch_size
+
+
+def make_dataset(seq, steps, loader_threads, max_queue_size):
+    """tf.data.Dataset of steps batches per epoch from a PreppedSequence
+
+    Batches are prepared by loader_threads in parallel, in order, and
+    queued ahead of the model.
+
+    """
+    import tensorflow as tf
+
+    sample_imgs, sample_masks = seq[0]
+
+    def load_batch(idx):
+        return seq[int(idx)]
+
+    def set_shapes(imgs, masks):
+        imgs.set_shape((seq.batch_size,) + sample_imgs.shape[1:])
+        masks.set_shape((seq.batch_size,) + sample_masks.shape[1:])
+        return imgs, masks
+
+    dataset = tf.data.Dataset.range(steps).repeat()
+    dataset = dataset.map(
+        lambda idx: tf.numpy_function(load_batch, [idx],
+                                      [tf.float32, tf.float32]),
+        num_parallel_calls=loader_threads, deterministic=True)
+    dataset = dataset.map(set_shapes).prefetch(max_queue_size)
+
+    # Data is already sharded by worker
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = (
+        tf.data.experimental.AutoShardPolicy.OFF)
+
+    return dataset.with_options(options)
+
+
+def train_worker(args):
+    """Train as one worker of the cluster described by TF_CONFIG."""
+    import tensorflow as tf
+
+    # The strategy must be created before any other TensorFlow ops
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+    from keras.callbacks import (ModelCheckpoint, EarlyStopping,
+                                 LambdaCallback)
+    import loss_functions as lf
+    import batch_augment
+    import preprocess_cache
+    import throughput
+    import data_loader
+    import nd_bands
+    import train
+
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    task_index = tf_config.get('task', {}).get('index', 0)
+    num_workers = strategy.num_replicas_in_sync
+    is_chief = task_index == 0
+    out_dir = args.out_dir
+    if not is_chief:
+        out_dir = os.path.join(args.out_dir, 'worker_{}/'.format(task_index))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    band_selection = [int(b) for b in args.bands.split(',')]
+    loss_func = getattr(lf, args.loss, args.loss)
+    cache = None
+    if args.cache_dir.lower() != 'none':
+        cache = preprocess_cache.PreprocessCache(args.cache_dir)
+    mean, std = train.get_mean_std(args.prepped_dir, band_selection, cache)
+    np.save('{}mean_std.npy'.format(out_dir), np.vstack((mean, std)))
+    nd_bands.write_nd_scaling(out_dir, data_loader.nd_scaling(args.prepped_dir))
+
+    # If no val set, test data is used as val/early stopping set, as train.py
+    val_split = 'val'
+    if not data_loader.has_split(args.prepped_dir, 'val'):
+        val_split = 'test'
+
+    # Shard train and val by worker, with equal full batches on every worker
+    shard = (task_index, num_workers)
+    imgs_train, _ = data_loader.load_prepped(args.prepped_dir, 'train')
+    imgs_val, _ = data_loader.load_prepped(args.prepped_dir, val_split)
+    steps, batch_size = shard_steps(imgs_train.shape[0], num_workers,
+                                    args.batch_size)
+    val_steps, val_batch_size = shard_steps(imgs_val.shape[0], num_workers,
+                                            args.batch_size)
+    train_seq = train.make_sequence(
+        args.prepped_dir, 'train', band_selection, mean, std, cache,
+        batch_augment.BatchAugmenter(task_index), shard=shard,
+        batch_size=batch_size)
+    val_seq = train.make_sequence(
+        args.prepped_dir, val_split, band_selection, mean, std, cache,
+        shard=shard, batch_size=val_batch_size)
+    train_data = make_dataset(train_seq, steps, args.loader_threads,
+                              train.MAX_QUEUE_SIZE)
+    val_data = make_dataset(val_seq, val_steps, args.loader_threads,
+                            train.MAX_QUEUE_SIZE)
+
+    with strategy.scope():
+        model = train.get_unet(
+            train.RESIZE_ROWS, train.RESIZE_COLS, len(band_selection),
+            loss_func, args.lr,
+            structure_path='{}unet_10band.txt'.format(out_dir))
+
+    callbacks = [
+        ModelCheckpoint('{}weights.h5'.format(out_dir), monitor='val_loss',
+                        mode='min', save_best_only=True),
+        EarlyStopping(monitor='val_loss', min_delta=0, patience=25,
+                      verbose=0, mode='min'),
+        LambdaCallback(on_epoch_end=lambda epoch, logs:
+                       train_seq.on_epoch_end()),
+        throughput.ThroughputLogger(
+            '{}throughput.jsonl'.format(out_dir),
+            log_dir='{}logs/throughput'.format(out_dir),
+            samples_per_epoch=steps * batch_size * num_workers)]
+
+    print('-'*30)
+    print('Fitting model on worker {} of {}...'.format(task_index,
+                                                       num_workers))
+    print('-'*30)
+    model.fit(train_data, epochs=args.epochs, steps_per_epoch=steps,
+              validation_data=val_data, validation_steps=val_steps,
+              verbose=2 if is_chief else 0, callbacks=callbacks)
+
+    return
+
+
+def worker_command(args, out_dir):
+    """Command line running this script as a worker with the same options"""
+    return [sys.executable, os.path.abspath(__file__), '--worker',
+            '--lr', str(args.lr), '--loss', args.loss,
+            '--bands', args.bands, '--batch-size', str(args.batch_size),
+            '--epochs', str(args.epochs),
+            '--loader-threads', str(args.loader_threads),
+            '--prepped-dir', args.prepped_dir, '--cache-dir', args.cache_dir,
+            '--out-dir', out_dir]
+
+
+def launch_local(args, num_workers, out_dir):
+    """Run num_workers local worker processes and wait for them.
+
+    Returns:
+        True if all workers exited cleanly.
+
+    """
+    import grid_executor
+
+    cores_per_worker = args.cores_per_worker
+    if cores_per_worker is None:
+        cores_per_worker = max(1, len(os.sched_getaffinity(0)) // num_workers)
+    slots = grid_executor.core_slots(num_workers, cores_per_worker)
+    workers = ['localhost:{}'.format(args.port + i)
+               for i in range(num_workers)]
+
+    procs = []
+    for i, cores in enumerate(slots):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': {'worker': workers},
+                                       'task': {'type': 'worker',
+                                                'index': i}})
+        for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'TF_NUM_INTRAOP_THREADS']:
+            env[var] = str(len(cores))
+        pin = lambda c=cores: os.sched_setaffinity(0, c)
+        procs += [sp.Popen(worker_command(args, out_dir), env=env,
+                           preexec_fn=pin)]
+
+    return all(proc.wait() == 0 for proc in procs)
+
+
+def scaling_report(args, worker_counts):
+    """Time training for each worker count and write scaling_report.json
+
+    Worker counts whose run failed or logged no epochs are reported with
+    ok False and null throughput, speedup and efficiency.
+
+    """
+    report = []
+    for num_workers in worker_counts:
+        out_dir = os.path.join(args.out_dir, 'scaling_{}/'.format(num_workers))
+        ok = launch_local(args, num_workers, out_dir)
+        records = []
+        throughput_path = '{}throughput.jsonl'.format(out_dir)
+        if os.path.isfile(throughput_path):
+            with open(throughput_path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        result = {'workers': num_workers,
+                  'ok': ok and len(records) > 0,
+                  'samples_per_sec': None,
+                  'data_wait_frac': None}
+        if len(records) == 0:
+            print('{} workers: failed, no throughput logged'.format(
+                num_workers))
+            report += [result]
+            continue
+        # Skip the first epoch, which includes graph building and warmup
+        timed = records[1:] if len(records) > 1 else records
+        result['samples_per_sec'] = float(np.mean([r['samples_per_sec']
+                                                   for r in timed]))
+        result['data_wait_frac'] = float(np.mean([r['data_wait_frac']
+                                                  for r in timed]))
+        report += [result]
+        print('{} workers: {:.2f} samples/sec{}'.format(
+            num_workers, result['samples_per_sec'],
+            '' if ok else ' (a worker failed)'))
+
+    # Speedup and efficiency relative to the first worker count that ran
+    timed_runs = [r for r in report if r['samples_per_sec'] is not None]
+    for r in report:
+        r['speedup'] = None
+        r['efficiency'] = None
+        if r['samples_per_sec'] is None:
+            continue
+        first = timed_runs[0]
+        r['speedup'] = r['samples_per_sec'] / first['samples_per_sec']
+        r['efficiency'] = r['speedup'] * first['workers'] / r['workers']
+
+    with open(os.path.join(args.out_dir, 'scaling_report.json'), 'w') as fp:
+        json.dump(report, fp, sort_keys=True, indent=4)
+
+    return report
+
+
+def main():
+
+    # Get command line args
+    parser = argparse_init()
+    args = parser.parse_args()
+
+    if args.worker:
+        train_worker(args)
+    elif args.scaling is not None:
+        worker_counts = [int(n) for n in args.scaling.split(',')]
+        print(scaling_report(args, worker_counts))
+    else:
+        if not launch_local(args, args.num_workers, args.out_dir):
+            sys.exit('A worker failed')
+
+    return
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Full training state checkpoints for resuming interrupted training
+
+TrainingState is a Keras callback that saves everything needed to continue
+training exactly where it stopped at the end of every epoch: model weights,
+optimizer slots and step, TensorFlow's global random generator, the epoch,
+the state of early stopping and best-model checkpointing, the numpy and
+Python random states, and the training sequence's epoch, shuffle order and
+augmentation seed.
+
+Each checkpoint is written to a temporary directory and renamed into place,
+then latest.json is atomically replaced to point at it, so a node that is
+killed mid-write always leaves the previous checkpoint intact.
+
+Example:
+    >>> state = TrainingState('./state/', train_seq, [early_stopping],
+    ...                       resume=True)
+    >>> initial_epoch = state.initial_epoch()
+    >>> state.restore_sequence()
+    >>> model.fit(train_seq, initial_epoch=initial_epoch,
+    ...           callbacks=[early_stopping, state])
+
+Notes:
+    Checkpoints are taken at epoch ends, so at most one epoch of work is lost
+    when a node is preempted.
+
+"""
+
+
+import os
+import json
+import random
+import shutil
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import Callback, EarlyStopping, ModelCheckpoint
+
+KEEP = 2
+# Number of most recent checkpoints kept
+
+LATEST_NAME = 'latest.json'
+# File in the state directory naming the most recent checkpoint
+
+
+def callback_state(callback):
+    """JSON serializable state of a callback that persists across epochs"""
+    if isinstance(callback, EarlyStopping):
+        return {'wait': int(callback.wait), 'best': float(callback.best),
+                'stopped_epoch': int(callback.stopped_epoch)}
+    elif isinstance(callback, ModelCheckpoint):
+        return {'best': float(callback.best)}
+    return {}
+
+
+def set_callback_state(callback, state):
+    for key, value in state.items():
+        setattr(callback, key, value)
+
+
+class TrainingState(Callback):
+    """Keras callback saving and restoring full training state
+
+    Attributes:
+        state_dir (str): Directory holding checkpoints and latest.json.
+        sequence (PreppedSequence): Training sequence, or None.
+        callbacks (list): Callbacks whose state is saved, e.g. EarlyStopping
+            and ModelCheckpoint.
+        resume (bool): Restore the latest checkpoint when training begins.
+        keep (int): Number of most recent checkpoints kept.
+
+    """
+    def __init__(self, state_dir, sequence=None, callbacks=None, resume=False,
+                 keep=KEEP):
+        super(TrainingState, self).__init__()
+        self.state_dir = state_dir
+        self.sequence = sequence
+        self.callbacks = callbacks or []
+        self.resume = resume
+        self.keep = keep
+        self.restored = None
+        self.sequence_restored = False
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+    def latest(self):
+        """Metadata of the latest checkpoint, or None"""
+        latest_path = os.path.join(self.state_dir, LATEST_NAME)
+        if not os.path.isfile(latest_path):
+            return None
+        with open(latest_path) as fp:
+            return json.load(fp)
+
+    def initial_epoch(self):
+        """Epoch to resume fit from, 0 if not resuming or no checkpoint"""
+        latest = self.latest() if self.resume else None
+        return 0 if latest is None else latest['epoch']
+
+    def latest_state(self):
+        """state.json contents of the latest checkpoint, or None"""
+        latest = self.latest() if self.resume else None
+        if latest is None:
+            return None
+        with open(os.path.join(self.state_dir, latest['name'],
+                               'state.json')) as fp:
+            return json.load(fp)
+
+    def restore_sequence(self):
+        """Restore the training sequence's epoch, order and augmentation.
+
+        Call before fit, so batches prepared ahead by loader threads, before
+        on_train_begin, already use the restored state. Done in
+        on_train_begin otherwise.
+
+        """
+        self.sequence_restored = True
+        state = self.latest_state()
+        if state is None or self.sequence is None:
+            return
+        seq_state = state['sequence']
+        self.sequence.epoch = seq_state['epoch']
+        self.sequence.order = np.array(seq_state['order'])
+        rng_state = seq_state['rng']
+        self.sequence.rng.set_state(
+            (rng_state[0], np.array(rng_state[1], np.uint32),
+             rng_state[2], rng_state[3], rng_state[4]))
+        augmenter = getattr(self.sequence, 'augmenter', None)
+        if augmenter is not None and 'augmenter_seed' in seq_state:
+            augmenter.seed = seq_state['augmenter_seed']
+
+        return
+
+    def tf_checkpoint(self):
+        return tf.train.Checkpoint(
+            model=self.model, optimizer=self.model.optimizer,
+            rng=tf.random.get_global_generator())
+
+    def on_train_begin(self, logs=None):
+        # Restore here, after other callbacks reset their own state
+        latest = self.latest() if self.resume else None
+        if latest is None:
+            return
+        print('Resuming from {} at epoch {}'.format(latest['name'],
+                                                    latest['epoch']))
+        ckpt_dir = os.path.join(self.state_dir, latest['name'])
+        self.tf_checkpoint().read(os.path.join(ckpt_dir, 'ckpt'))
+        with open(os.path.join(ckpt_dir, 'state.json')) as fp:
+            state = json.load(fp)
+
+        for callback, cb_state in zip(self.callbacks, state['callbacks']):
+            set_callback_state(callback, cb_state)
+        np_state = state['numpy_random']
+        np.random.set_state((np_state[0], np.array(np_state[1], np.uint32),
+                             np_state[2], np_state[3], np_state[4]))
+        py_state = state['python_random']
+        random.setstate((py_state[0], tuple(py_state[1]), py_state[2]))
+        if not self.sequence_restored:
+            self.restore_sequence()
+        self.restored = latest
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.save(epoch + 1)
+
+    def save(self, epoch):
+        """Write a checkpoint for resuming at epoch, atomically."""
+        name = 'epoch_{:05d}'.format(epoch)
+        ckpt_dir = os.path.join(self.state_dir, name)
+        tmp_dir = '{}.tmp'.format(ckpt_dir)
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        self.tf_checkpoint().write(os.path.join(tmp_dir, 'ckpt'))
+        np_state = np.random.get_state()
+        py_state = random.getstate()
+        state = {'epoch': epoch,
+                 'callbacks': [callback_state(c) for c in self.callbacks],
+                 'numpy_random': [np_state[0], np_state[1].tolist(),
+                                  int(np_state[2]), int(np_state[3]),
+                                  float(np_state[4])],
+                 'python_random': [py_state[0], list(py_state[1]),
+                                   py_state[2]]}
+        if self.sequence is not None:
+            rng_state = self.sequence.rng.get_state()
+            state['sequence'] = {
+                'epoch': int(self.sequence.epoch),
+                'order': self.sequence.order.tolist(),
+                'rng': [rng_state[0], rng_state[1].tolist(),
+                        int(rng_state[2]), int(rng_state[3]),
+                        float(rng_state[4])]}
+            augmenter = getattr(self.sequence, 'augmenter', None)
+            if augmenter is not None:
+                state['sequence']['augmenter_seed'] = int(augmenter.seed)
+        with open(os.path.join(tmp_dir, 'state.json'), 'w') as fp:
+            json.dump(state, fp)
+
+        if os.path.isdir(ckpt_dir):
+            shutil.rmtree(ckpt_dir)
+        os.rename(tmp_dir, ckpt_dir)
+
+        latest_path = os.path.join(self.state_dir, LATEST_NAME)
+        with open('{}.tmp'.format(latest_path), 'w') as fp:
+            json.dump({'name': name, 'epoch': epoch}, fp)
+        os.replace('{}.tmp'.format(latest_path), latest_path)
+
+        self.prune(name)
+
+        return
+
+    def prune(self, latest_name):
+        """Remove all but the keep most recent checkpoints."""
+        names = sorted(n for n in os.listdir(self.state_dir)
+                       if n.startswith('epoch_') and not n.endswith('.tmp'))
+        for name in names[:-self.keep]:
+            if name != latest_name:
+                shutil.rmtree(os.path.join(self.state_dir, name),
+                              ignore_errors=True)
+
+        return